@@ -0,0 +1,35 @@
+"""
+Truncated exponential backoff for transient API errors, shared by the Sheets and Trello services.
+"""
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+MAX_TRIES = 5
+
+def call_with_backoff(call, retry_status, *, api_name: str, tries: int = MAX_TRIES):
+    """Runs call(), retrying with exponential backoff (1s, 2s, 4s, 8s, plus jitter) on transient errors.
+
+    Args:
+        call: A function without arguments performing one API request.
+        retry_status: Given an exception raised by call, returns its HTTP status if the request
+                      should be retried, or None to re-raise the exception right away.
+        api_name: Name of the API, for the retry log line.
+        tries: Total number of attempts; the error of the last one is re-raised.
+
+    Returns:
+        Whatever call() returns.
+    """
+    for attempt in range(tries):
+        try:
+            return call()
+        except Exception as error:
+            status = retry_status(error)
+            if status is None or attempt == tries - 1:
+                raise
+            delay = 2 ** attempt + random.random()
+            logger.warning("%s returned %s, retrying in %.1fs (retry %s of %s)",
+                           api_name, status, delay, attempt + 1, tries - 1)
+            time.sleep(delay)
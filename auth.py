@@ -1,9 +1,15 @@
 import os.path
+import datetime
+import logging
+import threading
 import google.auth
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from config import GMAIL_PROCESSED_LABEL_NAME
+
+logger = logging.getLogger(__name__)
 
 # If modifying these scopes, delete the file token.json.
 # Scopes required for Gmail reading, Drive upload, Sheets access
@@ -12,67 +18,137 @@ SCOPES = [
     'https://www.googleapis.com/auth/drive',                 # Upload files to Drive
     'https://www.googleapis.com/auth/spreadsheets'        # Read/write Google Sheets
 ]
+if GMAIL_PROCESSED_LABEL_NAME:
+    SCOPES.append('https://www.googleapis.com/auth/gmail.modify') # Add the processed label to emails
 
 CREDENTIALS_FILE = 'credentials.json'
 TOKEN_FILE = 'token.json'
 
+# Refresh the access token this long before it actually expires, so no request fails mid-flight.
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+# Process-wide credentials cache: loaded/refreshed once and shared by every service client.
+_creds_cache = None
+_creds_mtime = None # token.json mtime (ns) the cached credentials correspond to
+_creds_lock = threading.RLock() # Serializes load/refresh when called from worker threads
+_creds_generation = 0 # Bumped whenever _creds_cache is replaced by a new credentials object
+
+# Service clients are built once per (service_name, version) *per thread*: googleapiclient
+# clients use httplib2, which is not thread-safe, so threads must not share them.
+_thread_services = threading.local()
+
+def _thread_service_cache() -> dict:
+    """Returns the calling thread's service client cache, dropping it if credentials changed."""
+    cache = getattr(_thread_services, 'cache', None)
+    if cache is None or _thread_services.generation != _creds_generation:
+        cache = _thread_services.cache = {}
+        _thread_services.generation = _creds_generation
+    return cache
+
+def _token_file_mtime() -> int | None:
+    """Returns token.json's mtime in ns, or None if it doesn't exist. One stat() call."""
+    try:
+        return os.stat(TOKEN_FILE).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+def _save_token(creds):
+    """Writes the credentials to token.json atomically (temp file + rename)."""
+    global _creds_mtime
+    data = creds.to_json().encode('utf-8')
+    tmp_path = f"{TOKEN_FILE}.tmp"
+    try:
+        with open(tmp_path, 'wb') as token:
+            token.write(data)
+        os.replace(tmp_path, TOKEN_FILE)
+    except OSError:
+        # A single-file bind mount (see docker-compose.yml) can't be replaced by rename; write in place.
+        with open(TOKEN_FILE, 'wb') as token:
+            token.write(data)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    _creds_mtime = _token_file_mtime() # Don't treat our own write as an external change
+
+def _expires_soon(creds) -> bool:
+    """True if the credentials' access token expires within TOKEN_REFRESH_MARGIN."""
+    # google-auth stores expiry as a naive UTC datetime.
+    return creds.expiry is not None and creds.expiry - datetime.datetime.utcnow() < TOKEN_REFRESH_MARGIN
+
 def get_google_credentials():
     """Shows basic usage of the Google APIs authentication flow.
     Returns authorized credentials object.
     Handles token refresh and initial authorization flow.
+    The result is cached in-process; token.json is only re-read if its mtime changes
+    (e.g. it was re-issued outside this process). Safe to call from multiple threads.
     """
-    creds = None
+    with _creds_lock:
+        return _get_google_credentials_locked()
+
+def _get_google_credentials_locked():
+    """get_google_credentials() body; caller holds _creds_lock."""
+    global _creds_cache, _creds_mtime, _creds_generation
+    token_mtime = _token_file_mtime()
+    if token_mtime != _creds_mtime:
+        _creds_cache = None # token.json changed on disk (or disappeared); reload it
+    if _creds_cache and _creds_cache.valid and not _expires_soon(_creds_cache):
+        return _creds_cache
+
+    creds = _creds_cache
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
-    if os.path.exists(TOKEN_FILE):
+    if creds is None and token_mtime is not None:
         try:
             creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
-            print(f"Loaded credentials from {TOKEN_FILE}")
+            _creds_mtime = token_mtime
+            logger.info("Loaded credentials from %s", TOKEN_FILE)
         except Exception as e:
-             print(f"Error loading credentials from {TOKEN_FILE}: {e}. Will re-authenticate.")
+             logger.error("Error loading credentials from %s: %s. Will re-authenticate.", TOKEN_FILE, e)
              creds = None # Force re-authentication
              # Optional: delete the corrupted token file
              # if os.path.exists(TOKEN_FILE):
              #    os.remove(TOKEN_FILE)
 
     # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            print("Credentials expired, refreshing...")
+    if not creds or not creds.valid or (creds.refresh_token and _expires_soon(creds)):
+        if creds and creds.refresh_token and (creds.expired or _expires_soon(creds)):
+            logger.info("Credentials expired or about to expire, refreshing...")
             try:
                 creds.refresh(Request())
-                print("Credentials refreshed successfully.")
+                logger.info("Credentials refreshed successfully.")
             except google.auth.exceptions.RefreshError as e:
-                 print(f"Error refreshing token: {e}. Need to re-authenticate.")
+                 logger.error("Error refreshing token: %s. Need to re-authenticate.", e)
                  # Likely refresh token revoked or expired, need full re-auth
                  creds = None 
                  # Delete potentially invalid token file
                  if os.path.exists(TOKEN_FILE):
-                     print(f"Deleting invalid token file: {TOKEN_FILE}")
+                     logger.info("Deleting invalid token file: %s", TOKEN_FILE)
                      os.remove(TOKEN_FILE)
         else:
             if not os.path.exists(CREDENTIALS_FILE):
-                print(f"Error: {CREDENTIALS_FILE} not found. Please download it from Google Cloud Console.")
+                logger.error("Error: %s not found. Please download it from Google Cloud Console.", CREDENTIALS_FILE)
                 return None
-            print(f"No valid token found or refresh failed. Starting authentication flow using {CREDENTIALS_FILE}...")
+            logger.info("No valid token found or refresh failed. Starting authentication flow using %s...", CREDENTIALS_FILE)
             flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
             # Run local server flow, this will open a browser window for auth
             creds = flow.run_local_server(port=0)
-            print("Authentication successful.")
+            logger.info("Authentication successful.")
         # Save the credentials for the next run
         if creds:
             try:
-                with open(TOKEN_FILE, 'w') as token:
-                    token.write(creds.to_json())
-                print(f"Credentials saved to {TOKEN_FILE}")
+                _save_token(creds)
+                logger.info("Credentials saved to %s", TOKEN_FILE)
             except Exception as e:
-                print(f"Error saving token to {TOKEN_FILE}: {e}")
+                logger.error("Error saving token to %s: %s", TOKEN_FILE, e)
 
     if not creds or not creds.valid:
-         print("Failed to obtain valid credentials.")
+         logger.error("Failed to obtain valid credentials.")
+         _creds_cache = None
          return None
 
+    if creds is not _creds_cache:
+        _creds_generation += 1 # Clients built with the previous credentials object are stale
+    _creds_cache = creds
     return creds
 
 def get_service(service_name: str, version: str):
@@ -84,19 +160,28 @@ def get_service(service_name: str, version: str):
 
     Returns:
         An authorized API service object, or None if authentication fails.
+        The client is built once per (service_name, version) per thread and reused afterwards.
     """
     creds = get_google_credentials()
     if not creds:
         return None
+    service_cache = _thread_service_cache()
+    cache_key = (service_name, version)
+    service = service_cache.get(cache_key)
+    if service is not None:
+        return service
     try:
-        service = build(service_name, version, credentials=creds)
-        print(f"Successfully built service client for {service_name} {version}")
+        # googleapiclient's file discovery cache only emits warnings with google-auth; the built client is cached instead.
+        service = build(service_name, version, credentials=creds, cache_discovery=False)
+        service_cache[cache_key] = service
+        logger.info("Successfully built service client for %s %s", service_name, version)
         return service
     except Exception as e:
-        print(f"An error occurred building the service client for {service_name}: {e}")
+        logger.error("An error occurred building the service client for %s: %s", service_name, e)
         return None
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     print("Attempting to get Google credentials...")
     credentials = get_google_credentials()
     if credentials:
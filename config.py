@@ -18,12 +18,24 @@ TRELLO_INVOICE_LIST_ID_ENV = "TRELLO_INVOICE_LIST_ID" # For new invoices
 # Google Sheets
 GOOGLE_SHEET_ID_FAKTURY_ENV = "GOOGLE_SHEET_ID_FAKTURY" # Main spreadsheet for invoices
 
-# Headers for individual month sheets (e.g., "05.2024")
-# Пов'язано з авто/паливом
-SHEET_HEADERS = [
-    "Номер фактури", "Дата виставлення", "Виставив", "Дата оплати", "Платник",
-    "NIP Платника", "Сума (брутто)", "VAT", "Пов\'язано з авто/паливом", "Посилання на Google Drive"
-]
+# Columns of the individual month sheets (e.g., "05.2024"), as (invoice data key, header) pairs.
+# The same fields, in the same order, make up the Trello card description.
+# "drive_file_link" is not extracted by Gemini; it's the Drive link of the uploaded file.
+INVOICE_COLUMNS = (
+    ("invoice_number", "Номер фактури"),
+    ("invoice_date", "Дата виставлення"),
+    ("issuer", "Виставив"),
+    ("due_date", "Дата оплати"),
+    ("payer", "Платник"),
+    ("payer_nip", "NIP Платника"),
+    ("gross_amount", "Сума (брутто)"),
+    ("vat_amount", "VAT"),
+    ("is_fuel_related", "Пов\'язано з авто/паливом"),
+    ("drive_file_link", "Посилання на Google Drive"),
+)
+
+# Headers for individual month sheets
+SHEET_HEADERS = [header for _, header in INVOICE_COLUMNS]
 
 VAT_SUMMARY_SHEET_NAME = "VAT Звіт" # Sheet name for VAT summaries
 VAT_SUMMARY_HEADERS = [
@@ -40,8 +52,17 @@ GMAIL_QUERY = "has:attachment label:inbox"
 # Optional: Process emails received only after this date (YYYY-MM-DD).
 # If None or empty, all emails matching GMAIL_QUERY will be considered.
 PROCESS_EMAILS_AFTER_DATE = "2025-05-20" # Example: "2024-01-01"
+# Optional: Gmail label added to emails once they are processed, and excluded from GMAIL_QUERY,
+# so each poll only lists new emails. Requires the gmail.modify scope: after enabling it,
+# delete token.json and authorize again. If None, processed emails are tracked in the database only.
+GMAIL_PROCESSED_LABEL_NAME = None # Example: "Invoice-Processed"
 
 # Other
 MONTH_YEAR_FORMAT = "%m.%Y"
 DATE_FORMAT = "%Y-%m-%d"
-EMAIL_CHECK_INTERVAL_SECONDS = 20 # Check email interval in seconds 
\ No newline at end of file
+EMAIL_CHECK_INTERVAL_SECONDS = 20 # Check email interval in seconds 
+
+# Gemini
+# On-disk cache of Gemini extraction results (kept under db_data so it survives container restarts).
+# Set GEMINI_NO_CACHE=1 in the environment to bypass it.
+GEMINI_CACHE_DIR = "db_data/gemini_cache"
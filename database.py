@@ -1,20 +1,106 @@
 import sqlite3
 import os
+import hashlib
+import logging
+import atexit
+import threading
+from collections import OrderedDict
 from config import DB_NAME
 
+logger = logging.getLogger(__name__)
+
+# One connection per thread, opened lazily and reused for the life of the process.
+_thread_local = threading.local()
+_all_connections = []
+_connections_lock = threading.Lock()
+
+# Email IDs known to be processed, most recently used last. An ID never becomes unprocessed,
+# so only positive results are cached and nothing has to be invalidated on insert.
+_PROCESSED_CACHE_MAXSIZE = 10000
+_processed_cache = OrderedDict()
+_processed_cache_lock = threading.Lock()
+
+# Per-connection tuning. journal_mode=WAL is persisted in the DB file and set in init_db().
+_CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",     # Safe with WAL; one fsync per checkpoint instead of per commit
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",      # ~64 MB page cache
+    "PRAGMA mmap_size=268435456",    # 256 MB memory-mapped I/O
+    "PRAGMA busy_timeout=5000",      # Wait up to 5s for a lock instead of failing immediately
+)
+
+# SQL statements used on the hot path. sqlite3 keeps a per-connection cache of prepared
+# statements keyed by SQL text; defining each statement once keeps the text identical
+# across call sites so every call after the first skips parsing/planning.
+_SQL_ADD_PROCESSED_EMAIL = "INSERT INTO processed_emails (email_id) VALUES (?)"
+_SQL_ADD_PROCESSED_EMAIL_IGNORE = "INSERT OR IGNORE INTO processed_emails (email_id) VALUES (?)"
+_SQL_IS_EMAIL_PROCESSED = "SELECT 1 FROM processed_emails WHERE email_id = ?"
+_SQL_ADD_INVOICE = '''
+    INSERT INTO invoices (
+        invoice_number, invoice_date, issuer, due_date, payer, 
+        payer_nip, gross_amount, vat_amount, is_fuel_related,
+        google_drive_file_id, google_drive_file_weblink, trello_card_id,
+        google_sheets_row_id, original_email_id, attachment_filename,
+        dedup_hash
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+_SQL_SET_INVOICE_DEDUP_HASH = "UPDATE invoices SET dedup_hash = ? WHERE id = ?"
+_SQL_FIND_EXACT_DUPLICATE = "SELECT id FROM invoices WHERE dedup_hash = ? LIMIT 1"
+_SQL_FIND_INVOICES_BY_NUMBER = "SELECT * FROM invoices WHERE invoice_number = ? ORDER BY created_at DESC"
+_SQL_DELETE_INVOICE = "DELETE FROM invoices WHERE id = ?"
+_SQL_ADD_DRIVE_FOLDER = "INSERT OR REPLACE INTO drive_folders (name, parent_id, folder_id) VALUES (?, ?, ?)"
+
+# Fields identifying "the same invoice" for find_exact_duplicate, in hashing order. Same fields as
+# the old Python-side comparison in main.py; payer_nip is derived from payer, so it is left out.
+_DEDUP_FIELDS = (
+    'invoice_number', 'invoice_date', 'issuer', 'due_date', 'payer',
+    'gross_amount', 'vat_amount', 'is_fuel_related',
+)
+
+# Room for the statements above plus ad-hoc queries without evicting hot entries.
+_STATEMENT_CACHE_SIZE = 256
+
 def get_db_connection():
-    """Establishes a connection to the SQLite database."""
-    conn = sqlite3.connect(DB_NAME)
-    conn.row_factory = sqlite3.Row
+    """Returns the SQLite connection for the current thread, opening it on first use."""
+    conn = getattr(_thread_local, 'conn', None)
+    if conn is None:
+        # isolation_level=None -> autocommit; multi-statement writes use explicit BEGIN/COMMIT.
+        conn = sqlite3.connect(DB_NAME, check_same_thread=False, isolation_level=None,
+                               cached_statements=_STATEMENT_CACHE_SIZE)
+        conn.row_factory = sqlite3.Row
+        for pragma in _CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        _thread_local.conn = conn
+        with _connections_lock:
+            _all_connections.append(conn)
     return conn
 
+def close_db_connections():
+    """Closes every connection opened by this module. Registered with atexit."""
+    with _connections_lock:
+        while _all_connections:
+            conn = _all_connections.pop()
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.error("Error closing database connection: %s", e)
+    _thread_local.__dict__.pop('conn', None)
+
+atexit.register(close_db_connections)
+
 def init_db():
     """Initializes the database and creates tables if they don't exist."""
     if not os.path.exists(DB_NAME):
-        print(f"Database '{DB_NAME}' does not exist. Creating...")
+        logger.info("Database '%s' does not exist. Creating...", DB_NAME)
     
     conn = get_db_connection()
     try:
+        # WAL lets readers (is_email_processed, find_*) run while a write is in progress.
+        # The -wal/-shm files live next to DB_NAME.
+        journal_mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        logger.info("Database journal mode: %s", journal_mode)
+
         # Create processed_emails table
         conn.execute('''
             CREATE TABLE IF NOT EXISTS processed_emails (
@@ -23,7 +109,7 @@ def init_db():
                 processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-        print("Table 'processed_emails' created successfully or already exists.")
+        logger.info("Table 'processed_emails' created successfully or already exists.")
 
         # Create invoices table
         conn.execute('''
@@ -37,65 +123,213 @@ def init_db():
                 payer_nip TEXT,
                 gross_amount REAL,
                 vat_amount REAL,
-                is_fuel_related INTEGER, -- 0 for false, 1 for true
+                is_fuel_related INTEGER CHECK (is_fuel_related IN (0, 1)), -- 0 for false, 1 for true
                 google_drive_file_id TEXT,
                 google_drive_file_weblink TEXT,
                 trello_card_id TEXT,
                 google_sheets_row_id TEXT, -- For future use
                 original_email_id TEXT, 
                 attachment_filename TEXT,
+                dedup_hash TEXT, -- See invoice_dedup_hash()
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP 
             )
         ''')
-        print("Table 'invoices' created successfully or already exists.")
+        logger.info("Table 'invoices' created successfully or already exists.")
+
+        _migrate_invoices_dedup_hash(conn)
+
+        # Index for find_invoices_by_number: equality on invoice_number,
+        # then ORDER BY created_at DESC read straight off the index (no sort step).
+        conn.execute('''
+            CREATE INDEX IF NOT EXISTS idx_invoices_number_created
+            ON invoices (invoice_number, created_at DESC)
+        ''')
+        logger.info("Index 'idx_invoices_number_created' created successfully or already exists.")
 
-        # Trigger to update 'updated_at' timestamp on invoices table update
+        # Cache of Google Drive folder IDs, keyed by (folder name, parent folder ID)
         conn.execute('''
-            CREATE TRIGGER IF NOT EXISTS update_invoices_updated_at
-            AFTER UPDATE ON invoices
-            FOR EACH ROW
-            BEGIN
-                UPDATE invoices SET updated_at = CURRENT_TIMESTAMP WHERE id = OLD.id;
-            END;
+            CREATE TABLE IF NOT EXISTS drive_folders (
+                name TEXT NOT NULL,
+                parent_id TEXT NOT NULL,
+                folder_id TEXT NOT NULL,
+                PRIMARY KEY (name, parent_id)
+            )
         ''')
-        print("Trigger 'update_invoices_updated_at' created successfully or already exists.")
-        
-        conn.commit()
+        logger.info("Table 'drive_folders' created successfully or already exists.")
+
+        # The old AFTER UPDATE trigger re-wrote every updated row a second time just to bump
+        # 'updated_at'. Any UPDATE on invoices must now set it itself:
+        #     UPDATE invoices SET ..., updated_at = CURRENT_TIMESTAMP WHERE id = ?
+        conn.execute("DROP TRIGGER IF EXISTS update_invoices_updated_at")
     except sqlite3.Error as e:
-        print(f"Error initializing database: {e}")
-    finally:
-        conn.close()
+        logger.error("Error initializing database: %s", e)
+
+def _migrate_invoices_dedup_hash(conn):
+    """Adds and backfills invoices.dedup_hash on databases created before it existed,
+    then creates its index."""
+    columns = {row['name'] for row in conn.execute("PRAGMA table_info(invoices)")}
+    if 'dedup_hash' not in columns:
+        conn.execute("ALTER TABLE invoices ADD COLUMN dedup_hash TEXT")
+        logger.info("Added column 'dedup_hash' to table 'invoices'.")
+
+    # Derived column, so updated_at is deliberately left alone here.
+    rows = conn.execute(f"SELECT id, {', '.join(_DEDUP_FIELDS)} FROM invoices WHERE dedup_hash IS NULL").fetchall()
+    if rows:
+        conn.execute("BEGIN")
+        conn.executemany(_SQL_SET_INVOICE_DEDUP_HASH,
+                         ((invoice_dedup_hash(dict(row)), row['id']) for row in rows))
+        conn.execute("COMMIT")
+        logger.info("Backfilled dedup_hash for %s invoice(s).", len(rows))
+
+    # Not UNIQUE: inserts never fail on a duplicate, they are only looked up before inserting.
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_invoices_dedup_hash ON invoices (dedup_hash)")
+    logger.info("Index 'idx_invoices_dedup_hash' created successfully or already exists.")
+
+def _amount_param(value) -> float | None:
+    """Converts an amount (number or string, '.' or ',' as decimal separator) to a float rounded to 2 decimals, or None."""
+    if isinstance(value, (float, int)):
+        return round(float(value), 2)
+    if isinstance(value, str):
+        try:
+            return round(float(value.replace(',', '.')), 2)
+        except ValueError:
+            return None
+    return None
+
+def _canonical_amount(value) -> str:
+    amount = _amount_param(value)
+    if amount is None:
+        return '' if value is None else str(value).strip()
+    return f"{amount:.2f}"
+
+def invoice_dedup_hash(invoice_data: dict) -> str:
+    """Returns a stable hash of the fields find_exact_duplicate matches on.
+    Amounts are rounded to 2 decimals so 100.1, 100.10 and "100,10" hash the same, and
+    is_fuel_related is reduced to 0/1; missing values hash as empty strings.
+    """
+    parts = []
+    for field in _DEDUP_FIELDS:
+        value = invoice_data.get(field)
+        if field in ('gross_amount', 'vat_amount'):
+            parts.append(_canonical_amount(value))
+        elif field == 'is_fuel_related':
+            parts.append('1' if value else '0')
+        else:
+            parts.append('' if value is None else str(value))
+    return hashlib.blake2b('\x1f'.join(parts).encode('utf-8'), digest_size=20).hexdigest()
+
+def _remember_processed(email_ids):
+    """Adds email IDs to the in-memory processed cache, evicting the least recently used."""
+    with _processed_cache_lock:
+        for email_id in email_ids:
+            _processed_cache[email_id] = True
+            _processed_cache.move_to_end(email_id)
+        while len(_processed_cache) > _PROCESSED_CACHE_MAXSIZE:
+            _processed_cache.popitem(last=False)
+
+def _is_cached_processed(email_id: str) -> bool:
+    with _processed_cache_lock:
+        if email_id in _processed_cache:
+            _processed_cache.move_to_end(email_id)
+            return True
+        return False
 
 def add_processed_email(email_id: str):
     """Adds a processed email ID to the database."""
     conn = get_db_connection()
     try:
-        conn.execute("INSERT INTO processed_emails (email_id) VALUES (?)", (email_id,))
-        conn.commit()
-        print(f"Added email ID {email_id} to processed list.")
+        conn.execute(_SQL_ADD_PROCESSED_EMAIL, (email_id,))
+        _remember_processed((email_id,))
+        logger.info("Added email ID %s to processed list.", email_id)
         return True
     except sqlite3.IntegrityError:
-        print(f"Email ID {email_id} already processed.")
+        _remember_processed((email_id,))
+        logger.info("Email ID %s already processed.", email_id)
         return False
     except sqlite3.Error as e:
-        print(f"Error adding email ID {email_id}: {e}")
+        logger.error("Error adding email ID %s: %s", email_id, e)
         return False
-    finally:
-        conn.close()
+
+def add_processed_emails(email_ids: list[str]) -> int:
+    """Adds several processed email IDs in a single transaction, ignoring ones already stored.
+    Returns:
+        The number of newly added IDs (0 on error).
+    """
+    if not email_ids:
+        return 0
+    conn = get_db_connection()
+    try:
+        conn.execute("BEGIN")
+        cursor = conn.executemany(_SQL_ADD_PROCESSED_EMAIL_IGNORE,
+                                  ((email_id,) for email_id in email_ids))
+        conn.execute("COMMIT")
+        _remember_processed(email_ids)
+        logger.info("Added %s of %s email IDs to processed list.", cursor.rowcount, len(email_ids))
+        return cursor.rowcount
+    except sqlite3.Error as e:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        logger.error("Error adding batch of %s email IDs: %s", len(email_ids), e)
+        return 0
 
 def is_email_processed(email_id: str) -> bool:
-    """Checks if an email ID has already been processed."""
+    """Checks if an email ID has already been processed. Warm hits skip SQLite."""
+    if _is_cached_processed(email_id):
+        return True
     conn = get_db_connection()
     try:
-        cursor = conn.execute("SELECT 1 FROM processed_emails WHERE email_id = ?", (email_id,))
+        cursor = conn.execute(_SQL_IS_EMAIL_PROCESSED, (email_id,))
         result = cursor.fetchone()
+        if result is not None:
+            _remember_processed((email_id,))
         return result is not None
     except sqlite3.Error as e:
-        print(f"Error checking email ID {email_id}: {e}")
+        logger.error("Error checking email ID %s: %s", email_id, e)
         return False
-    finally:
-        conn.close()
+
+# Stays well under SQLite's host-parameter limit (999 on older builds)
+_IN_CLAUSE_CHUNK_SIZE = 500
+
+def filter_unprocessed(email_ids: list[str]) -> set[str]:
+    """Returns the subset of email_ids that are not yet in processed_emails.
+    Uses one IN (...) query per 500 IDs instead of one lookup per ID; IDs already in the
+    in-memory processed cache are not queried at all.
+    On a database error, the uncached IDs are treated as unprocessed (same as is_email_processed).
+    """
+    unique_ids = [email_id for email_id in dict.fromkeys(email_ids) if not _is_cached_processed(email_id)]
+    if not unique_ids:
+        return set()
+    conn = get_db_connection()
+    processed = set()
+    try:
+        for start in range(0, len(unique_ids), _IN_CLAUSE_CHUNK_SIZE):
+            chunk = unique_ids[start:start + _IN_CLAUSE_CHUNK_SIZE]
+            placeholders = ",".join("?" * len(chunk))
+            cursor = conn.execute(f"SELECT email_id FROM processed_emails WHERE email_id IN ({placeholders})", chunk)
+            processed.update(row[0] for row in cursor)
+    except sqlite3.Error as e:
+        logger.error("Error checking %s email IDs against processed list: %s", len(unique_ids), e)
+        return set(unique_ids)
+    _remember_processed(processed)
+    return set(unique_ids) - processed
+
+def _invoice_insert_params(invoice_data: dict) -> tuple:
+    """Builds the parameter tuple for _SQL_ADD_INVOICE from an invoice dict."""
+    return (
+        invoice_data.get('invoice_number'), invoice_data.get('invoice_date'),
+        invoice_data.get('issuer'), invoice_data.get('due_date'),
+        invoice_data.get('payer'), invoice_data.get('payer_nip'),
+        invoice_data.get('gross_amount'), invoice_data.get('vat_amount'),
+        invoice_data.get('is_fuel_related'),
+        invoice_data.get('google_drive_file_id'), 
+        invoice_data.get('google_drive_file_weblink'),
+        invoice_data.get('trello_card_id'), 
+        invoice_data.get('google_sheets_row_id'),
+        invoice_data.get('original_email_id'),
+        invoice_data.get('attachment_filename'),
+        invoice_dedup_hash(invoice_data)
+    )
 
 def add_invoice(invoice_data: dict) -> int | None:
     """Adds a new invoice record to the database.
@@ -111,88 +345,31 @@ def add_invoice(invoice_data: dict) -> int | None:
     """
     conn = get_db_connection()
     try:
-        # Ensure boolean is_fuel_related is stored as integer
-        is_fuel_related_int = 1 if invoice_data.get('is_fuel_related') else 0
-
-        cursor = conn.execute('''
-            INSERT INTO invoices (
-                invoice_number, invoice_date, issuer, due_date, payer, 
-                payer_nip, gross_amount, vat_amount, is_fuel_related,
-                google_drive_file_id, google_drive_file_weblink, trello_card_id,
-                google_sheets_row_id, original_email_id, attachment_filename
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            invoice_data.get('invoice_number'), invoice_data.get('invoice_date'),
-            invoice_data.get('issuer'), invoice_data.get('due_date'),
-            invoice_data.get('payer'), invoice_data.get('payer_nip'),
-            invoice_data.get('gross_amount'), invoice_data.get('vat_amount'),
-            is_fuel_related_int,
-            invoice_data.get('google_drive_file_id'), 
-            invoice_data.get('google_drive_file_weblink'),
-            invoice_data.get('trello_card_id'), 
-            invoice_data.get('google_sheets_row_id'),
-            invoice_data.get('original_email_id'),
-            invoice_data.get('attachment_filename')
-        ))
-        conn.commit()
-        print(f"Added invoice with number: {invoice_data.get('invoice_number')} to database. ID: {cursor.lastrowid}")
+        cursor = conn.execute(_SQL_ADD_INVOICE, _invoice_insert_params(invoice_data))
+        logger.info("Added invoice with number: %s to database. ID: %s", invoice_data.get('invoice_number'), cursor.lastrowid)
         return cursor.lastrowid
     except sqlite3.Error as e:
-        print(f"Error adding invoice {invoice_data.get('invoice_number')}: {e}")
+        logger.error("Error adding invoice %s: %s", invoice_data.get('invoice_number'), e)
         return None
-    finally:
-        conn.close()
 
-def find_invoice(details: dict) -> dict | None:
+def find_exact_duplicate(details: dict) -> int | None:
     """
-    Finds an invoice based on a set of key details.
-    Searches for an exact match on: invoice_number, invoice_date, issuer, due_date, 
-                                   payer, gross_amount, vat_amount, is_fuel_related.
-    If multiple records match these criteria (e.g., due to reprocessing without cleanup),
-    it will return the most recently created one.
+    Finds an invoice with the same number, dates, payer, issuer, amounts (to the cent)
+    and fuel flag as details, via a single indexed lookup on their dedup_hash.
     Args:
-        details: A dictionary containing the key fields to search for.
+        details: A dictionary with the invoice fields (as returned by gemini_analyzer).
     Returns:
-        A dictionary representing the invoice row if found, otherwise None.
+        The ID of the matching invoice, or None if there is none (or amounts are not numeric).
     """
+    if _amount_param(details.get('gross_amount')) is None or _amount_param(details.get('vat_amount')) is None:
+        return None
     conn = get_db_connection()
     try:
-        # Ensure boolean is_fuel_related is converted to int for query
-        is_fuel_related_int = 1 if details.get('is_fuel_related') else 0
-        
-        # Convert amounts to float if they are strings, for consistent comparison.
-        # SQLite REAL type can sometimes have precision issues with direct float comparison
-        # but for this use case, it should be acceptable.
-        # Ensure values from Gemini (string numbers) are compared correctly.
-        gross_amount = float(details.get('gross_amount')) if details.get('gross_amount') is not None else None
-        vat_amount = float(details.get('vat_amount')) if details.get('vat_amount') is not None else None
-
-
-        query = '''
-            SELECT * FROM invoices 
-            WHERE invoice_number = ? AND invoice_date = ? AND issuer = ? 
-            AND due_date = ? AND payer = ? AND payer_nip = ? AND gross_amount = ? 
-            AND vat_amount = ? AND is_fuel_related = ?
-            ORDER BY created_at DESC 
-            LIMIT 1 
-        '''
-        cursor = conn.execute(query, (
-            details.get('invoice_number'), details.get('invoice_date'),
-            details.get('issuer'), details.get('due_date'),
-            details.get('payer'), details.get('payer_nip'),
-            gross_amount, vat_amount, is_fuel_related_int
-        ))
-        row = cursor.fetchone()
-        return dict(row) if row else None
+        row = conn.execute(_SQL_FIND_EXACT_DUPLICATE, (invoice_dedup_hash(details),)).fetchone()
+        return row['id'] if row else None
     except sqlite3.Error as e:
-        print(f"Error finding invoice with number {details.get('invoice_number')}: {e}")
-        return None
-    except (TypeError, ValueError) as conv_err: # Handle errors from float conversion
-        print(f"Error converting amount for invoice {details.get('invoice_number')} during search: {conv_err}")
+        logger.error("Error checking for duplicate of invoice %s: %s", details.get('invoice_number'), e)
         return None
-    finally:
-        conn.close()
 
 def find_invoices_by_number(invoice_number: str) -> list[dict]:
     """
@@ -206,33 +383,60 @@ def find_invoices_by_number(invoice_number: str) -> list[dict]:
     conn = get_db_connection()
     invoices_list = []
     try:
-        cursor = conn.execute("SELECT * FROM invoices WHERE invoice_number = ? ORDER BY created_at DESC", (invoice_number,))
+        cursor = conn.execute(_SQL_FIND_INVOICES_BY_NUMBER, (invoice_number,))
         rows = cursor.fetchall()
         for row in rows:
             invoices_list.append(dict(row))
         return invoices_list
     except sqlite3.Error as e:
-        print(f"Error finding invoices by number {invoice_number}: {e}")
+        logger.error("Error finding invoices by number %s: %s", invoice_number, e)
         return []
-    finally:
-        conn.close()
 
 
 def delete_invoice(invoice_id: int) -> bool:
     """Deletes an invoice from the database by its ID."""
     conn = get_db_connection()
     try:
-        conn.execute("DELETE FROM invoices WHERE id = ?", (invoice_id,))
-        conn.commit()
-        print(f"Deleted invoice with ID: {invoice_id} from database.")
+        conn.execute(_SQL_DELETE_INVOICE, (invoice_id,))
+        logger.info("Deleted invoice with ID: %s from database.", invoice_id)
+        return True
+    except sqlite3.Error as e:
+        logger.error("Error deleting invoice with ID %s: %s", invoice_id, e)
+        return False
+
+def get_drive_folders() -> dict[tuple[str, str], str]:
+    """Returns all cached Drive folder IDs as {(name, parent_id): folder_id}."""
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute("SELECT name, parent_id, folder_id FROM drive_folders")
+        return {(row['name'], row['parent_id']): row['folder_id'] for row in cursor}
+    except sqlite3.Error as e:
+        logger.error("Error loading cached Drive folders: %s", e)
+        return {}
+
+def add_drive_folder(name: str, parent_id: str, folder_id: str) -> bool:
+    """Stores (or replaces) the Drive folder ID for a (name, parent_id) pair."""
+    conn = get_db_connection()
+    try:
+        conn.execute(_SQL_ADD_DRIVE_FOLDER, (name, parent_id, folder_id))
         return True
     except sqlite3.Error as e:
-        print(f"Error deleting invoice with ID {invoice_id}: {e}")
+        logger.error("Error caching Drive folder '%s' (parent %s): %s", name, parent_id, e)
+        return False
+
+def clear_drive_folders() -> bool:
+    """Removes all cached Drive folder IDs (e.g. after a folder was deleted on Drive)."""
+    conn = get_db_connection()
+    try:
+        conn.execute("DELETE FROM drive_folders")
+        logger.info("Cleared cached Drive folder IDs.")
+        return True
+    except sqlite3.Error as e:
+        logger.error("Error clearing cached Drive folders: %s", e)
         return False
-    finally:
-        conn.close()
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     print("Running DB initialization...")
     init_db()
     print("DB initialization complete.")
@@ -252,10 +456,10 @@ if __name__ == '__main__':
     # if new_id:
     #     print(f"Added invoice with ID: {new_id}")
 
-    # print("\n--- Testing find_invoice (exact match) ---")
-    # found_invoice = find_invoice(test_invoice_data_1)
-    # if found_invoice:
-    #     print(f"Found invoice: {found_invoice['invoice_number']}, ID: {found_invoice['id']}")
+    # print("\n--- Testing find_exact_duplicate ---")
+    # found_invoice_id = find_exact_duplicate(test_invoice_data_1)
+    # if found_invoice_id:
+    #     print(f"Found invoice ID: {found_invoice_id}")
     # else:
     #     print("Invoice not found by exact match.")
 
@@ -271,27 +475,18 @@ if __name__ == '__main__':
     # print("\n--- Testing modified invoice data (different gross_amount) ---")
     # modified_invoice_data = test_invoice_data_1.copy()
     # modified_invoice_data['gross_amount'] = 1300.00
-    # found_modified = find_invoice(modified_invoice_data)
+    # found_modified = find_exact_duplicate(modified_invoice_data)
     # if found_modified:
-    #      print(f"Found modified invoice (should not match if amount differs): {found_modified['invoice_number']}")
+    #      print(f"Found modified invoice (should not match if amount differs): ID {found_modified}")
     # else:
     #     print("Modified invoice details did not find an exact match (as expected).")
 
 
-    # # Test adding another one to see if find_invoice gets the latest
-    # # test_invoice_data_1_v2 = test_invoice_data_1.copy()
-    # # test_invoice_data_1_v2['attachment_filename'] = "invoice_A_v2.pdf" # only one change
-    # # add_invoice(test_invoice_data_1_v2)
-    # # found_invoice_v2_check = find_invoice(test_invoice_data_1)
-    # # if found_invoice_v2_check:
-    # #      print(f"Found invoice (should be latest): {found_invoice_v2_check['invoice_number']}, attachment: {found_invoice_v2_check['attachment_filename']}, ID: {found_invoice_v2_check['id']}")
-
-
     # if new_id: # From first add_invoice
     #     print(f"\n--- Testing delete_invoice for ID: {new_id} ---")
     #     delete_success = delete_invoice(new_id)
     #     print(f"Deletion status for ID {new_id}: {delete_success}")
-    #     found_after_delete = find_invoice(test_invoice_data_1)
+    #     found_after_delete = find_exact_duplicate(test_invoice_data_1)
     #     if not found_after_delete:
     #         print(f"Invoice with ID {new_id} successfully deleted and not found.")
     #     else:
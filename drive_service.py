@@ -1,19 +1,109 @@
 import os
+import io
+import logging
+import mimetypes
+import threading
 from googleapiclient.discovery import Resource
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaFileUpload, MediaIoBaseUpload
 from googleapiclient.errors import HttpError
 import datetime
 
 import auth 
-from config import DRIVE_PARENT_FOLDER_NAME, DRIVE_INVOICE_FOLDER_NAME, MONTH_YEAR_FORMAT
+import database
+from config import DRIVE_PARENT_FOLDER_NAME, DRIVE_INVOICE_FOLDER_NAME
+
+logger = logging.getLogger(__name__)
 
 # MIME type for Google Drive folder
 FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
 
+# Files up to this size go in a single multipart request; larger ones use a resumable session.
+SIMPLE_UPLOAD_MAX_BYTES = 5 * 1024 * 1024
+# Chunk size for resumable uploads (must be a multiple of 256 KB). Pinned explicitly because
+# older googleapiclient releases default to 512 KB chunks; Gmail caps attachments at 25 MB,
+# so any invoice we receive goes up in a single chunk.
+RESUMABLE_CHUNK_SIZE = 25 * 1024 * 1024
+
+# Held while resolving a folder path so concurrent uploads into a new month/payer folder
+# don't each create their own copy of it. Cached lookups make this a short critical section.
+_folder_lock = threading.Lock()
+
+# Folder IDs keyed by (folder_name, parent_id). Loaded from the drive_folders table on first
+# use and written through on every lookup/creation, so restarts don't re-query Drive.
+_folder_id_cache: dict[tuple[str, str], str] | None = None
+# Folder IDs known to exist and not be in the trash, as of this process: found with a
+# trashed=false query, created, or checked. Cached IDs loaded from the database are checked
+# once before first use, since the folder may have been trashed while we weren't running.
+_live_folder_ids: set[str] = set()
+_root_folder_id: str | None = None
+
+def _escape_query_value(value: str) -> str:
+    """Escapes a value for use inside a single-quoted string in a Drive files().list query."""
+    # Backslash first, otherwise the backslashes added for quotes would be doubled
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+def _get_folder_cache() -> dict[tuple[str, str], str]:
+    """Returns the in-memory folder ID cache, loading it from the database on first use."""
+    global _folder_id_cache
+    if _folder_id_cache is None:
+        _folder_id_cache = database.get_drive_folders()
+        logger.info("Loaded %s cached Drive folder ID(s) from database.", len(_folder_id_cache))
+    return _folder_id_cache
+
+def _remember_folder(folder_name: str, parent_id: str, folder_id: str):
+    """Stores a folder ID in the in-memory cache and the database."""
+    _get_folder_cache()[(folder_name, parent_id)] = folder_id
+    _live_folder_ids.add(folder_id)
+    database.add_drive_folder(folder_name, parent_id, folder_id)
+
+def clear_folder_cache():
+    """Forgets all cached folder IDs, e.g. when a cached folder no longer exists on Drive."""
+    global _folder_id_cache
+    _folder_id_cache = {}
+    _live_folder_ids.clear()
+    database.clear_drive_folders()
+
+def _is_live_folder(service: Resource, folder_id: str) -> bool:
+    """Checks (once per process) that a cached folder still exists and is not in the trash."""
+    if folder_id in _live_folder_ids:
+        return True
+    try:
+        trashed = service.files().get(fileId=folder_id, fields='trashed').execute().get('trashed')
+    except HttpError as error:
+        if error.resp.status == 404:
+            return False
+        # Can't tell; use the cached ID and let the upload's own 404 handling catch a stale one
+        logger.warning("Could not check cached Drive folder %s: %s", folder_id, error)
+        return True
+    if trashed:
+        return False
+    _live_folder_ids.add(folder_id)
+    return True
+
 def get_drive_service() -> Resource | None:
     """Gets the authenticated Google Drive service resource."""
     return auth.get_service('drive', 'v3')
 
+def _create_folder(service: Resource, folder_name: str, parent_id: str) -> str | None:
+    """Creates a folder inside parent_id and caches its ID. HttpErrors propagate to the caller."""
+    file_metadata = {
+        'name': folder_name,
+        'mimeType': FOLDER_MIME_TYPE,
+        'parents': [parent_id]
+    }
+    created_folder = service.files().create(body=file_metadata, fields='id').execute()
+    folder_id = created_folder.get('id')
+    logger.info("Folder '%s' created with ID: %s inside parent %s", folder_name, folder_id, parent_id)
+    _remember_folder(folder_name, parent_id, folder_id)
+    return folder_id
+
+def _get_root_folder_id(service: Resource) -> str:
+    """Returns the real ID of the 'root' alias (files().list reports parents by ID, not alias)."""
+    global _root_folder_id
+    if _root_folder_id is None:
+        _root_folder_id = service.files().get(fileId='root', fields='id').execute().get('id')
+    return _root_folder_id
+
 def get_or_create_folder(service: Resource, folder_name: str, parent_id: str = 'root') -> str | None:
     """Checks if a folder exists within a parent folder, creates it if not, and returns its ID.
 
@@ -25,129 +115,228 @@ def get_or_create_folder(service: Resource, folder_name: str, parent_id: str = '
     Returns:
         The ID of the found or created folder, or None if an error occurs.
     """
+    cached_id = _get_folder_cache().get((folder_name, parent_id))
+    if cached_id:
+        return cached_id
+
     try:
         # Search for the folder first
-        query = f"name='{folder_name}' and mimeType='{FOLDER_MIME_TYPE}' and '{parent_id}' in parents and trashed=false"
+        query = (f"name='{_escape_query_value(folder_name)}' and mimeType='{FOLDER_MIME_TYPE}' "
+                 f"and '{_escape_query_value(parent_id)}' in parents and trashed=false")
         response = service.files().list(q=query, spaces='drive', fields='files(id, name)').execute()
         folders = response.get('files', [])
 
         if folders:
             folder_id = folders[0].get('id')
-            print(f"Folder '{folder_name}' found with ID: {folder_id} inside parent {parent_id}")
+            logger.info("Folder '%s' found with ID: %s inside parent %s", folder_name, folder_id, parent_id)
+            _remember_folder(folder_name, parent_id, folder_id)
             return folder_id
         else:
             # Folder not found, create it
-            print(f"Folder '{folder_name}' not found inside parent {parent_id}. Creating...")
-            file_metadata = {
-                'name': folder_name,
-                'mimeType': FOLDER_MIME_TYPE,
-                'parents': [parent_id]
-            }
-            created_folder = service.files().create(body=file_metadata, fields='id').execute()
-            folder_id = created_folder.get('id')
-            print(f"Folder '{folder_name}' created with ID: {folder_id} inside parent {parent_id}")
-            return folder_id
+            logger.info("Folder '%s' not found inside parent %s. Creating...", folder_name, parent_id)
+            return _create_folder(service, folder_name, parent_id)
 
     except HttpError as error:
-        print(f"An HTTP error occurred while finding/creating folder '{folder_name}': {error}")
+        logger.error("An HTTP error occurred while finding/creating folder '%s': %s", folder_name, error)
         return None
     except Exception as e:
-        print(f"An error occurred while finding/creating folder '{folder_name}': {e}")
+        logger.error("An error occurred while finding/creating folder '%s': %s", folder_name, e)
         return None
 
-def upload_invoice_to_drive(service: Resource, local_file_path: str, invoice_data: dict) -> dict | None:
-    """Uploads an invoice to Google Drive based on invoice data.
+def resolve_folder_path(service: Resource, path_components: list[str], root: str = 'root') -> list[str] | None:
+    """Finds or creates a nested folder path, e.g. ['A', 'B', 'C'] -> root/A/B/C.
 
-    Path: DRIVE_PARENT_FOLDER_NAME / MonthYear (from invoice_date) / Payer / DRIVE_INVOICE_FOLDER_NAME / original_filename
+    Segments already in the folder cache cost nothing. The remaining segments are looked up
+    with a single files().list query (name='X' or name='Y' ...), and only the segments that
+    still don't exist are created.
 
     Args:
         service: Authorized Google Drive API service instance.
-        local_file_path: The local path to the invoice file.
-        invoice_data: A dictionary containing extracted invoice data from Gemini,
-                      expected to have 'invoice_date' (YYYY-MM-DD) and 'payer'.
+        path_components: Folder names from the outermost to the innermost.
+        root: The ID of the folder the path starts in. Defaults to 'root'.
 
     Returns:
-        A dictionary with 'id' and 'link' of the uploaded file on Google Drive, or None if an error occurs.
+        The folder IDs for each path component (the last one is the target folder),
+        or None if an error occurs.
     """
-    if not os.path.exists(local_file_path):
-        print(f"Error: Local file not found for upload: {local_file_path}")
-        return None
+    with _folder_lock:
+        return _resolve_folder_path_locked(service, path_components, root)
+
+def _resolve_folder_path_locked(service: Resource, path_components: list[str], root: str) -> list[str] | None:
+    """resolve_folder_path() body; caller holds _folder_lock."""
+    cache = _get_folder_cache()
+    folder_ids = []
+    parent_id = root
+    # Walk the cached prefix of the path
+    for folder_name in path_components:
+        cached_id = cache.get((folder_name, parent_id))
+        if not cached_id:
+            break
+        if not _is_live_folder(service, cached_id):
+            logger.warning("Cached Drive folder '%s' (%s) was deleted or trashed. Clearing cached Drive folder IDs.",
+                           folder_name, cached_id)
+            clear_folder_cache()
+            cache = _get_folder_cache()
+            folder_ids = []
+            parent_id = root
+            break
+        folder_ids.append(cached_id)
+        parent_id = cached_id
+
+    remaining = path_components[len(folder_ids):]
+    if not remaining:
+        return folder_ids
 
     try:
-        # 1. Get/Create the main parent folder (e.g., "Документи для бухгалтера")
-        parent_folder_id = get_or_create_folder(service, DRIVE_PARENT_FOLDER_NAME, 'root')
-        if not parent_folder_id:
-            print(f"Failed to get or create base folder: {DRIVE_PARENT_FOLDER_NAME}")
-            return None
+        # One query for all missing segment names; parents tell us where each match lives.
+        names_clause = ' or '.join(f"name='{_escape_query_value(name)}'" for name in dict.fromkeys(remaining))
+        query = f"mimeType='{FOLDER_MIME_TYPE}' and trashed=false and ({names_clause})"
+        found = {}
+        page_token = None
+        while True:
+            response = service.files().list(
+                q=query, spaces='drive', fields='nextPageToken, files(id, name, parents)',
+                pageSize=1000, pageToken=page_token
+            ).execute()
+            for folder in response.get('files', []):
+                for folder_parent in folder.get('parents', []):
+                    found.setdefault((folder['name'], folder_parent), folder['id'])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
 
-        # Parse invoice_date to get year and month
-        try:
-            invoice_date_obj = datetime.datetime.strptime(invoice_data['invoice_date'], '%Y-%m-%d')
-            year_folder_name = invoice_date_obj.strftime('%Y')
-            # Use only month number for the month folder, as year is now a separate parent folder
-            month_folder_name = invoice_date_obj.strftime('%m') # Changed from MONTH_YEAR_FORMAT
-        except (KeyError, ValueError) as e:
-            print(f"Error parsing invoice_date from invoice_data: {e}. Using generic year/month folders.")
-            year_folder_name = "Unknown_Year"
-            month_folder_name = "Unknown_Month"
-
-        # 2. Get/Create the Year folder
-        year_folder_id = get_or_create_folder(service, year_folder_name, parent_folder_id)
-        if not year_folder_id:
-            print(f"Failed to get or create year folder: {year_folder_name}")
-            return None
+        for folder_name in remaining:
+            lookup_parent = _get_root_folder_id(service) if parent_id == 'root' else parent_id
+            folder_id = found.get((folder_name, lookup_parent))
+            if folder_id:
+                logger.info("Folder '%s' found with ID: %s inside parent %s", folder_name, folder_id, parent_id)
+                _remember_folder(folder_name, parent_id, folder_id)
+            else:
+                logger.info("Folder '%s' not found inside parent %s. Creating...", folder_name, parent_id)
+                folder_id = _create_folder(service, folder_name, parent_id)
+                if not folder_id:
+                    return None
+            folder_ids.append(folder_id)
+            parent_id = folder_id
+        return folder_ids
 
-        # 3. Get/Create the Month folder (inside the Year folder)
-        # month_year_folder_name was here, now it's month_folder_name
-        month_folder_id = get_or_create_folder(service, month_folder_name, year_folder_id) # Changed parent to year_folder_id
-        if not month_folder_id:
-            print(f"Failed to get or create month folder: {month_folder_name}")
-            return None
+    except HttpError as error:
+        logger.error("An HTTP error occurred while resolving folder path %s: %s", path_components, error)
+        return None
+    except Exception as e:
+        logger.error("An error occurred while resolving folder path %s: %s", path_components, e)
+        return None
 
-        # 4. Get/Create the Payer folder (Юр лице) - parent is now month_folder_id
-        payer_folder_name = invoice_data.get('payer', 'Unknown_Payer')
-        if not payer_folder_name or not isinstance(payer_folder_name, str) or payer_folder_name.isspace():
-            payer_folder_name = "Unknown_Payer"
-        # Sanitize payer_folder_name to avoid issues with Drive folder names (e.g. slashes)
-        payer_folder_name = payer_folder_name.replace('/', '-').replace('\\', '-').strip()
-        if not payer_folder_name:
-             payer_folder_name = "Invalid_Payer_Name"
-
-        payer_folder_id = get_or_create_folder(service, payer_folder_name, month_folder_id) # Changed from month_year_folder_id
-        if not payer_folder_id:
-            print(f"Failed to get or create payer folder: {payer_folder_name}")
-            return None
+def _invoice_folder_path(invoice_data: dict) -> list[str]:
+    """Returns the Drive folder path components an invoice is filed under:
+    DRIVE_PARENT_FOLDER_NAME / Year / Month / Payer / DRIVE_INVOICE_FOLDER_NAME
+    """
+    # Parse invoice_date to get year and month
+    try:
+        # fromisoformat is a C fast path for YYYY-MM-DD; strptime re-parses its format string on every call
+        invoice_date_obj = datetime.date.fromisoformat(invoice_data['invoice_date'])
+        year_folder_name = f"{invoice_date_obj.year:04d}"
+        # Use only month number for the month folder, as year is now a separate parent folder
+        month_folder_name = f"{invoice_date_obj.month:02d}" # Changed from MONTH_YEAR_FORMAT
+    except (KeyError, TypeError, ValueError) as e:
+        logger.warning("Error parsing invoice_date from invoice_data: %s. Using generic year/month folders.", e)
+        year_folder_name = "Unknown_Year"
+        month_folder_name = "Unknown_Month"
 
-        # 5. Get/Create the final "Фактури" folder - parent is payer_folder_id (remains the same)
-        final_invoices_folder_id = get_or_create_folder(service, DRIVE_INVOICE_FOLDER_NAME, payer_folder_id)
-        if not final_invoices_folder_id:
-            print(f"Failed to get or create final invoices folder: {DRIVE_INVOICE_FOLDER_NAME}")
-            return None
+    # Payer folder (Юр лице)
+    payer_folder_name = invoice_data.get('payer', 'Unknown_Payer')
+    if not payer_folder_name or not isinstance(payer_folder_name, str) or payer_folder_name.isspace():
+        payer_folder_name = "Unknown_Payer"
+    # Sanitize payer_folder_name to avoid issues with Drive folder names (e.g. slashes)
+    payer_folder_name = payer_folder_name.replace('/', '-').replace('\\', '-').strip()
+    if not payer_folder_name:
+         payer_folder_name = "Invalid_Payer_Name"
 
-        # 6. Upload the file
+    return [DRIVE_PARENT_FOLDER_NAME, year_folder_name, month_folder_name, payer_folder_name, DRIVE_INVOICE_FOLDER_NAME]
+
+def _upload_file(service: Resource, local_file_path: str, folder_id: str,
+                 file_bytes: bytes | None = None) -> dict | None:
+    """Uploads one file into the given Drive folder, from disk or (if file_bytes is given) from memory.
+
+    Returns:
+        A dictionary with 'id' and 'link' of the uploaded file, or None if an error occurs.
+        A 404 (the folder no longer exists) is raised to the caller, which can re-resolve it.
+    """
+    try:
         file_name = os.path.basename(local_file_path)
         file_metadata = {
             'name': file_name,
-            'parents': [final_invoices_folder_id]
+            'parents': [folder_id]
         }
-        media = MediaFileUpload(local_file_path, resumable=True)
+        # Typical invoices are well under 5 MB: one multipart POST instead of session start + chunks
+        if file_bytes is not None:
+            mime_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+            media = MediaIoBaseUpload(io.BytesIO(file_bytes), mimetype=mime_type,
+                                      resumable=len(file_bytes) > SIMPLE_UPLOAD_MAX_BYTES,
+                                      chunksize=RESUMABLE_CHUNK_SIZE)
+        elif os.path.getsize(local_file_path) > SIMPLE_UPLOAD_MAX_BYTES:
+            media = MediaFileUpload(local_file_path, resumable=True, chunksize=RESUMABLE_CHUNK_SIZE)
+        else:
+            media = MediaFileUpload(local_file_path, resumable=False)
         
-        print(f"Uploading '{file_name}' to Drive folder ID: {final_invoices_folder_id}...")
+        logger.info("Uploading '%s' to Drive folder ID: %s...", file_name, folder_id)
         uploaded_file = service.files().create(body=file_metadata, media_body=media, fields='id, webViewLink').execute()
         file_id = uploaded_file.get('id')
         file_link = uploaded_file.get('webViewLink')
-        print(f"File '{file_name}' uploaded successfully to Drive. ID: {file_id}, Link: {file_link}")
+        logger.info("File '%s' uploaded successfully to Drive. ID: %s, Link: %s", file_name, file_id, file_link)
         return {'id': file_id, 'link': file_link}
 
     except HttpError as error:
-        print(f"An HTTP error occurred during file upload: {error}")
+        if error.resp.status == 404:
+            raise
+        logger.error("An HTTP error occurred during file upload: %s", error)
         return None
     except Exception as e:
-        print(f"An error occurred during file upload process: {e}")
+        logger.error("An error occurred during file upload process: %s", e)
         # import traceback
         # traceback.print_exc()
         return None
 
+def upload_invoice_to_drive(service: Resource, local_file_path: str, invoice_data: dict,
+                            file_bytes: bytes | None = None) -> dict | None:
+    """Uploads an invoice to Google Drive based on invoice data.
+
+    Path: DRIVE_PARENT_FOLDER_NAME / Year / Month / Payer / DRIVE_INVOICE_FOLDER_NAME / original_filename
+
+    Args:
+        service: Authorized Google Drive API service instance.
+        local_file_path: The local path to the invoice file. With file_bytes, only its base name
+                         is used (as the Drive file name).
+        invoice_data: A dictionary containing extracted invoice data from Gemini,
+                      expected to have 'invoice_date' (YYYY-MM-DD) and 'payer'.
+        file_bytes: The file's contents, if the caller already has them in memory.
+
+    Returns:
+        A dictionary with 'id' and 'link' of the uploaded file on Google Drive, or None if an error occurs.
+    """
+    if file_bytes is None and not os.path.exists(local_file_path):
+        logger.error("Error: Local file not found for upload: %s", local_file_path)
+        return None
+
+    # 1-5. Get/Create "Документи для бухгалтера" / Year / Month / Payer / "Фактури" in one pass
+    folder_path = _invoice_folder_path(invoice_data)
+    for _ in range(2):
+        folder_ids = resolve_folder_path(service, folder_path, 'root')
+        if not folder_ids:
+            logger.error("Failed to get or create Drive folder path: %s", ' / '.join(folder_path))
+            return None
+
+        # 6. Upload the file
+        try:
+            return _upload_file(service, local_file_path, folder_ids[-1], file_bytes)
+        except HttpError as error:
+            # A cached folder was deleted on Drive; forget the cache and resolve the path again, once.
+            logger.warning("Upload target not found (%s). Clearing cached Drive folder IDs.", error)
+            clear_folder_cache()
+    logger.error("Failed to upload '%s': Drive folder path %s not found even after resolving it again.",
+                 os.path.basename(local_file_path), ' / '.join(folder_path))
+    return None
+
 def delete_file_from_drive(service: Resource, file_id: str) -> bool:
     """Deletes a file from Google Drive.
 
@@ -159,24 +348,25 @@ def delete_file_from_drive(service: Resource, file_id: str) -> bool:
         True if deletion was successful, False otherwise.
     """
     try:
-        print(f"Attempting to delete file with ID: {file_id} from Google Drive...")
+        logger.info("Attempting to delete file with ID: %s from Google Drive...", file_id)
         service.files().delete(fileId=file_id).execute()
-        print(f"Successfully deleted file with ID: {file_id} from Google Drive.")
+        logger.info("Successfully deleted file with ID: %s from Google Drive.", file_id)
         return True
     except HttpError as error:
-        print(f"An HTTP error occurred while deleting file ID '{file_id}': {error}")
+        logger.error("An HTTP error occurred while deleting file ID '%s': %s", file_id, error)
         if error.resp.status == 404:
-            print(f"File with ID '{file_id}' not found. Assuming already deleted or invalid ID.")
+            logger.info("File with ID '%s' not found. Assuming already deleted or invalid ID.", file_id)
             return True # Or False, depending on desired behavior for 404
         return False
     except Exception as e:
-        print(f"An unexpected error occurred while deleting file ID '{file_id}': {e}")
+        logger.error("An unexpected error occurred while deleting file ID '%s': %s", file_id, e)
         return False
 
 if __name__ == '__main__':
     # This is for testing the drive_service.py module directly
     # Ensure auth.py can provide credentials (e.g., token.json exists or credentials.json for flow)
     # and GOOGLE_API_KEY is set in .env for gemini_analyzer if it's called indirectly.
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     print("Testing Drive Service functions...")
     drive = get_drive_service()
     if drive:
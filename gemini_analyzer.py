@@ -1,11 +1,21 @@
 import os
+import logging
 import pathlib
+import re
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from google.api_core import retry as google_retry
 import mimetypes
-import json
-import base64
+import orjson
 import payer_mapping
+import gemini_cache
 import datetime # Ensure datetime is imported for timedelta
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, InvalidOperation
+
+logger = logging.getLogger(__name__)
 
 # DEBUG print statements removed
 # print("--- Attributes of genai module ---") # DEBUG
@@ -15,192 +25,443 @@ import datetime # Ensure datetime is imported for timedelta
 # Load API key from environment or placeholder
 API_KEY = os.getenv("GOOGLE_API_KEY")
 if not API_KEY:
-    print("Warning: GOOGLE_API_KEY environment variable not set. Using placeholder.")
+    logger.warning("Warning: GOOGLE_API_KEY environment variable not set. Using placeholder.")
     API_KEY = "YOUR_GOOGLE_API_KEY_PLACEHOLDER" # Ensure this is a distinct placeholder
 
 # Налаштування API ключа
 genai.configure(api_key=API_KEY)
 
-MODEL_NAME = "gemini-2.5-pro-preview-05-06" # Or "gemini-2.0-flash" as per docs, let's stick to 1.5 for now unless issues arise
+# Field extraction is structured OCR, not reasoning: Flash handles it at a fraction of Pro's cost and latency.
+MODEL_NAME = "gemini-2.5-flash"
+# Used only when MODEL_NAME's response is not valid JSON or lacks required fields
+FALLBACK_MODEL_NAME = "gemini-2.5-pro"
+# Bump whenever INVOICE_PROMPT (or the request format) changes, so cached results from the old prompt are not reused
+PROMPT_VERSION = "v3"
+
+# Max Gemini requests in flight for analyze_invoices(). Gemini rate limits are tight, so keep this small.
+GEMINI_CONCURRENCY = max(1, int(os.getenv("GEMINI_CONCURRENCY", "5")))
+_analysis_executor = ThreadPoolExecutor(max_workers=GEMINI_CONCURRENCY, thread_name_prefix='gemini')
+
+# Files above this size are uploaded once through the Files API and referenced by handle, instead of
+# being sent inline with every request (inline requests are capped at 20 MB in total).
+FILES_API_THRESHOLD_BYTES = 5 * 1024 * 1024
+# Uploaded file handles keyed by gemini_cache key (content hash). Released by release_uploaded_files().
+_uploaded_files = {}
+_uploaded_files_lock = threading.Lock()
+
+def _get_uploaded_file(path: pathlib.Path, mime_type: str, file_bytes: bytes, cache_key: str):
+    """Returns a Files API handle for the file, uploading it only if this content isn't uploaded yet."""
+    with _uploaded_files_lock:
+        uploaded = _uploaded_files.get(cache_key)
+    if uploaded is None:
+        # Upload outside the lock so concurrent analyses of different files don't queue behind each other
+        logger.info("Uploading %s to the Gemini Files API...", path.name)
+        # Upload from memory: the bytes are already read, and the file might not be on disk at all
+        uploaded = genai.upload_file(path=io.BytesIO(file_bytes), mime_type=mime_type, display_name=path.name)
+        with _uploaded_files_lock:
+            _uploaded_files.setdefault(cache_key, uploaded)
+    return uploaded
+
+def release_uploaded_files():
+    """Deletes the files uploaded through the Files API (they would otherwise expire after 48h)."""
+    with _uploaded_files_lock:
+        uploaded_files = list(_uploaded_files.values())
+        _uploaded_files.clear()
+    for uploaded in uploaded_files:
+        try:
+            genai.delete_file(uploaded.name)
+        except Exception as e:
+            logger.error("Error deleting uploaded Gemini file %s: %s", uploaded.name, e)
+
+# Static extraction instructions, sent as the model's system instruction. Keeping them identical
+# across requests (the file name goes in the per-request content) lets Gemini reuse the cached prefix.
+INVOICE_PROMPT = """
+Analyze the provided invoice document. Extract the following information and return it as a JSON object:
+1.  **document_type**: Classify the document. Is it a standard VAT invoice ('standard_invoice'), a proforma invoice ('proforma'), an offer ('offer'), a receipt ('receipt'), or other ('other')?
+2.  **is_paid**: A boolean (true/false). Set to true if the document is a receipt, or if the invoice explicitly states it has been paid (e.g., contains "Zapłacono", "Zapłacone", "Paid", or similar language, or if the document structure is clearly that of a receipt like a fuel receipt). If it appears to be an unpaid invoice requiring payment, set to false.
+3.  **invoice_date**: The date the invoice was issued (format YYYY-MM-DD). If it's not an invoice, this might be a document date.
+4.  **due_date**: The payment due date (format YYYY-MM-DD). If explicitly stated as a date, extract it. If not stated or if payment term is in days, this can be null.
+5.  **payment_terms_days**: An integer. If the payment term is specified in a number of days (e.g., "14 days", "Termin płatności: 7 dni"), extract the number of days. If a specific due_date is present, or if terms are not in days (e.g. "cash"), this should be null.
+6.  **payer**: The name of the company or person who needs to pay this invoice (Nabywca). Might not be relevant for some paid receipts.
+7.  **payer_nip**: The NIP (tax identification number) of the payer. Look for fields like "NIP Nabywcy" or similar. Extract it as accurately as possible, including prefixes if present.
+8.  **issuer**: The name of the company or person who issued this invoice (Sprzedawca).
+9.  **gross_amount**: The total amount including VAT (as a number, use '.' as decimal separator).
+10. **vat_amount**: The total VAT amount (as a number, use '.' as decimal separator).
+11. **is_fuel_related**: Is this invoice related to fuel or auto expenses? (true/false).
+12. **invoice_number**: The unique invoice identifier. Might be absent on some receipts.
+
+Important:
+- Prioritize extracting **due_date** if it's a specific calendar date. If payment terms are given in days, extract that into **payment_terms_days** and **due_date** might be null initially.
+- If the document is NOT a 'standard_invoice' requiring payment (e.g., it's a proforma, offer, receipt, or an already paid invoice), ensure 'is_paid' is true. For such documents, fields like 'due_date', 'payer' might be less relevant or absent; return null or empty string for them if not applicable.
+- For standard, unpaid invoices, 'is_paid' should be false. 'due_date' or 'payment_terms_days' should generally be present.
+- Return the data strictly as a JSON object. Do not include any introductory text or explanations outside the JSON structure.
+- Ensure all specified fields (document_type, is_paid, invoice_date, due_date, payment_terms_days, payer, payer_nip, issuer, gross_amount, vat_amount, is_fuel_related, invoice_number) are present in the JSON, even if their values are null or empty strings when not applicable.
+"""
+
+# Built once at import and shared by all calls/threads; the prompt lives in system_instruction, so
+# nothing per-request is stored on the model object.
+_MODELS = {
+    model_name: genai.GenerativeModel(model_name, system_instruction=INVOICE_PROMPT)
+    for model_name in (MODEL_NAME, FALLBACK_MODEL_NAME)
+}
+
+REQUIRED_KEYS = frozenset({
+    'document_type', 'is_paid', 'invoice_date', 'due_date', 'payment_terms_days',
+    'payer', 'payer_nip', 'issuer', 'gross_amount', 'vat_amount',
+    'is_fuel_related', 'invoice_number'
+})
+
+# Response schema enforced by Gemini's structured output mode (OpenAPI subset understood by the SDK)
+_NULLABLE_STRING = {"type": "string", "nullable": True}
+_NULLABLE_NUMBER = {"type": "number", "nullable": True}
+INVOICE_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "document_type": {"type": "string", "format": "enum",
+                          "enum": ["standard_invoice", "proforma", "offer", "receipt", "other"]},
+        "is_paid": {"type": "boolean"},
+        "invoice_date": _NULLABLE_STRING,
+        "due_date": _NULLABLE_STRING,
+        "payment_terms_days": {"type": "integer", "nullable": True},
+        "payer": _NULLABLE_STRING,
+        "payer_nip": _NULLABLE_STRING,
+        "issuer": _NULLABLE_STRING,
+        "gross_amount": _NULLABLE_NUMBER,
+        "vat_amount": _NULLABLE_NUMBER,
+        "is_fuel_related": {"type": "boolean"},
+        "invoice_number": _NULLABLE_STRING,
+    },
+    "required": sorted(REQUIRED_KEYS),
+}
+_GENERATION_CONFIG = genai.types.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=INVOICE_RESPONSE_SCHEMA,
+)
+
+# Transient Gemini failures (429 quota bursts, 503, 500, deadline) are retried with jittered
+# exponential backoff: 2s, 4s, 8s, ... capped at 60s per wait and 5 minutes in total.
+_GEMINI_RETRY = google_retry.Retry(
+    predicate=google_retry.if_exception_type(
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.DeadlineExceeded,
+    ),
+    initial=2.0,
+    maximum=60.0,
+    multiplier=2.0,
+    timeout=300.0,
+)
+
+def _request_extraction(model_name: str, content: list) -> dict | None:
+    """Sends the invoice content to the given Gemini model and parses the JSON reply.
+    Returns:
+        The parsed JSON object, or None if the reply is not valid JSON.
+    """
+    model = _MODELS[model_name]
+    
+    logger.info("Sending request to Gemini model (%s)...", model_name)
+    
+    # Генеруємо відповідь з правильними параметрами
+    # Structured output: the reply is bare JSON matching INVOICE_RESPONSE_SCHEMA (no ```json fences)
+    response = model.generate_content(content, generation_config=_GENERATION_CONFIG,
+                                      request_options={"retry": _GEMINI_RETRY})
+    
+    logger.info("Received response from Gemini (%s).", model_name)
+    
+    try:
+        extracted_data = orjson.loads(response.text) # C parser; several times faster than json.loads
+    except orjson.JSONDecodeError as json_err:
+        logger.error("Error: Failed to decode JSON response from Gemini (%s): %s", model_name, json_err)
+        logger.warning("Gemini Raw Response: %s", response.text)
+        return None
+    if not isinstance(extracted_data, dict):
+        logger.error("Error: Gemini (%s) returned JSON that is not an object: %s", model_name, extracted_data)
+        return None
+    return extracted_data
+
+# MIME types for the attachment kinds invoices arrive as; anything else goes through mimetypes
+_EXT_MIME = {
+    ".pdf": "application/pdf",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".webp": "image/webp",
+    ".heic": "image/heic",
+    ".heif": "image/heif",
+}
+
+def _guess_mime_type(path: pathlib.Path) -> str | None:
+    """Returns the MIME type to send to Gemini for the file, or None if it is unknown."""
+    mime_type = _EXT_MIME.get(path.suffix.lower()) or mimetypes.guess_type(path.name)[0]
+    if not mime_type:
+        logger.error("Error: Could not determine MIME type for %s", path)
+    return mime_type
 
-def analyze_invoice(file_path: str) -> dict | None:
+# Prefilter limits: images this small are signature logos/tracking pixels, not scanned invoices,
+# and Gemini does not accept documents above 50 MB at all.
+_MIN_IMAGE_BYTES = 5 * 1024
+_MAX_DOCUMENT_BYTES = 50 * 1024 * 1024
+
+def _has_expected_signature(mime_type: str, file_bytes: bytes) -> bool:
+    """Checks the file's magic bytes against its MIME type."""
+    if mime_type == "application/pdf":
+        return b"%PDF-" in file_bytes[:1024] # The header may follow a few junk bytes
+    if mime_type == "image/png":
+        return file_bytes.startswith(b"\x89PNG\r\n\x1a\n")
+    if mime_type == "image/jpeg":
+        return file_bytes.startswith(b"\xff\xd8\xff")
+    if mime_type == "image/webp":
+        return file_bytes[:4] == b"RIFF" and file_bytes[8:12] == b"WEBP"
+    if mime_type in ("image/heic", "image/heif"):
+        return file_bytes[4:8] == b"ftyp"
+    return False
+
+def _looks_like_invoice(path: pathlib.Path, mime_type: str, file_bytes: bytes) -> bool:
+    """Cheap checks that reject attachments Gemini would bill for and then discard."""
+    if mime_type not in _EXT_MIME.values():
+        logger.info("Skipping %s: file type %s is not an invoice format.", path.name, mime_type)
+        return False
+    if len(file_bytes) > _MAX_DOCUMENT_BYTES:
+        logger.warning("Warning: Skipping %s: %s bytes exceeds Gemini's document size limit.", path.name, len(file_bytes))
+        return False
+    if mime_type.startswith("image/") and len(file_bytes) < _MIN_IMAGE_BYTES:
+        logger.info("Skipping %s: image is only %s bytes (likely a logo or signature image).", path.name, len(file_bytes))
+        return False
+    if not _has_expected_signature(mime_type, file_bytes):
+        logger.warning("Warning: Skipping %s: content does not match its %s file type.", path.name, mime_type)
+        return False
+    return True
+
+def _gemini_call(path: pathlib.Path, mime_type: str, file_bytes: bytes) -> dict | None:
+    """Returns Gemini's raw extraction for the file (from the result cache when possible),
+    or None if neither model produced usable JSON. API errors propagate to the caller.
+    """
+    cache_key = gemini_cache.make_key(MODEL_NAME, PROMPT_VERSION, file_bytes)
+    extracted_data = gemini_cache.get(cache_key)
+    if extracted_data is not None:
+        logger.info("Using cached Gemini result for %s (key %s). Skipping Gemini request.", path.name, cache_key[:12])
+        return extracted_data
+
+    # Створюємо вміст з файлом та промптом у правильному форматі
+    if len(file_bytes) > FILES_API_THRESHOLD_BYTES:
+        file_part = _get_uploaded_file(path, mime_type, file_bytes, cache_key)
+    else:
+        # Raw bytes go straight into the Blob part; the SDK serializes them itself, so no base64 copy here
+        file_part = {"mime_type": mime_type, "data": file_bytes}
+    content = [file_part, {"text": f"Invoice file name: {path.name}"}]
+
+    # Flash first; escalate to the Pro model only if Flash's answer isn't usable JSON
+    extracted_data = _request_extraction(MODEL_NAME, content)
+    if extracted_data is None or not REQUIRED_KEYS.issubset(extracted_data.keys()):
+        logger.warning("Response from %s for %s is unusable. Retrying with fallback model %s...", MODEL_NAME, path.name, FALLBACK_MODEL_NAME)
+        extracted_data = _request_extraction(FALLBACK_MODEL_NAME, content) or extracted_data
+    # Cache the raw provider output; _postprocess/_enrich_payer are re-run on a cache hit.
+    # Incomplete answers are not cached, so the next attempt asks Gemini again.
+    if extracted_data is not None and REQUIRED_KEYS.issubset(extracted_data.keys()):
+        gemini_cache.put(cache_key, extracted_data)
+    return extracted_data
+
+_MONEY_QUANTUM = Decimal('0.01')
+_MONEY_JUNK = str.maketrans('', '', " \u00a0\u202f'") # Spaces / NBSPs / apostrophes used as thousands separators
+# Whole amounts grouped with one kind of separator, e.g. "1,234" or "1.234.567"
+_THOUSANDS_ONLY_RE = re.compile(r'[+-]?[1-9]\d{0,2}([.,])\d{3}(?:\1\d{3})*')
+
+def _parse_money(value) -> Decimal | None:
+    """Parses an amount such as 1234.56, "1234,56", "1.234,56" or "1,234.56" to a Decimal (2 places).
+    The right-most '.' or ',' is taken as the decimal separator, except in amounts made of
+    3-digit groups with a single kind of separator ("1,234" and "1.234.567" are whole amounts).
+    Returns None if value isn't an amount."""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        text = repr(value)
+    else:
+        text = str(value).translate(_MONEY_JUNK)
+        decimal_sep = max(text.rfind('.'), text.rfind(','))
+        if _THOUSANDS_ONLY_RE.fullmatch(text):
+            text = text.replace('.', '').replace(',', '')
+        elif decimal_sep != -1:
+            text = text[:decimal_sep].replace('.', '').replace(',', '') + '.' + text[decimal_sep + 1:]
+    try:
+        money = Decimal(text)
+    except InvalidOperation:
+        return None
+    return money.quantize(_MONEY_QUANTUM) if money.is_finite() else None
+
+def _postprocess(extracted_data: dict, file_name: str) -> dict | None:
+    """Normalizes Gemini's raw extraction in place (NIP, is_fuel_related, due_date).
+    Returns:
+        The data, or None if it is incomplete or not a standard invoice/receipt.
+    """
+    logger.debug("Initial extracted data from Gemini: %s", extracted_data) # Log before cleaning NIP
+    
+    # Clean payer_nip - remove non-digit characters
+    payer_nip_raw = extracted_data.get('payer_nip')
+    if isinstance(payer_nip_raw, str):
+        cleaned_nip = payer_mapping.clean_nip(payer_nip_raw)
+        if payer_nip_raw != cleaned_nip:
+            logger.info("Cleaned payer_nip: '%s' -> '%s'", payer_nip_raw, cleaned_nip)
+        extracted_data['payer_nip'] = cleaned_nip
+    elif payer_nip_raw is not None: # If it's not a string but not None (e.g. a number already)
+        extracted_data['payer_nip'] = str(payer_nip_raw) # Ensure it's a string for consistency, then it will be digits only
+
+    # Normalize is_fuel_related to a real bool once here (Gemini may return "false"/"true" strings);
+    # the database, Sheets and Trello code use the value as-is.
+    if 'is_fuel_related' in extracted_data:
+        is_fuel_raw = extracted_data['is_fuel_related']
+        if isinstance(is_fuel_raw, str):
+            extracted_data['is_fuel_related'] = is_fuel_raw.strip().lower() in ('true', '1', 'yes', 'так', 'tak')
+        else:
+            extracted_data['is_fuel_related'] = bool(is_fuel_raw)
+
+    # Parse amounts once here (Gemini occasionally returns "1.234,56"-style strings) so that
+    # storage and the duplicate check see canonical 2-decimal numbers. Stored as float: the
+    # invoices columns are REAL and the Sheets API takes JSON numbers, neither accepts a Decimal.
+    for amount_key in ('gross_amount', 'vat_amount'):
+        amount_raw = extracted_data.get(amount_key)
+        if amount_raw is None:
+            continue
+        money = _parse_money(amount_raw)
+        if money is None:
+            logger.warning("Could not parse %s '%s' in %s as an amount.", amount_key, amount_raw, file_name)
+        else:
+            extracted_data[amount_key] = float(money)
+
+    logger.debug("Successfully parsed and NIP-cleaned data: %s", extracted_data)
+    
+    if not REQUIRED_KEYS.issubset(extracted_data.keys()):
+         missing_keys = REQUIRED_KEYS - set(extracted_data.keys())
+         logger.error("Error: Extracted JSON is missing required keys. Required: %s. Got: %s. Missing: %s", set(REQUIRED_KEYS), extracted_data.keys(), missing_keys)
+         return None 
+
+    # Check if Gemini classified the document as a standard invoice OR a receipt (as receipts also need processing for DB/Sheets)
+    document_type = extracted_data.get("document_type")
+    # Allow 'standard_invoice' and 'receipt' to proceed further for data storage.
+    # Other types like 'proforma', 'offer', 'other' will be skipped.
+    if document_type not in ["standard_invoice", "receipt"]:
+        logger.info("Document %s is not a standard invoice or receipt (type: %s). Skipping analysis.", file_name, document_type)
+        return None 
+
+    # Calculate due_date if payment_terms_days is provided
+    due_date_str = extracted_data.get('due_date')
+    payment_terms_days_val = extracted_data.get('payment_terms_days')
+    invoice_date_str = extracted_data.get('invoice_date')
+
+    # Try to parse due_date_str to see if it's already a valid date
+    valid_due_date_present = False
+    if due_date_str:
+        try:
+            datetime.datetime.strptime(due_date_str, '%Y-%m-%d')
+            valid_due_date_present = True
+        except (TypeError, ValueError):
+            # due_date_str is present but not a valid date, might need calculation or is invalid
+            logger.warning("Warning: due_date '%s' is present but not in YYYY-MM-DD format. Will attempt calculation if payment_terms_days is available.", due_date_str)
+            # We will proceed to check payment_terms_days
+
+    if not valid_due_date_present and payment_terms_days_val is not None and invoice_date_str:
+        try:
+            invoice_date_obj = datetime.datetime.strptime(invoice_date_str, '%Y-%m-%d')
+            # Ensure payment_terms_days_val is an integer
+            days_to_add = int(payment_terms_days_val)
+            calculated_due_date = invoice_date_obj + datetime.timedelta(days=days_to_add)
+            extracted_data['due_date'] = calculated_due_date.strftime('%Y-%m-%d')
+            logger.info("Calculated due_date: %s from invoice_date: %s and payment_terms_days: %s", extracted_data['due_date'], invoice_date_str, days_to_add)
+        except (ValueError, OverflowError) as e:
+            logger.error("Error converting payment_terms_days ('%s') to int or parsing invoice_date ('%s'): %s. Due date may remain as is or null.", payment_terms_days_val, invoice_date_str, e)
+        except TypeError as e: # Handles if payment_terms_days_val is not suitable for int()
+             logger.error("Error with payment_terms_days type ('%s'): %s. Due date may remain as is or null.", payment_terms_days_val, e)
+    return extracted_data
+
+def _enrich_payer(extracted_data: dict, file_name: str) -> dict:
+    """Fills in the payer name (by NIP) or the payer NIP (by name) from payer_mapping, in place."""
+    identified_payer = None
+    payer_nip = extracted_data.get("payer_nip")
+    if payer_nip:
+        identified_payer = payer_mapping.identify_payer_by_nip(payer_nip)
+        if identified_payer:
+            logger.info("Payer identified by NIP ('%s'): '%s'", payer_nip, identified_payer)
+            extracted_data['payer'] = identified_payer
+        else:
+            # NIP was extracted by Gemini, but not found in our mapping.
+            # Keep the original payer name from the invoice.
+            logger.warning("Warning: Payer NIP '%s' (cleaned) extracted from invoice, but not found in payer_mapping. Using payer name from invoice: '%s'.", payer_nip, extracted_data.get('payer'))
+    else:
+        # Спробуємо знайти NIP за назвою платника
+        payer_name = extracted_data.get('payer')
+        if payer_name:
+            logger.info("No NIP found by Gemini and no payer name to look up NIP in %s. Attempting to find NIP based on payer name: '%s'", file_name, payer_name)
+            nip_from_mapping = payer_mapping.get_payer_nip(payer_name)
+            if nip_from_mapping:
+                logger.info("NIP ('%s') found for payer '%s' via mapping. Adding to extracted data.", nip_from_mapping, payer_name)
+                extracted_data['payer_nip'] = nip_from_mapping # Add the NIP found via name mapping
+            else:
+                logger.info("No NIP found for payer '%s' via mapping.", payer_name)
+        else:
+            logger.info("No NIP found by Gemini and no payer name to look up NIP in %s.", file_name)
+    return extracted_data
+
+def analyze_invoice(file_path: str, file_bytes: bytes | None = None) -> dict | None:
     """Analyzes an invoice file (PDF, image) using Gemini API.
     Args:
-        file_path: Path to the invoice file.
+        file_path: Path to the invoice file. When file_bytes is given, only its name is used
+                   (for the MIME type and logging) and the file need not exist on disk.
+        file_bytes: The file's contents, if the caller already has them in memory.
     Returns:
         A dictionary containing extracted invoice data, or None if analysis fails.
     """
     if API_KEY == "YOUR_GOOGLE_API_KEY_PLACEHOLDER" or not API_KEY:
-        print("Error: Gemini API key is not configured with a real value. Skipping analysis.")
+        logger.error("Error: Gemini API key is not configured with a real value. Skipping analysis.")
         return None
         
-    print(f"Analyzing invoice: {file_path} using model {MODEL_NAME}")
+    logger.info("Analyzing invoice: %s using model %s", file_path, MODEL_NAME)
     path = pathlib.Path(file_path)
-    if not path.exists():
-        print(f"Error: File not found at {file_path}")
+    mime_type = _guess_mime_type(path)
+    if not mime_type:
         return None
 
-    mime_type, _ = mimetypes.guess_type(path)
-    if not mime_type:
-        if file_path.lower().endswith('.pdf'):
-            mime_type = 'application/pdf'
-        elif file_path.lower().endswith(('.png', '.jpg', '.jpeg', '.webp', '.heic', '.heif')):
-            mime_type = f'image/{path.suffix[1:].lower()}'
-        else:
-             print(f"Error: Could not determine MIME type for {file_path}")
-             return None
-        print(f"Guessed MIME type as: {mime_type}")
-
-    prompt = f""" 
-    Analyze the provided invoice document ({path.name}). Extract the following information and return it as a JSON object:
-    1.  **document_type**: Classify the document. Is it a standard VAT invoice ('standard_invoice'), a proforma invoice ('proforma'), an offer ('offer'), a receipt ('receipt'), or other ('other')?
-    2.  **is_paid**: A boolean (true/false). Set to true if the document is a receipt, or if the invoice explicitly states it has been paid (e.g., contains "Zapłacono", "Zapłacone", "Paid", or similar language, or if the document structure is clearly that of a receipt like a fuel receipt). If it appears to be an unpaid invoice requiring payment, set to false.
-    3.  **invoice_date**: The date the invoice was issued (format YYYY-MM-DD). If it's not an invoice, this might be a document date.
-    4.  **due_date**: The payment due date (format YYYY-MM-DD). If explicitly stated as a date, extract it. If not stated or if payment term is in days, this can be null.
-    5.  **payment_terms_days**: An integer. If the payment term is specified in a number of days (e.g., "14 days", "Termin płatności: 7 dni"), extract the number of days. If a specific due_date is present, or if terms are not in days (e.g. "cash"), this should be null.
-    6.  **payer**: The name of the company or person who needs to pay this invoice (Nabywca). Might not be relevant for some paid receipts.
-    7.  **payer_nip**: The NIP (tax identification number) of the payer. Look for fields like "NIP Nabywcy" or similar. Extract it as accurately as possible, including prefixes if present.
-    8.  **issuer**: The name of the company or person who issued this invoice (Sprzedawca).
-    9.  **gross_amount**: The total amount including VAT (as a number, use '.' as decimal separator).
-    10. **vat_amount**: The total VAT amount (as a number, use '.' as decimal separator).
-    11. **is_fuel_related**: Is this invoice related to fuel or auto expenses? (true/false).
-    12. **invoice_number**: The unique invoice identifier. Might be absent on some receipts.
-
-    Important:
-    - Prioritize extracting **due_date** if it's a specific calendar date. If payment terms are given in days, extract that into **payment_terms_days** and **due_date** might be null initially.
-    - If the document is NOT a 'standard_invoice' requiring payment (e.g., it's a proforma, offer, receipt, or an already paid invoice), ensure 'is_paid' is true. For such documents, fields like 'due_date', 'payer' might be less relevant or absent; return null or empty string for them if not applicable.
-    - For standard, unpaid invoices, 'is_paid' should be false. 'due_date' or 'payment_terms_days' should generally be present.
-    - Return the data strictly as a JSON object. Do not include any introductory text or explanations outside the JSON structure.
-    - Ensure all specified fields (document_type, is_paid, invoice_date, due_date, payment_terms_days, payer, payer_nip, issuer, gross_amount, vat_amount, is_fuel_related, invoice_number) are present in the JSON, even if their values are null or empty strings when not applicable.
-    """
+    if file_bytes is None:
+        try:
+            file_bytes = path.read_bytes()
+        except OSError as e:
+            logger.error("Error: Could not read file %s: %s", file_path, e)
+            return None
+
+    if not _looks_like_invoice(path, mime_type, file_bytes):
+        return None
 
     try:
-        file_bytes = path.read_bytes()
-        
-        # Створюємо модель за допомогою genai.GenerativeModel
-        model = genai.GenerativeModel(MODEL_NAME)
-        
-        print(f"Sending request to Gemini model ({MODEL_NAME})...")
-        
-        # Створюємо вміст з файлом та промптом у правильному форматі
-        content = [
-            {"mime_type": mime_type, "data": base64.b64encode(file_bytes).decode()},
-            {"text": prompt}
-        ]
-        
-        # Генеруємо відповідь з правильними параметрами
-        response = model.generate_content(content)
-        
-        print("Received response from Gemini.")
-        
-        cleaned_response = response.text.strip()
-        if cleaned_response.startswith("```json"):
-            cleaned_response = cleaned_response[7:]
-        if cleaned_response.endswith("```"):
-            cleaned_response = cleaned_response[:-3]
-        cleaned_response = cleaned_response.strip()
-        
-        extracted_data = json.loads(cleaned_response)
-        print(f"Initial extracted data from Gemini: {extracted_data}") # Log before cleaning NIP
-        
-        # Clean payer_nip - remove non-digit characters
-        payer_nip_raw = extracted_data.get('payer_nip')
-        if isinstance(payer_nip_raw, str):
-            cleaned_nip = ''.join(filter(str.isdigit, payer_nip_raw))
-            if payer_nip_raw != cleaned_nip:
-                print(f"Cleaned payer_nip: '{payer_nip_raw}' -> '{cleaned_nip}'")
-            extracted_data['payer_nip'] = cleaned_nip
-        elif payer_nip_raw is not None: # If it's not a string but not None (e.g. a number already)
-            extracted_data['payer_nip'] = str(payer_nip_raw) # Ensure it's a string for consistency, then it will be digits only
-
-        print(f"Successfully parsed and NIP-cleaned data: {extracted_data}")
-        
-        required_keys = {
-            'document_type', 'is_paid', 'invoice_date', 'due_date', 'payment_terms_days',
-            'payer', 'payer_nip', 'issuer', 'gross_amount', 'vat_amount',
-            'is_fuel_related', 'invoice_number'
-        }
-        if not required_keys.issubset(extracted_data.keys()):
-             missing_keys = required_keys - set(extracted_data.keys())
-             print(f"Error: Extracted JSON is missing required keys. Required: {required_keys}. Got: {extracted_data.keys()}. Missing: {missing_keys}")
-             return None 
-
-        # Check if Gemini classified the document as a standard invoice OR a receipt (as receipts also need processing for DB/Sheets)
-        document_type = extracted_data.get("document_type")
-        # Allow 'standard_invoice' and 'receipt' to proceed further for data storage.
-        # Other types like 'proforma', 'offer', 'other' will be skipped.
-        if document_type not in ["standard_invoice", "receipt"]:
-            print(f"Document {path.name} is not a standard invoice or receipt (type: {document_type}). Skipping analysis.")
-            return None 
-
-        # Calculate due_date if payment_terms_days is provided
-        due_date_str = extracted_data.get('due_date')
-        payment_terms_days_val = extracted_data.get('payment_terms_days')
-        invoice_date_str = extracted_data.get('invoice_date')
-
-        # Try to parse due_date_str to see if it's already a valid date
-        valid_due_date_present = False
-        if due_date_str:
-            try:
-                datetime.datetime.strptime(due_date_str, '%Y-%m-%d')
-                valid_due_date_present = True
-            except ValueError:
-                # due_date_str is present but not a valid date, might need calculation or is invalid
-                print(f"Warning: due_date '{due_date_str}' is present but not in YYYY-MM-DD format. Will attempt calculation if payment_terms_days is available.")
-                # We will proceed to check payment_terms_days
-
-        if not valid_due_date_present and payment_terms_days_val is not None and invoice_date_str:
-            try:
-                invoice_date_obj = datetime.datetime.strptime(invoice_date_str, '%Y-%m-%d')
-                # Ensure payment_terms_days_val is an integer
-                days_to_add = int(payment_terms_days_val)
-                calculated_due_date = invoice_date_obj + datetime.timedelta(days=days_to_add)
-                extracted_data['due_date'] = calculated_due_date.strftime('%Y-%m-%d')
-                print(f"Calculated due_date: {extracted_data['due_date']} from invoice_date: {invoice_date_str} and payment_terms_days: {days_to_add}")
-            except ValueError as e:
-                print(f"Error converting payment_terms_days ('{payment_terms_days_val}') to int or parsing invoice_date ('{invoice_date_str}'): {e}. Due date may remain as is or null.")
-            except TypeError as e: # Handles if payment_terms_days_val is not suitable for int()
-                 print(f"Error with payment_terms_days type ('{payment_terms_days_val}'): {e}. Due date may remain as is or null.")
-        
-        # If it is a standard invoice or receipt, proceed with payer identification and data enrichment
-        identified_payer = None
-        payer_nip = extracted_data.get("payer_nip")
-        if payer_nip:
-            identified_payer = payer_mapping.identify_payer_by_nip(payer_nip)
-            if identified_payer:
-                print(f"Payer identified by NIP ('{payer_nip}'): '{identified_payer}'")
-                extracted_data['payer'] = identified_payer
-            else:
-                # NIP was extracted by Gemini, but not found in our mapping.
-                # Keep the original payer name from the invoice.
-                print(f"Warning: Payer NIP '{payer_nip}' (cleaned) extracted from invoice, but not found in payer_mapping. Using payer name from invoice: '{extracted_data.get('payer')}'.")
-        else:
-            # Спробуємо знайти NIP за назвою платника
-            payer_name = extracted_data.get('payer')
-            if payer_name:
-                print(f"No NIP found by Gemini and no payer name to look up NIP in {path.name}. Attempting to find NIP based on payer name: '{payer_name}'")
-                nip_from_mapping = payer_mapping.get_payer_nip(payer_name)
-                if nip_from_mapping:
-                    print(f"NIP ('{nip_from_mapping}') found for payer '{payer_name}' via mapping. Adding to extracted data.")
-                    extracted_data['payer_nip'] = nip_from_mapping # Add the NIP found via name mapping
-                else:
-                    print(f"No NIP found for payer '{payer_name}' via mapping.")
-            else:
-                print(f"No NIP found by Gemini and no payer name to look up NIP in {path.name}.")
-        
-        return extracted_data
-    except json.JSONDecodeError as json_err:
-        print(f"Error: Failed to decode JSON response from Gemini: {json_err}")
-        print(f"Gemini Raw Response: {response.text if 'response' in locals() else 'Response not available'}")
+        extracted_data = _gemini_call(path, mime_type, file_bytes)
+    except google_exceptions.GoogleAPIError as api_err: # Quota (429), timeouts, 5xx, invalid request...
+        logger.error("Gemini API error during analysis of %s: %s", file_path, api_err)
         return None
-    except AttributeError as attr_err: # To catch issues like Client not having 'models'
-        print(f"AttributeError during Gemini analysis: {attr_err}")
+    except Exception as e: # Unexpected SDK/transport failures; the post-processing below is not covered
+        logger.exception("An error occurred during Gemini analysis for %s: %s", file_path, e)
         return None
-    except FileNotFoundError:
-        print(f"Error: File not found during read: {file_path}")
+    if extracted_data is None:
         return None
-    except Exception as e:
-        print(f"An error occurred during Gemini analysis for {file_path}: {e}")
-        # import traceback
-        # traceback.print_exc() # For more detailed error logging
+
+    extracted_data = _postprocess(extracted_data, path.name)
+    if extracted_data is None:
         return None
+    # If it is a standard invoice or receipt, proceed with payer identification and data enrichment
+    return _enrich_payer(extracted_data, path.name)
+
+def analyze_invoices(file_paths: list[str], file_contents: dict[str, bytes] | None = None) -> dict[str, dict | None]:
+    """Analyzes several invoice files concurrently (at most GEMINI_CONCURRENCY at a time).
+    Args:
+        file_paths: Paths (or, with file_contents, names) of the invoice files.
+        file_contents: Optional in-memory contents keyed by path, passed on as analyze_invoice's file_bytes.
+    Returns:
+        A dictionary mapping each file path to its analyze_invoice() result (None for failed
+        or skipped files). One failing file does not affect the others.
+    """
+    file_contents = file_contents or {}
+    unique_paths = list(dict.fromkeys(file_paths))
+
+    def analyze(file_path):
+        return analyze_invoice(file_path, file_contents.get(file_path))
+
+    if len(unique_paths) <= 1:
+        return {file_path: analyze(file_path) for file_path in unique_paths}
+    return dict(zip(unique_paths, _analysis_executor.map(analyze, unique_paths)))
@@ -0,0 +1,68 @@
+"""
+On-disk cache of Gemini invoice analysis results.
+
+Entries are keyed by (model, prompt version, file contents), so re-analysing the same
+attachment (retries, re-delivered emails) skips the Gemini call entirely. Only the raw
+provider output is stored; post-processing (NIP cleaning, due dates, payer mapping) is
+re-run on every hit.
+"""
+import os
+import json
+import hashlib
+import logging
+import tempfile
+from config import GEMINI_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+def is_enabled() -> bool:
+    """The cache is on unless GEMINI_NO_CACHE=1 is set."""
+    return os.getenv("GEMINI_NO_CACHE", "").strip() != "1"
+
+def make_key(model_name: str, prompt_version: str, file_bytes: bytes) -> str:
+    """Returns the cache key for a file analysed with the given model and prompt version."""
+    digest = hashlib.sha256()
+    for part in (model_name.encode('utf-8'), prompt_version.encode('utf-8'), file_bytes):
+        # Length-prefix each part so different splits can't produce the same byte stream
+        digest.update(len(part).to_bytes(8, 'big'))
+        digest.update(part)
+    return digest.hexdigest()
+
+def _entry_path(key: str) -> str:
+    return os.path.join(GEMINI_CACHE_DIR, f"{key}.json")
+
+def get(key: str) -> dict | None:
+    """Returns the cached result for key, or None on a miss (or if the cache is disabled)."""
+    if not is_enabled():
+        return None
+    try:
+        with open(_entry_path(key), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring unreadable Gemini cache entry %s: %s", key, e)
+        return None
+
+def put(key: str, data: dict) -> bool:
+    """Stores a result under key. Writes are atomic, so readers never see a partial entry."""
+    if not is_enabled():
+        return False
+    path = _entry_path(key)
+    tmp_path = None
+    try:
+        os.makedirs(GEMINI_CACHE_DIR, exist_ok=True)
+        # Unique per call, so concurrent writers (threads or processes) never share a temp file
+        fd, tmp_path = tempfile.mkstemp(dir=GEMINI_CACHE_DIR, prefix=f"{key}.", suffix='.tmp')
+        with open(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        return True
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning("Could not write Gemini cache entry %s: %s", key, e)
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return False
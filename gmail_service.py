@@ -1,15 +1,28 @@
 import base64
 import os
+import logging
 import shutil
 from googleapiclient.discovery import Resource
 from googleapiclient.errors import HttpError
 
 import auth
-from config import GMAIL_QUERY, PROCESS_EMAILS_AFTER_DATE
-from database import is_email_processed
+from config import GMAIL_QUERY, PROCESS_EMAILS_AFTER_DATE, GMAIL_PROCESSED_LABEL_NAME
+from database import filter_unprocessed
 
-# Directory to temporarily store downloaded attachments
+logger = logging.getLogger(__name__)
+
+# Directory to temporarily store downloaded attachments. Created once, at import, instead of
+# being checked/created for every message.
 DOWNLOAD_DIR = "temp_downloads"
+os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+
+# Max page size for messages.list (the default is 100)
+GMAIL_LIST_PAGE_SIZE = 500
+# messages.batchModify accepts at most 1000 IDs per call
+GMAIL_BATCH_MODIFY_SIZE = 1000
+
+# ID of GMAIL_PROCESSED_LABEL_NAME, looked up (or created) on first use
+_processed_label_id = None
 
 def get_gmail_service() -> Resource | None:
     """Gets the authenticated Gmail service resource."""
@@ -31,130 +44,254 @@ def find_new_emails(service: Resource) -> list[dict]:
         # Gmail API uses YYYY/MM/DD for date queries
         api_date_format = str(PROCESS_EMAILS_AFTER_DATE).strip().replace('-', '/')
         current_query += f" after:{api_date_format}"
-        print(f"Extended Gmail query with date filter: after:{api_date_format}")
+        logger.info("Extended Gmail query with date filter: after:%s", api_date_format)
+
+    if GMAIL_PROCESSED_LABEL_NAME:
+        # Gmail search writes spaces in label names as hyphens
+        current_query += f" -label:{GMAIL_PROCESSED_LABEL_NAME.replace(' ', '-')}"
 
     try:
         # Initial query to find messages matching the criteria
-        print(f"Searching for emails with query: '{current_query}'")
-        response = service.users().messages().list(userId='me', q=current_query).execute()
-        messages = response.get('messages', [])
+        logger.info("Searching for emails with query: '%s'", current_query)
+        message_count = 0
+        page_token = None
+        while True:
+            response = service.users().messages().list(
+                userId='me', q=current_query, maxResults=GMAIL_LIST_PAGE_SIZE, pageToken=page_token
+            ).execute()
+            messages = response.get('messages', [])
+            message_count += len(messages)
 
-        if not messages:
-            print("No emails found matching the query.")
+            # Check the page against the database in one bulk query
+            unprocessed_ids = filter_unprocessed([message['id'] for message in messages])
+            for message in messages:
+                email_id = message['id']
+                if email_id in unprocessed_ids:
+                    new_emails.append(message)
+                    logger.info("Found new email: ID %s", email_id)
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+            if not GMAIL_PROCESSED_LABEL_NAME and not unprocessed_ids:
+                # Without the label the query matches every processed email too. Results are
+                # newest first, so a page with nothing new means the rest was already handled.
+                logger.info("Stopping the search after a page of already processed emails.")
+                break
+
+        if not message_count:
+            logger.info("No emails found matching the query.")
             return []
 
-        print(f"Found {len(messages)} potential emails. Checking against database...")
-
-        # Check each message against the database
-        for message in messages:
-            email_id = message['id']
-            if not is_email_processed(email_id):
-                new_emails.append(message)
-                print(f"Found new email: ID {email_id}")
-            # else:
-                # print(f"Email ID {email_id} already processed. Skipping.")
-
-        # Handle pagination if necessary (if more results than fit in one page)
-        # TODO: Implement pagination if more than 100 messages are expected frequently
-        # while 'nextPageToken' in response:
-        #     page_token = response['nextPageToken']
-        #     response = service.users().messages().list(userId='me', q=GMAIL_QUERY, pageToken=page_token).execute()
-        #     messages = response.get('messages', [])
-        #     for message in messages:
-        #         email_id = message['id']
-        #         if not is_email_processed(email_id):
-        #             new_emails.append(message)
-
-        print(f"Found {len(new_emails)} new, unprocessed emails.")
+        logger.info("Checked %s potential emails against the database.", message_count)
+
+        logger.info("Found %s new, unprocessed emails.", len(new_emails))
         return new_emails
 
     except HttpError as error:
-        print(f"An HTTP error occurred: {error}")
+        logger.error("An HTTP error occurred: %s", error)
         return []
     except Exception as e:
-        print(f"An error occurred finding emails: {e}")
+        logger.error("An error occurred finding emails: %s", e)
         return []
 
-def download_attachments(service: Resource, message_id: str) -> dict[str, str]:
+def _get_processed_label_id(service: Resource) -> str | None:
+    """Returns the ID of GMAIL_PROCESSED_LABEL_NAME, creating the label if it doesn't exist yet."""
+    global _processed_label_id
+    if _processed_label_id is None:
+        labels = service.users().labels().list(userId='me').execute().get('labels', [])
+        _processed_label_id = next((label['id'] for label in labels if label['name'] == GMAIL_PROCESSED_LABEL_NAME), None)
+        if _processed_label_id is None:
+            label = service.users().labels().create(userId='me', body={'name': GMAIL_PROCESSED_LABEL_NAME}).execute()
+            _processed_label_id = label['id']
+            logger.info("Created Gmail label '%s' (ID: %s)", GMAIL_PROCESSED_LABEL_NAME, _processed_label_id)
+    return _processed_label_id
+
+def mark_emails_processed(service: Resource, email_ids: list[str]) -> bool:
+    """Adds GMAIL_PROCESSED_LABEL_NAME to the given emails so later queries skip them.
+    Does nothing if no label is configured. The database remains the source of truth,
+    so a failure here only means the emails are listed (and filtered out) again.
+    """
+    if not GMAIL_PROCESSED_LABEL_NAME or not email_ids:
+        return False
+    try:
+        label_id = _get_processed_label_id(service)
+        for start in range(0, len(email_ids), GMAIL_BATCH_MODIFY_SIZE):
+            service.users().messages().batchModify(userId='me', body={
+                'ids': email_ids[start:start + GMAIL_BATCH_MODIFY_SIZE],
+                'addLabelIds': [label_id],
+            }).execute()
+        logger.info("Labeled %s email(s) as '%s'.", len(email_ids), GMAIL_PROCESSED_LABEL_NAME)
+        return True
+    except HttpError as error:
+        logger.error("An HTTP error occurred labeling %s emails as processed: %s", len(email_ids), error)
+        return False
+
+# Attachment data is decoded and written in slices of this many base64 characters (a multiple of 4,
+# so every slice decodes on its own) instead of materializing the whole decoded file first.
+_B64_WRITE_SLICE = 64 * 1024
+
+def _write_base64url(data: str, f) -> int:
+    """Decodes URL-safe base64 data into the open binary file f slice by slice. Returns bytes written."""
+    written = 0
+    for start in range(0, len(data), _B64_WRITE_SLICE):
+        chunk = data[start:start + _B64_WRITE_SLICE]
+        if len(chunk) % 4:
+            chunk += '=' * (-len(chunk) % 4) # Only the last slice can be short; restore stripped padding
+        written += f.write(base64.urlsafe_b64decode(chunk))
+    return written
+
+# Gmail allows up to 100 calls per batch, but recommends <= 50 to stay clear of per-user rate limits
+GMAIL_BATCH_SIZE = 50
+
+def _execute_batched(service: Resource, requests: dict[str, object]) -> dict[str, dict]:
+    """Executes Gmail API requests via BatchHttpRequest, GMAIL_BATCH_SIZE per HTTP round-trip.
+
+    Args:
+        service: Authorized Gmail API service instance.
+        requests: Request objects keyed by a caller-chosen request ID.
+
+    Returns:
+        The responses keyed by request ID. Requests that failed are logged and left out.
+    """
+    responses = {}
+
+    def _on_response(request_id, response, exception):
+        if exception is not None:
+            logger.error("An HTTP error occurred in batched Gmail request %s: %s", request_id, exception)
+        else:
+            responses[request_id] = response
+
+    items = list(requests.items())
+    for start in range(0, len(items), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=_on_response)
+        for request_id, request in items[start:start + GMAIL_BATCH_SIZE]:
+            batch.add(request, request_id=request_id)
+        batch.execute()
+    return responses
+
+def get_messages(service: Resource, message_ids: list[str]) -> dict[str, dict]:
+    """Fetches full message resources for several emails in batched requests.
+
+    Args:
+        service: Authorized Gmail API service instance.
+        message_ids: The IDs of the messages to fetch.
+
+    Returns:
+        A dictionary of message ID -> message resource. Messages that could not be fetched are missing.
+    """
+    if not message_ids:
+        return {}
+    try:
+        logger.info("Fetching details for %s email(s) in batches of %s...", len(message_ids), GMAIL_BATCH_SIZE)
+        return _execute_batched(service, {
+            message_id: service.users().messages().get(userId='me', id=message_id)
+            for message_id in dict.fromkeys(message_ids)
+        })
+    except HttpError as error:
+        logger.error("An HTTP error occurred fetching %s messages: %s", len(message_ids), error)
+        return {}
+    except Exception as e:
+        logger.error("An error occurred fetching %s messages: %s", len(message_ids), e)
+        return {}
+
+def attachment_file_name(message_id: str, filename: str) -> str:
+    """Returns the (file system safe) name an attachment is stored under, prefixed with its message ID."""
+    # Sanitize filename slightly (replace spaces, could be more robust)
+    return f"{message_id}_{filename.replace(' ', '_')}"
+
+def download_attachments(service: Resource, message_id: str, message: dict | None = None,
+                         save_to_disk: bool = True) -> dict[str, str] | dict[str, bytes]:
     """Downloads all attachments from a specific email message.
 
     Args:
         service: Authorized Gmail API service instance.
         message_id: The ID of the message from which to download attachments.
+        message: The already fetched message resource (e.g. from get_messages). Fetched if None.
+        save_to_disk: If False, attachments are decoded in memory and nothing is written to DOWNLOAD_DIR.
 
     Returns:
         A dictionary where keys are original filenames and values are 
-        local file paths to the downloaded attachments. Empty if errors occur.
+        local file paths to the downloaded attachments (or their contents as bytes
+        when save_to_disk is False). Empty if errors occur.
     """
     downloaded_files_map = {}
     try:
-        print(f"Fetching email details for ID: {message_id}")
-        message = service.users().messages().get(userId='me', id=message_id).execute()
+        if message is None:
+            logger.info("Fetching email details for ID: %s", message_id)
+            message = service.users().messages().get(userId='me', id=message_id).execute()
         parts = message['payload'].get('parts', [])
 
         if not parts:
-            print(f"No parts found in message {message_id}. Cannot download attachments.")
+            logger.info("No parts found in message %s. Cannot download attachments.", message_id)
             # This might happen for simple text emails included by the query
             return {}
 
-        # Ensure download directory exists
-        if not os.path.exists(DOWNLOAD_DIR):
-            os.makedirs(DOWNLOAD_DIR)
-            print(f"Created download directory: {DOWNLOAD_DIR}")
-
-        attachment_count = 0
+        attachment_parts = {}
         for part in parts:
             if part.get('filename') and part.get('body') and part['body'].get('attachmentId'):
                 filename = part['filename']
                 attachment_id = part['body']['attachmentId']
-                print(f"Found attachment: '{filename}' (ID: {attachment_id}) in email {message_id}")
-                attachment_count += 1
-
-                try:
-                    attachment = service.users().messages().attachments().get(userId='me', messageId=message_id, id=attachment_id).execute()
-                    file_data = base64.urlsafe_b64decode(attachment['data'].encode('UTF-8'))
-                    
-                    # Sanitize filename slightly (replace spaces, could be more robust)
-                    safe_filename = filename.replace(" ", "_") 
-                    file_path = os.path.join(DOWNLOAD_DIR, f"{message_id}_{safe_filename}")
-
-                    print(f"Downloading attachment '{filename}' to '{file_path}'...")
-                    with open(file_path, 'wb') as f:
-                        f.write(file_data)
-                    
-                    downloaded_files_map[filename] = file_path
-                    print(f"Successfully downloaded '{file_path}' (Original: '{filename}')")
-
-                except HttpError as attach_error:
-                    print(f"An HTTP error occurred downloading attachment {filename} (ID: {attachment_id}): {attach_error}")
-                except Exception as e:
-                    print(f"An error occurred processing attachment {filename} (ID: {attachment_id}): {e}")
-
-        if attachment_count == 0:
-            print(f"No attachments with attachmentId found in email {message_id}. The query might include emails without downloadable attachments.")
-        
+                logger.info("Found attachment: '%s' (ID: %s) in email %s", filename, attachment_id, message_id)
+                attachment_parts[str(len(attachment_parts))] = (filename, attachment_id)
+
+        if not attachment_parts:
+            logger.info("No attachments with attachmentId found in email %s. The query might include emails without downloadable attachments.", message_id)
+            return {}
+
+        # Fetch all of the message's attachments in one batched round-trip
+        attachments = _execute_batched(service, {
+            request_id: service.users().messages().attachments().get(userId='me', messageId=message_id, id=attachment_id)
+            for request_id, (_, attachment_id) in attachment_parts.items()
+        })
+
+        for request_id, (filename, attachment_id) in attachment_parts.items():
+            attachment = attachments.get(request_id)
+            if attachment is None:
+                logger.warning("Could not download attachment %s (ID: %s) from email %s.", filename, attachment_id, message_id)
+                continue
+            try:
+                if not save_to_disk:
+                    data = attachment['data']
+                    downloaded_files_map[filename] = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+                    logger.info("Downloaded attachment '%s' into memory (%s bytes)", filename, len(downloaded_files_map[filename]))
+                    continue
+
+                file_path = os.path.join(DOWNLOAD_DIR, attachment_file_name(message_id, filename))
+
+                logger.info("Downloading attachment '%s' to '%s'...", filename, file_path)
+                with open(file_path, 'wb') as f:
+                    _write_base64url(attachment['data'], f)
+                
+                downloaded_files_map[filename] = file_path
+                logger.info("Successfully downloaded '%s' (Original: '%s')", file_path, filename)
+
+            except Exception as e:
+                logger.error("An error occurred processing attachment %s (ID: %s): %s", filename, attachment_id, e)
+
         return downloaded_files_map
 
     except HttpError as error:
-        print(f"An HTTP error occurred getting message {message_id}: {error}")
+        logger.error("An HTTP error occurred getting message %s: %s", message_id, error)
         return {}
     except Exception as e:
-        print(f"An error occurred downloading attachments for message {message_id}: {e}")
+        logger.error("An error occurred downloading attachments for message %s: %s", message_id, e)
         return {}
 
 def cleanup_downloads():
-    """Removes the temporary download directory and its contents."""
+    """Removes the temporary download directory and its contents. Call once, at shutdown."""
     if os.path.exists(DOWNLOAD_DIR):
         try:
             shutil.rmtree(DOWNLOAD_DIR)
-            print(f"Removed temporary download directory: {DOWNLOAD_DIR}")
+            logger.info("Removed temporary download directory: %s", DOWNLOAD_DIR)
         except Exception as e:
-            print(f"Error removing download directory {DOWNLOAD_DIR}: {e}")
+            logger.error("Error removing download directory %s: %s", DOWNLOAD_DIR, e)
     # else:
         # print(f"Download directory {DOWNLOAD_DIR} does not exist. No cleanup needed.")
 
 # Example usage (optional, for testing)
 if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
     print("Testing Gmail Service functions...")
     gmail = get_gmail_service()
     if gmail:
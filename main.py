@@ -1,19 +1,36 @@
 import os
 import time
+import datetime
 import json
 from dotenv import load_dotenv # Import load_dotenv
 import logging # Import logging module
-from apscheduler.schedulers.background import BackgroundScheduler # Corrected import
+import logging.handlers
+import queue
+import atexit
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait
+from apscheduler.schedulers.blocking import BlockingScheduler
 
 # Load environment variables from .env file at the start
 load_dotenv()
 
 # --- Basic Logging Configuration ---
+# Records are handed to a queue on the calling thread; a listener thread does the formatting
+# and the actual stdout write, so logging never blocks the processing loop on I/O.
+_log_queue = queue.SimpleQueue()
+_console_handler = logging.StreamHandler()
+_console_handler.setFormatter(logging.Formatter(
+    fmt='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+))
+_log_listener = logging.handlers.QueueListener(_log_queue, _console_handler)
 logging.basicConfig(
     level=logging.INFO, 
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
 )
+_log_listener.start()
+atexit.register(_log_listener.stop) # Flushes queued records on exit
 logger = logging.getLogger(__name__) # Add a logger for main.py
 # --- End Logging Configuration ---
 
@@ -27,157 +44,199 @@ import trello_service
 import sheets_service # Uncommented
 import vat_calculator # For VAT Calculation Scheduling
 
-# --- Helper function for comparing invoice data ---
-def _are_invoices_identical(new_data_gemini: dict, existing_db_invoice: dict) -> bool:
-    """Compares key fields of a new invoice (from Gemini) and an existing DB record."""
-    if not new_data_gemini or not existing_db_invoice:
-        return False
-
-    # Helper to safely convert Gemini string amounts to float for comparison
-    def to_float(value):
-        if isinstance(value, (float, int)):
-            return float(value)
-        if isinstance(value, str):
-            try:
-                return float(value.replace(',', '.')) # Handle comma as decimal if any
-            except ValueError:
-                return None # Cannot convert
-        return None
-
-    # Compare invoice_number (should always be present and match if this function is called appropriately)
-    if str(new_data_gemini.get('invoice_number')) != str(existing_db_invoice.get('invoice_number')):
-        # This check is more of a safeguard; typically, this function is called when numbers already match.
-        return False 
-
-    # Compare dates (YYYY-MM-DD string format)
-    if new_data_gemini.get('invoice_date') != existing_db_invoice.get('invoice_date'):
-        return False
-    if new_data_gemini.get('due_date') != existing_db_invoice.get('due_date'):
-        return False
-    
-    # Compare textual fields (case-sensitive, assuming consistency)
-    if new_data_gemini.get('payer') != existing_db_invoice.get('payer'):
-        return False
-    if new_data_gemini.get('issuer') != existing_db_invoice.get('issuer'):
-        return False
-
-    # Compare amounts (handle potential precision issues by comparing with a small tolerance if needed,
-    # but direct float comparison is often okay if data sources are consistent)
-    new_gross = to_float(new_data_gemini.get('gross_amount'))
-    db_gross = to_float(existing_db_invoice.get('gross_amount'))
-    if new_gross is None or db_gross is None or abs(new_gross - db_gross) > 0.001: # Comparing floats
-        return False
+# Read once; .env was loaded above
+SPREADSHEET_ID_FAKTURY = os.getenv(config.GOOGLE_SHEET_ID_FAKTURY_ENV)
 
-    new_vat = to_float(new_data_gemini.get('vat_amount'))
-    db_vat = to_float(existing_db_invoice.get('vat_amount'))
-    if new_vat is None or db_vat is None or abs(new_vat - db_vat) > 0.001: # Comparing floats
-        return False
+# --- Concurrency ---
+# All downstream services are network-bound, so threads overlap their round-trips.
+# Attachments and the per-invoice stages get separate pools: an attachment worker blocks on its
+# stage futures, so sharing one pool could leave no free worker to run them.
+ATTACHMENT_WORKERS = 4
+STAGE_WORKERS = 8
+_attachment_executor = ThreadPoolExecutor(max_workers=ATTACHMENT_WORKERS, thread_name_prefix='attachment')
+_stage_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix='invoice-stage')
 
-    # Compare boolean is_fuel_related (Gemini gives bool, DB stores int 0 or 1)
-    gemini_fuel_related = bool(new_data_gemini.get('is_fuel_related'))
-    db_fuel_related = bool(existing_db_invoice.get('is_fuel_related')) # SQLite int 0/1 converts to bool
-    if gemini_fuel_related != db_fuel_related:
-        return False
-        
-    return True
+# Serializes the duplicate check -> cleanup -> insert sequence per invoice number, so two
+# attachments carrying the same invoice can't both pass the check before either is saved.
+# Weak values: a lock disappears once no thread holds or waits on it, so the map doesn't grow.
+_invoice_locks: weakref.WeakValueDictionary[str, threading.Lock] = weakref.WeakValueDictionary()
+_invoice_locks_guard = threading.Lock()
 
+def _invoice_lock(invoice_number) -> threading.Lock:
+    with _invoice_locks_guard:
+        return _invoice_locks.setdefault(str(invoice_number), threading.Lock())
 
 # --- Main Logic ---
-def process_single_invoice(file_path: str, email_id: str, attachment_filename: str, drive_service_instance) -> bool:
+_NOT_ANALYZED = object() # process_single_invoice default: run Gemini analysis itself
+
+def process_single_invoice(file_path: str, email_id: str, attachment_filename: str, drive_service_instance,
+                           analysis_result=_NOT_ANALYZED, file_bytes: bytes | None = None) -> bool:
     """
     Processes a single downloaded invoice file.
     Handles Gemini analysis, Drive upload, Trello card creation, and DB storage.
     Manages duplicate and modification detection.
+    If analysis_result is given (e.g. from gemini_analyzer.analyze_invoices, None meaning skipped/failed),
+    the file is not analyzed again.
+    If file_bytes is given, file_path only serves as the file's name; otherwise the file is read once, up front.
     """
-    logger.info(f"--- Processing invoice file: {attachment_filename} (from email {email_id}) ---")
+    logger.info("--- Processing invoice file: %s (from email %s) ---", attachment_filename, email_id)
     
     # Перевіряємо чи файл не є ZIP архівом
     if file_path.lower().endswith('.zip'):
-        logger.info(f"Skipping ZIP file: {attachment_filename}")
+        logger.info("Skipping ZIP file: %s", attachment_filename)
         return True  # Повертаємо True, бо це не помилка, а навмисне пропускання
     
-    analysis_result = gemini_analyzer.analyze_invoice(file_path)
+    if file_bytes is None:
+        # Read the file once; Gemini (and its cache key), Drive and Trello all reuse these bytes
+        try:
+            with open(file_path, 'rb') as f:
+                file_bytes = f.read()
+        except OSError as e:
+            logger.error("[FAILED] Could not read invoice file %s: %s", file_path, e)
+            return False
+
+    if analysis_result is _NOT_ANALYZED:
+        analysis_result = gemini_analyzer.analyze_invoice(file_path, file_bytes)
 
     if analysis_result is None:
         # Лог з gemini_analyzer вже пояснив причину (наприклад, "is not a standard invoice or receipt")
         # Тому тут ми просто підтверджуємо, що файл пропущено коректно.
-        logger.info(f"Document {attachment_filename} was intentionally skipped by Gemini analyzer (e.g., not a standard invoice/receipt). This is expected behavior.")
+        logger.info("Document %s was intentionally skipped by Gemini analyzer (e.g., not a standard invoice/receipt). This is expected behavior.", attachment_filename)
         return True # Повертаємо True, оскільки це не помилка обробки, а коректний пропуск.
     
-    # Ensure all required keys from Gemini are present, including invoice_number
-    # Note: This check might seem redundant if Gemini returns None for non-standard invoices above,
-    # but it's a good safeguard if analyze_invoice changes its return for non-skipped but incomplete data.
-    # Required keys are now checked within gemini_analyzer.py before returning, so this specific block might be simplified
-    # or removed if we trust gemini_analyzer to always return None or a complete dict for processable types.
-    # For now, keeping it as a defense layer.
-    required_gemini_keys = {'document_type', 'is_paid', 'invoice_number', 'invoice_date', 'due_date', 'payer', 'issuer', 'gross_amount', 'vat_amount', 'is_fuel_related'}
-    # Payer_nip is not strictly required here as it can be derived.
-    if not required_gemini_keys.issubset(analysis_result.keys()):
-        logger.error(f"[FAILED] Gemini analysis for {attachment_filename} missing one or more required keys: {required_gemini_keys - set(analysis_result.keys())}. Raw: {analysis_result}")
-        return False
+    # gemini_analyzer returns either None or a dict with all of its REQUIRED_KEYS, so only the value is checked here
     if not analysis_result.get('invoice_number'): # Specifically check for invoice_number
-        logger.error(f"[FAILED] Gemini analysis for {attachment_filename} did not return an 'invoice_number'. Raw: {analysis_result}")
+        logger.error("[FAILED] Gemini analysis for %s did not return an 'invoice_number'. Raw: %s", attachment_filename, analysis_result)
         return False
 
-    logger.info(f"[SUCCESS] Gemini analysis for {attachment_filename} successful. Invoice Number: {analysis_result.get('invoice_number')}")
-    # logger.debug(json.dumps(analysis_result, indent=2, ensure_ascii=False)) # Make debug for less verbose logs
+    logger.info("[SUCCESS] Gemini analysis for %s successful. Invoice Number: %s", attachment_filename, analysis_result.get('invoice_number'))
+    if logger.isEnabledFor(logging.DEBUG): # Skip the JSON dump entirely unless DEBUG is on
+        logger.debug(json.dumps(analysis_result, indent=2, ensure_ascii=False))
 
     current_invoice_details_from_gemini = analysis_result.copy()
     invoice_num = current_invoice_details_from_gemini.get('invoice_number')
 
+    with _invoice_lock(invoice_num):
+        return _store_invoice(current_invoice_details_from_gemini, file_path, email_id, attachment_filename,
+                              drive_service_instance, file_bytes)
+
+def _delete_old_drive_file(file_id: str):
+    # Runs on a stage worker, so it uses that thread's own Drive client
+    del_drive = drive_service.delete_file_from_drive(drive_service.get_drive_service(), file_id)
+    logger.info("  Old Google Drive file %s deletion status: %s", file_id, del_drive)
+
+def _delete_old_trello_card(card_id: str):
+    del_trello = trello_service.delete_trello_card(card_id)
+    logger.info("  Old Trello card %s deletion status: %s", card_id, del_trello)
+
+def _delete_old_sheets_rows(row_ranges: list[str]):
+    logger.info("Attempting to delete old Google Sheets rows: %s", row_ranges)
+    if SPREADSHEET_ID_FAKTURY:
+        del_sheets = sheets_service.delete_invoice_rows_by_ranges(
+            SPREADSHEET_ID_FAKTURY, 
+            row_ranges
+        )
+        logger.info("  Old Google Sheets rows %s deletion status: %s", row_ranges, del_sheets)
+    else:
+        logger.warning("  Could not delete Google Sheets rows: %s not set.", config.GOOGLE_SHEET_ID_FAKTURY_ENV)
+
+def _create_trello_card_for(invoice_details: dict, file_path: str, attachment_filename: str, drive_file_data,
+                            file_bytes: bytes | None = None) -> str | None:
+    """Creates a Trello card for unpaid standard invoices. Returns the card ID or None if skipped/failed."""
+    is_paid_status = invoice_details.get('is_paid', False) # Default to False if key is missing
+    doc_type_for_trello = invoice_details.get('document_type')
+
+    if doc_type_for_trello != 'standard_invoice':
+        logger.info("[SKIPPED] Trello card creation for %s because document type is '%s' (not 'standard_invoice').", attachment_filename, doc_type_for_trello)
+        return None
+    if is_paid_status:
+        logger.info("[SKIPPED] Trello card creation for %s because it is marked as paid (is_paid: %s).", attachment_filename, is_paid_status)
+        return None
+    if not (drive_file_data and drive_file_data.get('link')): # Requires Drive link
+        logger.info("[SKIPPED] Trello card creation for %s due to missing Drive link (even though it's an unpaid invoice).", attachment_filename)
+        return None
+
+    logger.info("Attempting to create Trello card for unpaid standard invoice %s...", attachment_filename)
+    trello_card_id_val = trello_service.create_trello_card(
+        invoice_data=invoice_details,
+        invoice_file_path=file_path, # For attachment
+        drive_file_link=drive_file_data['link'],
+        file_bytes=file_bytes
+    )
+    if trello_card_id_val:
+        logger.info("[SUCCESS] Trello card created for %s. ID: %s", attachment_filename, trello_card_id_val)
+    else:
+        logger.warning("[WARNING] Failed to create Trello card for %s. This is non-critical for DB entry.", attachment_filename)
+    return trello_card_id_val
+
+def _append_to_sheets(invoice_details: dict, attachment_filename: str, drive_file_data) -> str | None:
+    """Appends the invoice to Google Sheets. Returns the written row range or None if skipped/failed."""
+    logger.info("Attempting to add entry to Google Sheets for %s...", attachment_filename)
+    if not (invoice_details and drive_file_data and drive_file_data.get('link')):
+        logger.warning("[SKIPPED] Google Sheets entry for %s due to missing analysis data or Drive link.", attachment_filename)
+        return None
+
+    google_sheets_row_id_val = sheets_service.append_invoice_to_sheet(
+        invoice_data=invoice_details,
+        drive_file_link=drive_file_data['link']
+    )
+    if google_sheets_row_id_val:
+        logger.info("[SUCCESS] Data for %s added to Google Sheets. Range: %s", attachment_filename, google_sheets_row_id_val)
+    else:
+        logger.warning("[WARNING] Failed to add data for %s to Google Sheets. DB record will not have sheet row ID.", attachment_filename)
+    return google_sheets_row_id_val
+
+def _store_invoice(current_invoice_details_from_gemini: dict, file_path: str, email_id: str, attachment_filename: str,
+                   drive_service_instance, file_bytes: bytes | None = None) -> bool:
+    """Duplicate/modification handling, Drive upload, Trello, Sheets and DB storage for an analyzed invoice."""
+    invoice_num = current_invoice_details_from_gemini.get('invoice_number')
+
     # --- Duplicate / Modification Check ---
+    duplicate_db_id = database.find_exact_duplicate(current_invoice_details_from_gemini)
+    if duplicate_db_id:
+        logger.info("[DUPLICATE] Invoice %s (%s) is an exact duplicate of DB record ID %s. Skipping.", invoice_num, attachment_filename, duplicate_db_id)
+        return True # Duplicate handled successfully
+
     existing_db_invoices = database.find_invoices_by_number(invoice_num)
     
     if existing_db_invoices:
-        is_exact_duplicate = False
-        for db_invoice_record in existing_db_invoices:
-            if _are_invoices_identical(current_invoice_details_from_gemini, db_invoice_record):
-                is_exact_duplicate = True
-                logger.info(f"[DUPLICATE] Invoice {invoice_num} ({attachment_filename}) is an exact duplicate of DB record ID {db_invoice_record['id']}. Skipping.")
-                break 
-        
-        if is_exact_duplicate:
-            return True # Duplicate handled successfully
-
         # If not an exact duplicate, but invoice_number existed, it's a modification. Delete all old versions.
-        logger.info(f"[MODIFICATION] Invoice {invoice_num} ({attachment_filename}) is a new version. Deleting {len(existing_db_invoices)} old version(s).")
+        logger.info("[MODIFICATION] Invoice %s (%s) is a new version. Deleting %s old version(s).", invoice_num, attachment_filename, len(existing_db_invoices))
+        # Drive, Trello and Sheets deletions are independent, so they run concurrently across all
+        # old versions; the DB rows are removed once they have finished.
+        cleanup_futures = []
         for old_db_invoice in existing_db_invoices:
-            logger.info(f"Deleting resources for old invoice version (DB ID: {old_db_invoice['id']})...")
+            logger.info("Deleting resources for old invoice version (DB ID: %s)...", old_db_invoice['id'])
             if old_db_invoice.get('google_drive_file_id') and drive_service_instance:
-                del_drive = drive_service.delete_file_from_drive(drive_service_instance, old_db_invoice['google_drive_file_id'])
-                logger.info(f"  Old Google Drive file {old_db_invoice['google_drive_file_id']} deletion status: {del_drive}")
+                cleanup_futures.append(_stage_executor.submit(_delete_old_drive_file, old_db_invoice['google_drive_file_id']))
             if old_db_invoice.get('trello_card_id'):
-                del_trello = trello_service.delete_trello_card(old_db_invoice['trello_card_id'])
-                logger.info(f"  Old Trello card {old_db_invoice['trello_card_id']} deletion status: {del_trello}")
-            # Delete from Google Sheets
-            if old_db_invoice.get('google_sheets_row_id'):
-                logger.info(f"Attempting to delete old Google Sheets row: {old_db_invoice['google_sheets_row_id']}")
-                spreadsheet_id_for_delete = os.getenv(config.GOOGLE_SHEET_ID_FAKTURY_ENV)
-                if spreadsheet_id_for_delete:
-                    del_sheets = sheets_service.delete_invoice_row_by_range(
-                        spreadsheet_id_for_delete, 
-                        old_db_invoice['google_sheets_row_id']
-                    )
-                    logger.info(f"  Old Google Sheets row {old_db_invoice['google_sheets_row_id']} deletion status: {del_sheets}")
-                else:
-                    logger.warning(f"  Could not delete Google Sheets row: {config.GOOGLE_SHEET_ID_FAKTURY_ENV} not set.")
-            
+                cleanup_futures.append(_stage_executor.submit(_delete_old_trello_card, old_db_invoice['trello_card_id']))
+        # All old Sheets rows go in one delete_invoice_rows_by_ranges batchUpdate, deleted bottom-up
+        # so earlier deletions don't shift the rows still to be removed
+        old_sheets_rows = [old_db_invoice['google_sheets_row_id'] for old_db_invoice in existing_db_invoices
+                           if old_db_invoice.get('google_sheets_row_id')]
+        if old_sheets_rows:
+            cleanup_futures.append(_stage_executor.submit(_delete_old_sheets_rows, old_sheets_rows))
+        wait(cleanup_futures)
+
+        for old_db_invoice in existing_db_invoices:
             db_del_success = database.delete_invoice(old_db_invoice['id'])
-            logger.info(f"  Old DB record {old_db_invoice['id']} deletion status: {db_del_success}")
-        logger.info(f"Finished deleting old versions for invoice {invoice_num}.")
+            logger.info("  Old DB record %s deletion status: %s", old_db_invoice['id'], db_del_success)
+        logger.info("Finished deleting old versions for invoice %s.", invoice_num)
     
     # --- Process as New Invoice (or Modification after cleanup) ---
-    logger.info(f"Processing invoice {invoice_num} ({attachment_filename}) as new or modified version.")
+    logger.info("Processing invoice %s (%s) as new or modified version.", invoice_num, attachment_filename)
 
     # 1. Upload to Google Drive
     drive_file_data = None
     if drive_service_instance:
-        logger.info(f"Attempting to upload {attachment_filename} to Google Drive...")
-        drive_file_data = drive_service.upload_invoice_to_drive(drive_service_instance, file_path, current_invoice_details_from_gemini)
+        logger.info("Attempting to upload %s to Google Drive...", attachment_filename)
+        drive_file_data = drive_service.upload_invoice_to_drive(drive_service_instance, file_path, current_invoice_details_from_gemini,
+                                                                file_bytes)
         if not drive_file_data or not drive_file_data.get('id'):
-            logger.error(f"[FAILED] Google Drive upload failed for {attachment_filename} or file ID not found.")
+            logger.error("[FAILED] Google Drive upload failed for %s or file ID not found.", attachment_filename)
             return False # Critical failure
-        logger.info(f"[SUCCESS] File {attachment_filename} uploaded to Google Drive. ID: {drive_file_data.get('id')}, Link: {drive_file_data.get('link')}")
+        logger.info("[SUCCESS] File %s uploaded to Google Drive. ID: %s, Link: %s", attachment_filename, drive_file_data.get('id'), drive_file_data.get('link'))
     else:
         logger.warning("[SKIPPED] Google Drive service not available. Cannot upload.")
         # Depending on requirements, this might be a critical failure if Drive upload is essential
@@ -185,30 +244,14 @@ def process_single_invoice(file_path: str, email_id: str, attachment_filename: s
         # Consider returning False if Drive is absolutely mandatory for all documents.
         pass # Or return False if Drive is mandatory
 
-    # 2. Create Trello Card - only if the document is not paid and is a standard invoice
-    trello_card_id_val = None
-    is_paid_status = current_invoice_details_from_gemini.get('is_paid', False) # Default to False if key is missing
-    doc_type_for_trello = current_invoice_details_from_gemini.get('document_type')
-
-    if doc_type_for_trello == 'standard_invoice' and not is_paid_status:
-        if drive_file_data and drive_file_data.get('link'): # Requires Drive link
-            logger.info(f"Attempting to create Trello card for unpaid standard invoice {attachment_filename}...")
-            trello_card_id_val = trello_service.create_trello_card(
-                invoice_data=current_invoice_details_from_gemini,
-                invoice_file_path=file_path, # For attachment
-                drive_file_link=drive_file_data['link']
-            )
-            if trello_card_id_val:
-                logger.info(f"[SUCCESS] Trello card created for {attachment_filename}. ID: {trello_card_id_val}")
-            else:
-                logger.warning(f"[WARNING] Failed to create Trello card for {attachment_filename}. This is non-critical for DB entry.")
-        else:
-            logger.info(f"[SKIPPED] Trello card creation for {attachment_filename} due to missing Drive link (even though it's an unpaid invoice).")
-    else:
-        if doc_type_for_trello != 'standard_invoice':
-            logger.info(f"[SKIPPED] Trello card creation for {attachment_filename} because document type is '{doc_type_for_trello}' (not 'standard_invoice').")
-        elif is_paid_status:
-            logger.info(f"[SKIPPED] Trello card creation for {attachment_filename} because it is marked as paid (is_paid: {is_paid_status}).")
+    # 2. Trello card (unpaid standard invoices only) and the Google Sheets row both need just the
+    # Drive link, so they run concurrently.
+    trello_future = _stage_executor.submit(_create_trello_card_for, current_invoice_details_from_gemini,
+                                           file_path, attachment_filename, drive_file_data, file_bytes)
+    sheets_future = _stage_executor.submit(_append_to_sheets, current_invoice_details_from_gemini,
+                                           attachment_filename, drive_file_data)
+    trello_card_id_val = trello_future.result()
+    google_sheets_row_id_val = sheets_future.result()
 
     # 3. Store in Database
     invoice_to_save_in_db = current_invoice_details_from_gemini.copy() # Start with Gemini data
@@ -217,34 +260,17 @@ def process_single_invoice(file_path: str, email_id: str, attachment_filename: s
     invoice_to_save_in_db['trello_card_id'] = trello_card_id_val
     invoice_to_save_in_db['original_email_id'] = email_id
     invoice_to_save_in_db['attachment_filename'] = attachment_filename
-    # 'google_sheets_row_id' will be set after attempting to append to Sheets
-
-    # --- Google Sheets Entry ---
-    google_sheets_row_id_val = None
-    logger.info(f"Attempting to add entry to Google Sheets for {attachment_filename}...")
-    if current_invoice_details_from_gemini and drive_file_data and drive_file_data.get('link'):
-        google_sheets_row_id_val = sheets_service.append_invoice_to_sheet(
-            invoice_data=current_invoice_details_from_gemini, 
-            drive_file_link=drive_file_data['link']
-        )
-        if google_sheets_row_id_val:
-            logger.info(f"[SUCCESS] Data for {attachment_filename} added to Google Sheets. Range: {google_sheets_row_id_val}")
-        else:
-            logger.warning(f"[WARNING] Failed to add data for {attachment_filename} to Google Sheets. DB record will not have sheet row ID.")
-    else:
-        logger.warning(f"[SKIPPED] Google Sheets entry for {attachment_filename} due to missing analysis data or Drive link.")
-    
     invoice_to_save_in_db['google_sheets_row_id'] = google_sheets_row_id_val # Store even if None
 
-    logger.info(f"Attempting to save invoice {invoice_num} ({attachment_filename}) to database with Sheets ID: {google_sheets_row_id_val}...")
+    logger.info("Attempting to save invoice %s (%s) to database with Sheets ID: %s...", invoice_num, attachment_filename, google_sheets_row_id_val)
     new_db_invoice_id = database.add_invoice(invoice_to_save_in_db)
 
     if not new_db_invoice_id:
-        logger.error(f"[FAILED] Could not save invoice {invoice_num} ({attachment_filename}) to database.")
+        logger.error("[FAILED] Could not save invoice %s (%s) to database.", invoice_num, attachment_filename)
         # Potentially attempt to rollback Drive upload / Trello card if this fails? Complex.
         return False # Critical failure
     
-    logger.info(f"[SUCCESS] Invoice {invoice_num} ({attachment_filename}) saved to database with ID: {new_db_invoice_id}.")
+    logger.info("[SUCCESS] Invoice %s (%s) saved to database with ID: %s.", invoice_num, attachment_filename, new_db_invoice_id)
     
     # --- Google Sheets Entry (Commented Out for now) ---
     # logger.info(f"Attempting to add entry to Google Sheets for {attachment_filename}...")
@@ -264,8 +290,105 @@ def process_single_invoice(file_path: str, email_id: str, attachment_filename: s
 
     return True # All critical steps succeeded for this file
 
-def main_loop():
-    """Main loop to check emails and process invoices."""
+def poll_once():
+    """Checks for new emails once and processes their invoices. Scheduled by main_loop()."""
+    # Jobs run on the scheduler's worker threads, so take this thread's own clients
+    gmail = gmail_service.get_gmail_service()
+    drive = drive_service.get_drive_service()
+    if not gmail or not drive:
+        logger.error("Failed to get required Google services (Gmail or Drive). Skipping this check.")
+        return
+
+    try:
+        logger.info("\n[%s] Checking for new emails...", time.strftime('%Y-%m-%d %H:%M:%S'))
+        
+        new_emails = gmail_service.find_new_emails(gmail)
+
+        if not new_emails:
+            logger.info("No new emails to process.")
+        else:
+            logger.info("Found %s new email(s) requiring processing.", len(new_emails))
+            # One batched round-trip per 50 emails instead of one messages.get per email
+            fetched_messages = gmail_service.get_messages(gmail, [email_info['id'] for email_info in new_emails])
+            # Download every email's attachments first, so Gemini analyzes the whole poll window
+            # in one concurrent pass instead of email by email. Attachments stay in memory: they are
+            # handed to Gemini, Drive and Trello as bytes, never written to disk.
+            downloads_by_email = {} # email_id -> {original filename: attachment file name}
+            file_contents = {} # attachment file name -> bytes
+            emails_without_attachments = [] # Nothing to process; recorded in one transaction below
+            for email_info in new_emails:
+                email_id = email_info['id']
+                attachments = gmail_service.download_attachments(gmail, email_id, fetched_messages.get(email_id),
+                                                                 save_to_disk=False) # Returns dict
+                
+                if not attachments:
+                    logger.info("No attachments found or failed to download for email %s. Skipping email.", email_id)
+                    # If an email had no attachments but was queried, we might mark it as processed.
+                    # For now, if download_attachments returns empty/None, we assume it's not an invoice email
+                    # or an issue occurred. If it's consistently picked up, gmail_query might need refinement.
+                    # Let's mark it as processed to avoid re-picking an empty email.
+                    logger.info("Marking email %s as processed as no valid attachments were found for processing.", email_id)
+                    emails_without_attachments.append(email_id)
+                    continue
+                downloaded_files_map = {}
+                for original_filename, data in attachments.items():
+                    file_name = gmail_service.attachment_file_name(email_id, original_filename)
+                    downloaded_files_map[original_filename] = file_name
+                    file_contents[file_name] = data
+                downloads_by_email[email_id] = downloaded_files_map
+            database.add_processed_emails(emails_without_attachments)
+
+            analyzable_names = [name for name in file_contents if not name.lower().endswith('.zip')]
+            logger.info("Analyzing %s attachment(s) from %s email(s) with Gemini...", len(analyzable_names), len(downloads_by_email))
+            analysis_results = gemini_analyzer.analyze_invoices(analyzable_names, file_contents)
+            gemini_analyzer.release_uploaded_files() # Analysis for this poll is done
+
+            for email_id, downloaded_files_map in downloads_by_email.items():
+                logger.info("\nProcessing Email ID: %s", email_id)
+
+                def handle_attachment(item):
+                    original_filename, file_name = item
+                    try:
+                        # Worker threads use their own Drive client; googleapiclient clients aren't thread-safe
+                        worker_drive = drive_service.get_drive_service() if drive else None
+                        success = process_single_invoice(file_name, email_id, original_filename, worker_drive,
+                                                         analysis_results.get(file_name, _NOT_ANALYZED),
+                                                         file_contents[file_name])
+                    except Exception as e:
+                        # One failing attachment must not abort the rest of the poll
+                        logger.exception("Unexpected error while processing attachment %s from email %s: %s",
+                                         original_filename, email_id, e)
+                        success = False
+                    if not success:
+                        logger.error("Critical processing failed for attachment %s from email %s.", original_filename, email_id)
+                    return success
+
+                # Attachments of one email are processed concurrently. We still go through all of them,
+                # but the email won't count as fully handled if any attachment fails critically.
+                all_attachments_handled_successfully = all(
+                    list(_attachment_executor.map(handle_attachment, downloaded_files_map.items()))
+                )
+                for file_name in downloaded_files_map.values():
+                    del file_contents[file_name] # Done with this email's attachments; free the memory
+
+                if all_attachments_handled_successfully:
+                    logger.info("All attachments for email %s were handled successfully (processed, duplicate, or modified).", email_id)
+                else:
+                    logger.warning("One or more attachments in email %s could not be fully processed (e.g., unsupported file type, analysis error). See logs for details.", email_id)
+                
+                logger.info("Marking email %s as processed to prevent further attempts on this email.", email_id)
+                # Recorded as soon as the email is done, so a crash later in the poll doesn't redo it
+                database.add_processed_email(email_id)
+
+            # Every email above was recorded as processed; label them so the next query skips them
+            gmail_service.mark_emails_processed(gmail, [email_info['id'] for email_info in new_emails])
+
+    except Exception as e:
+        # Logged, not fatal: the next scheduled check runs as usual
+        logger.exception("\n[ERROR] An unexpected error occurred while checking emails: %s", e)
+
+def main_loop(scheduler):
+    """Initializes the services, schedules poll_once() every EMAIL_CHECK_INTERVAL_SECONDS and runs the scheduler."""
     logger.info("Starting Faktura Processing Automation...")
     
     logger.info("Initializing database...")
@@ -279,82 +402,24 @@ def main_loop():
         logger.error("Failed to get required Google services (Gmail or Drive). Exiting.")
         return
     
-    logger.info("Authentication successful. Entering main loop for email checking...")
+    logger.info("Authentication successful. Scheduling email checks...")
+
+    # max_instances=1 + coalesce: a slow check is never overlapped by the next one, and missed
+    # runs collapse into one. The first check starts right away.
+    scheduler.add_job(
+        poll_once,
+        'interval',
+        seconds=config.EMAIL_CHECK_INTERVAL_SECONDS,
+        max_instances=1,
+        coalesce=True,
+        next_run_time=datetime.datetime.now(scheduler.timezone)
+    )
+    logger.info("Checking for new emails every %s seconds.", config.EMAIL_CHECK_INTERVAL_SECONDS)
 
     try:
-        while True:
-            logger.info(f"\n[{time.strftime('%Y-%m-%d %H:%M:%S')}] Checking for new emails...")
-            
-            new_emails = gmail_service.find_new_emails(gmail)
-
-            if not new_emails:
-                logger.info("No new emails to process.")
-            else:
-                logger.info(f"Found {len(new_emails)} new email(s) requiring processing.")
-                for email_info in new_emails:
-                    email_id = email_info['id']
-                    logger.info(f"\nProcessing Email ID: {email_id}")
-                    
-                    downloaded_files_map = gmail_service.download_attachments(gmail, email_id) # Returns dict
-                    
-                    if not downloaded_files_map:
-                        logger.info(f"No attachments found or failed to download for email {email_id}. Skipping email.")
-                        # If an email had no attachments but was queried, we might mark it as processed.
-                        # For now, if download_attachments returns empty/None, we assume it's not an invoice email
-                        # or an issue occurred. If it's consistently picked up, gmail_query might need refinement.
-                        # Let's mark it as processed to avoid re-picking an empty email.
-                        logger.info(f"Marking email {email_id} as processed as no valid attachments were found for processing.")
-                        database.add_processed_email(email_id)
-                        continue
-
-                    all_attachments_handled_successfully = True # Renamed for clarity
-                    for original_filename, file_path in downloaded_files_map.items():
-                        if not os.path.exists(file_path): # Double check file exists
-                            logger.error(f"Downloaded file path {file_path} for {original_filename} does not exist. Skipping.")
-                            all_attachments_handled_successfully = False
-                            continue
-
-                        success = process_single_invoice(file_path, email_id, original_filename, drive)
-                        if not success:
-                            all_attachments_handled_successfully = False
-                            logger.error(f"Critical processing failed for attachment {original_filename} from email {email_id}.")
-                            # We continue processing other attachments in the same email,
-                            # but the email won't be marked as fully processed if any attachment fails critically.
-                    
-                    logger.info(f"Cleaning up temporary files for email {email_id}...")
-                    for file_path in downloaded_files_map.values():
-                        if os.path.exists(file_path): # Check before removing
-                            try:
-                                os.remove(file_path)
-                            except OSError as e:
-                                logger.error(f"Error removing temp file {file_path}: {e}")
-                    
-                    # Attempt to remove the email's temporary sub-directory
-                    if downloaded_files_map: # If there were files, a directory might have been made
-                        # Assuming download_attachments creates a per-email_id folder inside a main download dir
-                        # And that file_path is inside that per-email_id folder.
-                        # This needs to align with how gmail_service.download_attachments and cleanup_downloads work.
-                        # For simplicity, relying on a global cleanup in gmail_service for now,
-                        # or individual file removal is sufficient if no per-email subfolder is used that needs specific cleanup here.
-                        # The current `gmail_service.cleanup_downloads()` in `finally` should handle the main download folder.
-                        pass
-
-
-                    if all_attachments_handled_successfully:
-                        logger.info(f"All attachments for email {email_id} were handled successfully (processed, duplicate, or modified).")
-                    else:
-                        logger.warning(f"One or more attachments in email {email_id} could not be fully processed (e.g., unsupported file type, analysis error). See logs for details.")
-                    
-                    logger.info(f"Marking email {email_id} as processed to prevent further attempts on this email.")
-                    database.add_processed_email(email_id)
-
-            logger.info(f"\nWaiting for {config.EMAIL_CHECK_INTERVAL_SECONDS} seconds before next check...")
-            time.sleep(config.EMAIL_CHECK_INTERVAL_SECONDS)
-
-    except KeyboardInterrupt:
+        scheduler.start() # Blocks until shutdown
+    except (KeyboardInterrupt, SystemExit):
         logger.info("\nProcess interrupted by user. Exiting gracefully...")
-    except Exception as e:
-        logger.exception(f"\n[FATAL ERROR] An unexpected error occurred in the main loop: {e}")
     finally:
         logger.info("Performing final cleanup...")
         gmail_service.cleanup_downloads() 
@@ -362,8 +427,8 @@ def main_loop():
 
 
 if __name__ == '__main__':
-    bg_scheduler = BackgroundScheduler(timezone="Europe/Kiev")
-    bg_scheduler.add_job(
+    scheduler = BlockingScheduler(timezone="Europe/Kiev")
+    scheduler.add_job(
         vat_calculator.calculate_and_record_vat_summary, 
         'cron', 
         day=15, 
@@ -371,8 +436,7 @@ if __name__ == '__main__':
         minute=0,
         misfire_grace_time=3600 
     )
-    bg_scheduler.start()
-    logger.info("Background scheduler for VAT calculation started. (15th of month, 9:00 AM Europe/Kiev).")
+    logger.info("VAT calculation scheduled (15th of month, 9:00 AM Europe/Kiev).")
     
     logger.info("Starting main email processing loop...")
-    main_loop() 
\ No newline at end of file
+    main_loop(scheduler)
@@ -9,6 +9,27 @@ PAYER_NIP_MAPPING = {
     "5253033512": "Premium Maksym Yeromin"
 }
 
+def _normalize_name(name: str) -> str:
+    """Канонічна форма назви для порівняння: casefold(), без крапок, пробіли згорнуто в один.
+    Напр. "ABC  Sp. z o.o." і "abc sp z oo" дають однаковий результат."""
+    return ' '.join(name.casefold().replace('.', '').split())
+
+# Зворотний маппінг (нормалізована назва -> NIP), будується один раз при імпорті.
+# setdefault зберігає перший NIP для назви, як і попередній лінійний пошук.
+PAYER_NAME_TO_NIP = {}
+for _nip, _name in PAYER_NIP_MAPPING.items():
+    PAYER_NAME_TO_NIP.setdefault(_normalize_name(_name), _nip)
+
+# Видаляє всі ASCII нецифрові символи за один прохід str.translate (NIP часто виглядає як "PL 521-405-29-65")
+_NIP_TRANS = str.maketrans('', '', ''.join(chr(c) for c in range(128) if not chr(c).isdigit()))
+
+def clean_nip(nip: str) -> str:
+    """Повертає лише цифри з NIP."""
+    cleaned = nip.translate(_NIP_TRANS)
+    if not cleaned.isascii(): # Рідкісні не-ASCII залишки (напр. нерозривні пробіли): повільний шлях
+        cleaned = ''.join(filter(str.isdigit, cleaned))
+    return cleaned
+
 def identify_payer_by_nip(nip: str) -> str | None:
     """
     Ідентифікує платника за його NIP номером.
@@ -23,9 +44,7 @@ def identify_payer_by_nip(nip: str) -> str | None:
         return None
         
     # Видаляємо всі нецифрові символи з NIP
-    clean_nip = ''.join(filter(str.isdigit, str(nip)))
-    
-    return PAYER_NIP_MAPPING.get(clean_nip)
+    return PAYER_NIP_MAPPING.get(clean_nip(str(nip)))
 
 def get_payer_nip(payer_name: str) -> str | None:
     """
@@ -40,9 +59,5 @@ def get_payer_nip(payer_name: str) -> str | None:
     if not payer_name:
         return None
         
-    # Шукаємо NIP за назвою платника
-    for nip, name in PAYER_NIP_MAPPING.items():
-        if name.lower() == payer_name.lower():
-            return nip
-            
-    return None 
\ No newline at end of file
+    # Шукаємо NIP за нормалізованою назвою (регістр, крапки та зайві пробіли не враховуються)
+    return PAYER_NAME_TO_NIP.get(_normalize_name(payer_name)) 
\ No newline at end of file
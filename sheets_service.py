@@ -1,10 +1,13 @@
 import logging
 import os
 import re # Added for parsing row range
-from datetime import datetime
+import random
+import threading
+from datetime import date, datetime
 from googleapiclient.discovery import Resource
 from googleapiclient.errors import HttpError
 
+import api_retry
 import auth
 import config
 
@@ -16,19 +19,68 @@ SHEET_HEADERS = [
     "Сума (брутто)", "VAT", "Пов'язано з авто/паливом", "Посилання на Google Drive"
 ]
 
+# Sheet (tab) title -> sheetId, per spreadsheet ID. Filled from one spreadsheets().get and kept
+# for the life of the process; re-fetched on a title miss and dropped when Sheets reports that
+# a sheet/range no longer exists (e.g. a tab was deleted by hand).
+_sheet_id_cache: dict[str, dict[str, int]] = {}
+_sheet_id_cache_lock = threading.Lock()
+# Held while checking for / creating a monthly tab, so concurrent appends don't both try to add it
+_ensure_sheet_lock = threading.Lock()
+
+# HTTP statuses worth retrying (see api_retry.call_with_backoff)
+_RETRY_STATUSES = frozenset((429, 500, 503))
+# A 429 means the request was rejected before being applied. A 5xx may have been applied anyway,
+# so appends and row deletions (which are not idempotent) only retry on 429.
+_REJECTED_STATUSES = frozenset((429,))
+
+def _execute_with_backoff(request, *, retry_statuses=_RETRY_STATUSES, tries=api_retry.MAX_TRIES):
+    """Executes a Sheets API request, retrying with exponential backoff on the given HTTP statuses."""
+    def retry_status(error):
+        status = getattr(error.resp, 'status', None) if isinstance(error, HttpError) else None
+        return status if status in retry_statuses else None
+    return api_retry.call_with_backoff(request.execute, retry_status, api_name='Sheets API', tries=tries)
+
 def get_sheets_service() -> Resource | None:
     """Gets the authenticated Google Sheets service resource."""
     return auth.get_service('sheets', 'v4')
 
+def _fetch_sheet_ids(service, spreadsheet_id) -> dict[str, int]:
+    """Reads all tab titles and IDs of a spreadsheet and stores them in the cache. Raises HttpError."""
+    # Only titles and IDs are needed; without a fields mask Sheets returns every tab's full properties.
+    spreadsheet_properties = _execute_with_backoff(service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id, fields='sheets.properties.sheetId,sheets.properties.title'
+    ))
+    sheet_ids = {
+        sheet['properties']['title']: sheet['properties']['sheetId']
+        for sheet in spreadsheet_properties.get('sheets', [])
+    }
+    with _sheet_id_cache_lock:
+        _sheet_id_cache[spreadsheet_id] = sheet_ids
+    return sheet_ids
+
+def _cached_sheet_id(spreadsheet_id, sheet_title):
+    with _sheet_id_cache_lock:
+        return _sheet_id_cache.get(spreadsheet_id, {}).get(sheet_title)
+
+def _remember_sheet_id(spreadsheet_id, sheet_title, sheet_id):
+    with _sheet_id_cache_lock:
+        _sheet_id_cache.setdefault(spreadsheet_id, {})[sheet_title] = sheet_id
+
+def _invalidate_sheet_ids(spreadsheet_id):
+    with _sheet_id_cache_lock:
+        _sheet_id_cache.pop(spreadsheet_id, None)
+
+def _is_missing_sheet_error(error: HttpError) -> bool:
+    """True for the 400/404 errors Sheets returns when a cached tab or range no longer exists."""
+    return error.resp.status in (400, 404)
+
 def _get_sheet_id_by_title(service, spreadsheet_id, sheet_title):
     """Gets the ID of a sheet (tab) by its title. Returns None if not found."""
+    sheet_id = _cached_sheet_id(spreadsheet_id, sheet_title)
+    if sheet_id is not None:
+        return sheet_id
     try:
-        spreadsheet_properties = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-        sheets = spreadsheet_properties.get('sheets', [])
-        for sheet in sheets:
-            if sheet.get('properties', {}).get('title') == sheet_title:
-                return sheet.get('properties', {}).get('sheetId')
-        return None
+        return _fetch_sheet_ids(service, spreadsheet_id).get(sheet_title)
     except HttpError as e:
         logger.error(f"Error getting sheet ID for title '{sheet_title}': {e}")
         return None
@@ -45,7 +97,7 @@ def _create_sheet_tab(service, spreadsheet_id, sheet_title):
                 }
             }]
         }
-        response = service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
+        response = _execute_with_backoff(service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body=body))
         # Assuming the new sheet is the last one in the response of addSheet requests
         created_sheet_properties = response.get('replies')[0].get('addSheet').get('properties')
         logger.info(f"Created new sheet tab: '{sheet_title}' with ID {created_sheet_properties.get('sheetId')}")
@@ -54,44 +106,18 @@ def _create_sheet_tab(service, spreadsheet_id, sheet_title):
         logger.error(f"Error creating sheet tab '{sheet_title}': {e}")
         return None
 
-def _ensure_sheet_tab_with_headers(service: Resource, spreadsheet_id: str, sheet_title: str, headers: list[str]) -> bool:
-    """Ensures a sheet (tab) with the given title and headers exists. Creates it if not."""
+def _ensure_sheet_tab_with_headers(service: Resource, spreadsheet_id: str, sheet_title: str, headers: list[str],
+                                   column_formats: dict[int, dict] | None = None) -> bool:
+    """Ensures a sheet (tab) with the given title and headers exists. Creates it if not.
+
+    column_formats maps 0-based column indices to a CellFormat numberFormat, applied below the header row
+    of a newly created tab.
+    """
+    if _cached_sheet_id(spreadsheet_id, sheet_title) is not None:
+        return True # Known to exist; no API call
     try:
-        sheet_metadata = service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-        sheets = sheet_metadata.get('sheets', '')
-        existing_sheet = next((s for s in sheets if s.get('properties', '').get('title', '') == sheet_title), None)
-
-        if existing_sheet:
-            logger.info(f"Sheet '{sheet_title}' already exists.")
-            # Optionally, check if headers are present and correct, though append will add them if sheet is empty
-            # For simplicity, we assume if it exists, it's usable or append will handle headers on empty sheet.
-            return True
-        else:
-            logger.info(f"Sheet '{sheet_title}' not found. Creating it...")
-            body = {
-                'requests': [{
-                    'addSheet': {
-                        'properties': {
-                            'title': sheet_title
-                        }
-                    }
-                }]
-            }
-            service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
-            logger.info(f"Sheet '{sheet_title}' created.")
-            
-            # Add headers to the new sheet
-            header_body = {
-                'values': [headers]
-            }
-            service.spreadsheets().values().update(
-                spreadsheetId=spreadsheet_id,
-                range=f"'{sheet_title}'!A1",
-                valueInputOption='USER_ENTERED',
-                body=header_body
-            ).execute()
-            logger.info(f"Headers added to sheet '{sheet_title}'.")
-            return True
+        with _ensure_sheet_lock:
+            return _ensure_sheet_tab_locked(service, spreadsheet_id, sheet_title, headers, column_formats)
     except HttpError as error:
         logger.error(f"Error ensuring sheet '{sheet_title}': {error}")
         return False
@@ -99,34 +125,148 @@ def _ensure_sheet_tab_with_headers(service: Resource, spreadsheet_id: str, sheet
         logger.error(f"Unexpected error ensuring sheet '{sheet_title}': {e}")
         return False
 
+def _ensure_sheet_tab_locked(service: Resource, spreadsheet_id: str, sheet_title: str, headers: list[str],
+                             column_formats: dict[int, dict] | None = None) -> bool:
+    """_ensure_sheet_tab_with_headers body; caller holds _ensure_sheet_lock. Raises HttpError."""
+    if _cached_sheet_id(spreadsheet_id, sheet_title) is not None:
+        return True # Created by another thread while we waited for the lock
+    sheet_ids = _fetch_sheet_ids(service, spreadsheet_id)
+
+    if sheet_title in sheet_ids:
+        logger.info(f"Sheet '{sheet_title}' already exists.")
+        # Optionally, check if headers are present and correct, though append will add them if sheet is empty
+        # For simplicity, we assume if it exists, it's usable or append will handle headers on empty sheet.
+        return True
+
+    logger.info(f"Sheet '{sheet_title}' not found. Creating it...")
+    # The tab and its header row go in one batchUpdate. Choosing the sheetId ourselves lets the
+    # updateCells request refer to the tab that the addSheet request in the same batch creates.
+    new_sheet_id = random.randrange(1, 2**31)
+    body = {
+        'requests': [
+            {
+                'addSheet': {
+                    'properties': {
+                        'sheetId': new_sheet_id,
+                        'title': sheet_title
+                    }
+                }
+            },
+            {
+                'updateCells': {
+                    'rows': [{'values': [{'userEnteredValue': {'stringValue': header}} for header in headers]}],
+                    'fields': 'userEnteredValue',
+                    'start': {'sheetId': new_sheet_id, 'rowIndex': 0, 'columnIndex': 0}
+                }
+            }
+        ] + [
+            {
+                'repeatCell': {
+                    'range': {'sheetId': new_sheet_id, 'startRowIndex': 1,
+                              'startColumnIndex': column_index, 'endColumnIndex': column_index + 1},
+                    'cell': {'userEnteredFormat': {'numberFormat': number_format}},
+                    'fields': 'userEnteredFormat.numberFormat'
+                }
+            }
+            for column_index, number_format in (column_formats or {}).items()
+        ]
+    }
+    response = _execute_with_backoff(service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body=body))
+    new_sheet_id = response['replies'][0]['addSheet']['properties']['sheetId']
+    logger.info(f"Sheet '{sheet_title}' created with headers.")
+    _remember_sheet_id(spreadsheet_id, sheet_title, new_sheet_id)
+    return True
+
 def _ensure_header_row(service, spreadsheet_id, sheet_title):
     """Ensures the header row exists for the main invoice sheets. (Uses predefined SHEET_HEADERS from config)"""
     # Use SHEET_HEADERS from config.py for consistency
-    return _ensure_sheet_tab_with_headers(service, spreadsheet_id, sheet_title, config.SHEET_HEADERS)
+    return _ensure_sheet_tab_with_headers(service, spreadsheet_id, sheet_title, config.SHEET_HEADERS,
+                                          _INVOICE_COLUMN_FORMATS)
 
-def read_sheet_data(spreadsheet_id: str, sheet_name_with_range: str) -> list[list[str]] | None:
-    """Reads data from a specific sheet and range."""
+def read_sheet_data_many(spreadsheet_id: str, ranges: list[str]) -> list[list[list[str]]] | None:
+    """Reads data from several sheets/ranges with one values().batchGet request.
+
+    Returns one list of rows per range, in input order ([] for a range with no data),
+    or None on error. Sheets fails the whole batch if any range is invalid (e.g., a missing tab).
+    """
+    if not ranges:
+        return []
     service = get_sheets_service()
     if not service:
         logger.error("Sheets service not available for reading data.")
         return None
     try:
-        logger.info(f"Reading data from spreadsheet '{spreadsheet_id}', range '{sheet_name_with_range}'")
-        result = service.spreadsheets().values().get(
+        logger.info(f"Reading data from spreadsheet '{spreadsheet_id}', ranges {ranges}")
+        result = _execute_with_backoff(service.spreadsheets().values().batchGet(
             spreadsheetId=spreadsheet_id,
-            range=sheet_name_with_range
-        ).execute()
-        values = result.get('values', [])
-        if not values:
-            logger.info(f"No data found in '{sheet_name_with_range}'.")
-            return [] # Return empty list not None if no data, to distinguish from error
-        return values
+            ranges=ranges,
+            majorDimension='ROWS'
+        ))
+        value_ranges = result.get('valueRanges', [])
+        all_values = [value_range.get('values', []) for value_range in value_ranges]
+        all_values += [[] for _ in range(len(ranges) - len(all_values))]
+        for sheet_name_with_range, values in zip(ranges, all_values):
+            if not values:
+                logger.info(f"No data found in '{sheet_name_with_range}'.")
+        return all_values # Empty lists, not None, if no data, to distinguish from error
     except HttpError as error:
-        logger.error(f"Error reading data from sheet '{sheet_name_with_range}': {error}")
+        logger.error(f"Error reading data from sheets {ranges}: {error}")
         return None # Error case
     except Exception as e_read:
-        logger.error(f"Unexpected error reading data from '{sheet_name_with_range}': {e_read}")
+        logger.error(f"Unexpected error reading data from {ranges}: {e_read}")
+        return None
+
+def read_sheet_data(spreadsheet_id: str, sheet_name_with_range: str) -> list[list[str]] | None:
+    """Reads data from a specific sheet and range."""
+    all_values = read_sheet_data_many(spreadsheet_id, [sheet_name_with_range])
+    return None if all_values is None else all_values[0]
+
+def _sheet_title_for(invoice_data: dict) -> str | None:
+    """Returns the monthly sheet title (e.g. "05.2025") for an invoice, or None if its date is unusable."""
+    invoice_date_str = invoice_data.get('invoice_date')
+    if not invoice_date_str:
+        logger.error("Invoice date missing in invoice_data. Cannot determine sheet title.")
         return None
+    try:
+        # fromisoformat parses zero-padded config.DATE_FORMAT (%Y-%m-%d) in C, without strptime's format handling
+        return date.fromisoformat(invoice_date_str).strftime(config.MONTH_YEAR_FORMAT) # %m.%Y
+    except (TypeError, ValueError):
+        pass # strptime below also accepts dates without zero padding, e.g. "2024-3-5"
+    try:
+        invoice_date_obj = datetime.strptime(invoice_date_str, config.DATE_FORMAT) # %Y-%m-%d
+        return invoice_date_obj.strftime(config.MONTH_YEAR_FORMAT) # %m.%Y
+    except (TypeError, ValueError) as ve:
+        logger.error(f"Error parsing invoice_date '{invoice_date_str}' to determine sheet title: {ve}")
+        return None
+
+_DOT2COMMA = str.maketrans({'.': ','})
+
+def _money_cell(value) -> float | str:
+    # Amounts arrive as floats rounded to cents (gemini_analyzer._postprocess) and are written as
+    # numbers; the column's numberFormat takes care of the display.
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    return str(value).translate(_DOT2COMMA) # Sheets often prefers comma for decimal in some locales
+
+def _yes_no_cell(value) -> str:
+    return "Так" if value else "Ні"
+
+# (invoice key, cell formatter) per sheet column, in config.SHEET_HEADERS order
+_ROW_CELL_FORMATTERS = {'gross_amount': _money_cell, 'vat_amount': _money_cell, 'is_fuel_related': _yes_no_cell}
+_ROW_FIELDS = tuple((key, _ROW_CELL_FORMATTERS.get(key, str)) for key, _ in config.INVOICE_COLUMNS)
+
+# Rows are written RAW (no locale-dependent parsing), so new monthly tabs get a number format on the
+# amount columns up front. No grouping separator, so vat_calculator.parse_decimal can read the values back.
+# Dates stay ISO text: as serial numbers they would show up as plain numbers in tabs created before this.
+_INVOICE_COLUMN_FORMATS = {
+    index: {'type': 'NUMBER', 'pattern': '0.00'}
+    for index, (key, _) in enumerate(config.INVOICE_COLUMNS) if _ROW_CELL_FORMATTERS.get(key) is _money_cell
+}
+
+def _invoice_row(invoice_data: dict, drive_file_link: str) -> list:
+    """Builds a sheet row for an invoice, in config.SHEET_HEADERS order."""
+    values = {**invoice_data, 'drive_file_link': drive_file_link if drive_file_link else ''}
+    return [format_cell(values.get(key, '')) for key, format_cell in _ROW_FIELDS]
 
 def append_invoice_to_sheet(invoice_data: dict, drive_file_link: str) -> str | None:
     """Appends invoice data to the appropriate monthly sheet in Google Sheets.
@@ -138,7 +278,7 @@ def append_invoice_to_sheet(invoice_data: dict, drive_file_link: str) -> str | N
         drive_file_link: The Google Drive link for the uploaded invoice.
 
     Returns:
-        The range where data was appended (e.g., "05.2025!A10"), or None if an error occurred.
+        The range where data was appended (e.g., "05.2025!A10:J10"), or None if an error occurred.
     """
     spreadsheet_id = os.getenv(config.GOOGLE_SHEET_ID_FAKTURY_ENV)
     if not spreadsheet_id:
@@ -150,147 +290,185 @@ def append_invoice_to_sheet(invoice_data: dict, drive_file_link: str) -> str | N
         logger.error("Failed to get Google Sheets service. Cannot append.")
         return None
 
-    try:
-        # Determine sheet title (e.g., "05.2025")
-        invoice_date_str = invoice_data.get('invoice_date')
-        if not invoice_date_str:
-            logger.error("Invoice date missing in invoice_data. Cannot determine sheet title.")
-            return None
-        invoice_date_obj = datetime.strptime(invoice_date_str, config.DATE_FORMAT) # %Y-%m-%d
-        sheet_title = invoice_date_obj.strftime(config.MONTH_YEAR_FORMAT) # %m.%Y
-    except ValueError as ve:
-        logger.error(f"Error parsing invoice_date '{invoice_date_str}' to determine sheet title: {ve}")
+    sheet_title = _sheet_title_for(invoice_data)
+    if not sheet_title:
         return None
 
     # Ensure sheet and headers exist
-    if not _ensure_sheet_tab_with_headers(service, spreadsheet_id, sheet_title, config.SHEET_HEADERS):
+    if not _ensure_sheet_tab_with_headers(service, spreadsheet_id, sheet_title, config.SHEET_HEADERS,
+                                          _INVOICE_COLUMN_FORMATS):
         logger.error(f"Failed to ensure sheet '{sheet_title}' with headers. Aborting append.")
         return None
 
-    # Prepare row data according to config.SHEET_HEADERS
-    # SHEET_HEADERS = ["Номер фактури", "Дата виставлення", "Виставив", "Дата оплати", "Платник", 
-    #                  "Сума (брутто)", "VAT", "Пов'язано з авто/паливом", "Посилання на Google Drive"]
-    row_values = []
     try:
-        row_values = [
-            str(invoice_data.get('invoice_number', '')),
-            str(invoice_data.get('invoice_date', '')),
-            str(invoice_data.get('issuer', '')),
-            str(invoice_data.get('due_date', '')),
-            str(invoice_data.get('payer', '')),
-            str(invoice_data.get('payer_nip', '')),
-            str(invoice_data.get('gross_amount', '')).replace('.', ','), # Sheets often prefers comma for decimal in some locales
-            str(invoice_data.get('vat_amount', '')).replace('.', ','),   # Sheets often prefers comma for decimal in some locales
-            "Так" if invoice_data.get('is_fuel_related') else "Ні",
-            str(drive_file_link if drive_file_link else '')
-        ]
+        row_values = _invoice_row(invoice_data, drive_file_link)
     except Exception as e_format:
         logger.error(f"Error formatting row data for Google Sheets: {e_format}. Data: {invoice_data}")
         return None
-        
+
     body = {
         'values': [row_values]
     }
-    
+
     try:
         logger.info(f"Appending data to sheet: '{sheet_title}', row: {row_values}")
-        result = service.spreadsheets().values().append(
+        result = _execute_with_backoff(service.spreadsheets().values().append(
             spreadsheetId=spreadsheet_id,
             range=f"'{sheet_title}'!A1", # Append after the last row with data in this range
-            valueInputOption='USER_ENTERED', # So Sheets interprets values as numbers, dates if possible
+            valueInputOption='RAW', # Amounts are sent as numbers; no formula/locale parsing of the strings
             insertDataOption='INSERT_ROWS',
             body=body
-        ).execute()
+        ), retry_statuses=_REJECTED_STATUSES)
         logger.info(f"Data appended successfully to '{sheet_title}'. Result: {result}")
         updated_range = result.get('updates', {}).get('updatedRange')
-        return updated_range # e.g., "05.2025!A10:I10"
+        return updated_range # e.g., "05.2025!A10:J10"
     except HttpError as error:
         logger.error(f"Error appending data to sheet '{sheet_title}': {error}")
+        if _is_missing_sheet_error(error):
+            _invalidate_sheet_ids(spreadsheet_id) # The tab may have been deleted; look it up again next time
         return None
     except Exception as e_append:
         logger.error(f"Unexpected error appending data to '{sheet_title}': {e_append}")
         return None
 
-def delete_invoice_row_by_range(spreadsheet_id: str, row_range_to_delete: str) -> bool:
+# Full A1 row-range grammar; only needed for titles the scanner below doesn't handle
+_ROW_RANGE_RE = re.compile(r"^(?:'(.*)'|([^'!]+))!(?:[A-Z]+)(\d+)(?::[A-Z]+\d+)?$")
+
+def _cell_row(cell: str) -> int | None:
+    """Returns the row number of an A1 cell such as "J10", or None if it isn't one."""
+    letters_end = len(cell) - len(cell.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+    digits = cell[letters_end:]
+    if not letters_end or not digits.isascii() or not digits.isdigit():
+        return None
+    return int(digits)
+
+def _parse_row_range(row_range: str) -> tuple[str, int] | None:
+    """Parses "05.2025!A10:J10" / "'Sheet Name'!A10" into (sheet title, first row number), or None."""
+    title, separator, cells = row_range.rpartition('!')
+    quoted = len(title) >= 2 and title[0] == title[-1] == "'"
+    if separator and (quoted or (title and "'" not in title and '!' not in title)):
+        first_cell, colon, last_cell = cells.partition(':')
+        row = _cell_row(first_cell)
+        if row is None or (colon and _cell_row(last_cell) is None):
+            return None
+        return (title[1:-1] if quoted else title), row
+    match = _ROW_RANGE_RE.match(row_range)
+    if not match:
+        return None
+    return match.group(1) or match.group(2), int(match.group(3)) # Group 1 for quoted, Group 2 for unquoted
+
+def _is_missing_grid_error(error: HttpError) -> bool:
+    """True for the error Sheets returns when a request refers to a sheetId that no longer exists."""
+    return error.resp.status == 400 and "No grid with id" in str(error)
+
+def _delete_rows(service, spreadsheet_id: str, rows_to_delete: set[tuple[int, int]]):
+    """Deletes (sheet_id, row_index_0_based) rows in one batchUpdate. Raises HttpError."""
+    # Bottom-up (highest row first) so earlier deletions don't shift the rows still to be deleted
+    requests = [{
+        "deleteDimension": {
+            "range": {
+                "sheetId": sheet_id,
+                "dimension": "ROWS",
+                "startIndex": row_index_0_based,
+                "endIndex": row_index_0_based + 1  # Deletes one row starting at startIndex
+            }
+        }
+    } for sheet_id, row_index_0_based in sorted(rows_to_delete, reverse=True)]
+
+    body = {'requests': requests}
+    _execute_with_backoff(service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body=body),
+                          retry_statuses=_REJECTED_STATUSES)
+
+def delete_invoice_rows_by_ranges(spreadsheet_id: str, row_ranges: list[str]) -> bool:
     """
-    Deletes a row from a Google Sheet based on its A1 notation range.
+    Deletes rows from a Google Sheet based on their A1 notation ranges, in a single batchUpdate.
 
     Args:
         spreadsheet_id: The ID of the Google Spreadsheet.
-        row_range_to_delete: The A1 notation of the range to delete (e.g., "05.2025!A10:I10" or "Sheet1!A5").
-                             It's assumed this range refers to a single row or part of a single row.
+        row_ranges: A1 notation ranges to delete (e.g., ["05.2025!A10:I10", "Sheet1!A5"]).
+                    Each range is assumed to refer to a single row or part of a single row.
 
     Returns:
-        True if deletion was successful or row_range_to_delete was invalid, False otherwise.
+        True if all deletions were successful (rows on missing sheets count as deleted), False otherwise.
     """
-    if not row_range_to_delete:
-        logger.warning("No row_range_to_delete provided. Skipping deletion.")
+    row_ranges = [row_range for row_range in row_ranges if row_range]
+    if not row_ranges:
+        logger.warning("No row ranges provided. Skipping deletion.")
         return True # Not an error, just nothing to do
 
     service = get_sheets_service()
     if not service:
-        logger.error("Failed to get Google Sheets service. Cannot delete row.")
+        logger.error("Failed to get Google Sheets service. Cannot delete rows.")
         return False
 
     try:
-        # Parse sheet_title and row_index from row_range_to_delete
-        # Example: "05.2025!A10:I10" or "'Sheet Name with Spaces'!A10"
-        match = re.match(r"^(?:'(.*)'|([^'!]+))!(?:[A-Z]+)(\d+)(?::[A-Z]+\d+)?$", row_range_to_delete)
-        if not match:
-            logger.error(f"Could not parse sheet title and row index from range: '{row_range_to_delete}'")
-            return False
-
-        sheet_title = match.group(1) or match.group(2) # Group 1 for quoted, Group 2 for unquoted
-        row_number_1_indexed = int(match.group(3))
-        
-        if not sheet_title or row_number_1_indexed <= 0:
-            logger.error(f"Invalid sheet title or row number parsed from '{row_range_to_delete}'. Title: '{sheet_title}', Row: {row_number_1_indexed}")
-            return False
-
-        logger.info(f"Attempting to delete row {row_number_1_indexed} from sheet '{sheet_title}' (range: '{row_range_to_delete}')")
-
-        sheet_id = _get_sheet_id_by_title(service, spreadsheet_id, sheet_title)
-        if sheet_id is None:
-            logger.error(f"Could not find sheetId for title '{sheet_title}'. Cannot delete row.")
-            # If the sheet itself doesn't exist, we can consider the "deletion" successful
-            # as the row is effectively not there. Or return False if explicit deletion failed.
-            # For now, let's say if sheet is gone, row is gone.
-            logger.warning(f"Sheet '{sheet_title}' not found. Assuming row is already effectively deleted.")
-            return True 
-
-        row_index_0_based = row_number_1_indexed - 1
-
-        requests = [{
-            "deleteDimension": {
-                "range": {
-                    "sheetId": sheet_id,
-                    "dimension": "ROWS",
-                    "startIndex": row_index_0_based,
-                    "endIndex": row_index_0_based + 1  # Deletes one row starting at startIndex
-                }
-            }
-        }]
-
-        body = {'requests': requests}
-        service.spreadsheets().batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
-        logger.info(f"Successfully deleted row {row_number_1_indexed} (index {row_index_0_based}) from sheet '{sheet_title}' (ID: {sheet_id}).")
-        return True
+        all_parsed = True
+        rows_to_delete = set()  # (sheet_id, row_index_0_based)
+        for row_range in row_ranges:
+            # Example: "05.2025!A10:I10" or "'Sheet Name with Spaces'!A10"
+            parsed = _parse_row_range(row_range)
+            if not parsed or not parsed[0] or parsed[1] <= 0:
+                logger.error(f"Could not parse sheet title and row index from range: '{row_range}'")
+                all_parsed = False
+                continue
+
+            sheet_title, row_number_1_indexed = parsed
+            sheet_id = _get_sheet_id_by_title(service, spreadsheet_id, sheet_title)
+            if sheet_id is None:
+                # If the sheet itself doesn't exist, the row is effectively not there.
+                logger.warning(f"Sheet '{sheet_title}' not found. Assuming row {row_range} is already effectively deleted.")
+                continue
+            rows_to_delete.add((sheet_id, row_number_1_indexed - 1))
+
+        if not rows_to_delete:
+            return all_parsed
+
+        logger.info(f"Attempting to delete {len(rows_to_delete)} row(s) from spreadsheet {spreadsheet_id} (ranges: {row_ranges})")
+        try:
+            _delete_rows(service, spreadsheet_id, rows_to_delete)
+        except HttpError as error:
+            if not _is_missing_grid_error(error):
+                raise
+            # SheetIds come from the cache without a GET. A tab deleted since then took its rows with it,
+            # but it fails the whole batch, so retry with only the rows on tabs that still exist.
+            # SheetIds are never reused, so the remaining ones still point at the same rows.
+            logger.warning(f"A sheet targeted by {row_ranges} no longer exists. Retrying on the remaining sheets.")
+            _invalidate_sheet_ids(spreadsheet_id)
+            live_sheet_ids = set(_fetch_sheet_ids(service, spreadsheet_id).values())
+            rows_to_delete = {row for row in rows_to_delete if row[0] in live_sheet_ids}
+            if rows_to_delete:
+                _delete_rows(service, spreadsheet_id, rows_to_delete)
+        logger.info(f"Successfully deleted {len(rows_to_delete)} row(s): {row_ranges}")
+        return all_parsed
 
     except HttpError as error:
-        logger.error(f"Error deleting row from sheet '{row_range_to_delete}': {error}")
+        logger.error(f"Error deleting rows {row_ranges} from sheet: {error}")
+        if _is_missing_sheet_error(error):
+            _invalidate_sheet_ids(spreadsheet_id)
         # Specific check for "Unable to parse range" which can happen if sheet was deleted
         # or if the range refers to something outside existing sheet dimensions after other deletions.
         if "Unable to parse range" in str(error) or "range (gridRange.startRowIndex)" in str(error):
-             logger.warning(f"Could not delete row {row_range_to_delete}. It might have been already deleted or sheet structure changed. Treating as non-critical.")
+             logger.warning(f"Could not delete rows {row_ranges}. They might have been already deleted or sheet structure changed. Treating as non-critical.")
              return True # Non-critical if row/sheet is already gone or range is invalid due to prior changes
         return False
-    except ValueError as ve: # For int conversion error
-        logger.error(f"ValueError parsing row index from '{row_range_to_delete}': {ve}")
-        return False
     except Exception as e:
-        logger.error(f"Unexpected error deleting row '{row_range_to_delete}': {e}")
+        logger.error(f"Unexpected error deleting rows {row_ranges}: {e}")
         return False
 
+def delete_invoice_row_by_range(spreadsheet_id: str, row_range_to_delete: str) -> bool:
+    """
+    Deletes a row from a Google Sheet based on its A1 notation range.
+
+    Args:
+        spreadsheet_id: The ID of the Google Spreadsheet.
+        row_range_to_delete: The A1 notation of the range to delete (e.g., "05.2025!A10:I10" or "Sheet1!A5").
+                             It's assumed this range refers to a single row or part of a single row.
+
+    Returns:
+        True if deletion was successful or row_range_to_delete was invalid, False otherwise.
+    """
+    return delete_invoice_rows_by_ranges(spreadsheet_id, [row_range_to_delete])
+
 if __name__ == '__main__':
     from dotenv import load_dotenv
     load_dotenv() # For testing
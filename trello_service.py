@@ -1,32 +1,91 @@
 import os
-from trello import TrelloClient
+import io
+import threading
+import requests
+from trello import TrelloClient, List, ResourceUnavailable
 import logging
+import api_retry
 import config # Import the config module
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# Built once and shared: py-trello otherwise goes through a fresh requests call per API request,
+# so reusing one requests.Session keeps the HTTPS connection to api.trello.com alive across cards.
+_TRELLO_CLIENT = None
+_trello_client_lock = threading.Lock()
+
 def get_trello_client():
-    """Initializes and returns a TrelloClient instance."""
-    api_key = os.getenv(config.TRELLO_API_KEY_ENV)
-    api_token = os.getenv(config.TRELLO_API_TOKEN_ENV)
-
-    # --- DEBUG LOGGING: Display Trello credentials ---
-    logger.info(f"Attempting to use Trello API Key (from {config.TRELLO_API_KEY_ENV}): '{api_key[:5]}...{api_key[-5:] if api_key and len(api_key) > 10 else api_key}'")
-    logger.info(f"Attempting to use Trello API Token (from {config.TRELLO_API_TOKEN_ENV}): '{api_token[:5]}...{api_token[-5:] if api_token and len(api_token) > 10 else api_token}'")
-    # --- END DEBUG LOGGING ---
-
-    if not all([api_key, api_token]):
-        logger.error(f"Trello API Key (env var: {config.TRELLO_API_KEY_ENV}) or Token (env var: {config.TRELLO_API_TOKEN_ENV}) not found in environment variables.")
-        raise ValueError(f"Missing Trello API Key or Token in .env file. Ensure {config.TRELLO_API_KEY_ENV} and {config.TRELLO_API_TOKEN_ENV} are set.")
-    
-    client = TrelloClient(
-        api_key=api_key,
-        token=api_token
-    )
-    return client
-
-def create_trello_card(invoice_data: dict, invoice_file_path: str, drive_file_link: str) -> str | None:
+    """Returns the shared TrelloClient instance, creating it on first use."""
+    global _TRELLO_CLIENT
+    if _TRELLO_CLIENT is not None:
+        return _TRELLO_CLIENT
+
+    with _trello_client_lock:
+        if _TRELLO_CLIENT is None:
+            api_key = os.getenv(config.TRELLO_API_KEY_ENV)
+            api_token = os.getenv(config.TRELLO_API_TOKEN_ENV)
+
+            if not all([api_key, api_token]):
+                logger.error(f"Trello API Key (env var: {config.TRELLO_API_KEY_ENV}) or Token (env var: {config.TRELLO_API_TOKEN_ENV}) not found in environment variables.")
+                raise ValueError(f"Missing Trello API Key or Token in .env file. Ensure {config.TRELLO_API_KEY_ENV} and {config.TRELLO_API_TOKEN_ENV} are set.")
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Using Trello API Key (from %s): '%s...%s'", config.TRELLO_API_KEY_ENV, api_key[:5], api_key[-5:])
+                logger.debug("Using Trello API Token (from %s): '%s...%s'", config.TRELLO_API_TOKEN_ENV, api_token[:5], api_token[-5:])
+
+            session = requests.Session()
+            session.hooks['response'].append(_raise_on_rate_limit)
+            _TRELLO_CLIENT = TrelloClient(
+                api_key=api_key,
+                token=api_token,
+                http_service=session
+            )
+    return _TRELLO_CLIENT
+
+# Trello answers 429 when the per-token rate limit is hit; the request was not applied, so it's safe to retry.
+# py-trello turns every non-2xx response into ResourceUnavailable, so the session raises requests'
+# own HTTPError for a 429 before py-trello sees the response.
+_RATE_LIMITED_STATUS = 429
+
+def _raise_on_rate_limit(response, *args, **kwargs):
+    """requests response hook: raises requests.HTTPError for a rate-limited response."""
+    if response.status_code == _RATE_LIMITED_STATUS:
+        response.raise_for_status()
+
+def _rate_limited_status(error: Exception) -> int | None:
+    if isinstance(error, requests.HTTPError) and error.response is not None \
+            and error.response.status_code == _RATE_LIMITED_STATUS:
+        return _RATE_LIMITED_STATUS
+    return None
+
+def _with_backoff(call):
+    """Runs a Trello API call, retrying with exponential backoff on 429."""
+    return api_retry.call_with_backoff(call, _rate_limited_status, api_name='Trello API')
+
+def _yes_no(value) -> str:
+    return "Так" if value else "Ні"
+
+# (invoice key, header, value formatter, default if missing) per card description line, in
+# config.INVOICE_COLUMNS order. A missing is_fuel_related defaults to None, i.e. "Ні".
+_DESCRIPTION_FIELDS = tuple((key, header, _yes_no, None) if key == 'is_fuel_related'
+                            else (key, header, str, 'N/A')
+                            for key, header in config.INVOICE_COLUMNS)
+
+# Trello ids are immutable, so the List handle is fetched once per id instead of board -> list per card
+_LIST_CACHE: dict[str, List] = {}
+
+def _get_invoice_list(client: TrelloClient, list_id: str) -> List:
+    """Returns the (cached) Trello List with the given ID, fetching it with a single GET on first use."""
+    invoice_list = _LIST_CACHE.get(list_id)
+    if invoice_list is None:
+        invoice_list = _with_backoff(lambda: client.get_list(list_id))
+        if invoice_list:
+            _LIST_CACHE[list_id] = invoice_list
+    return invoice_list
+
+def create_trello_card(invoice_data: dict, invoice_file_path: str, drive_file_link: str,
+                       file_bytes: bytes | None = None) -> str | None:
     """
     Creates a Trello card for an invoice.
 
@@ -34,8 +93,10 @@ def create_trello_card(invoice_data: dict, invoice_file_path: str, drive_file_li
         invoice_data (dict): A dictionary containing extracted invoice information.
                              Expected keys: due_date, payer, issuer, gross_amount, 
                                             vat_amount, invoice_date, invoice_number.
-        invoice_file_path (str): The local path to the original invoice file.
+        invoice_file_path (str): The local path to the original invoice file. With file_bytes,
+                                 only its base name is used (as the attachment name).
         drive_file_link (str): The Google Drive link for the uploaded invoice.
+        file_bytes (bytes, optional): The file's contents, if the caller already has them in memory.
 
     Returns:
         str: The ID of the created Trello card, or None if creation failed.
@@ -45,58 +106,52 @@ def create_trello_card(invoice_data: dict, invoice_file_path: str, drive_file_li
         board_id = os.getenv(config.TRELLO_BOARD_ID_ENV)
         invoice_list_id = os.getenv(config.TRELLO_INVOICE_LIST_ID_ENV)
 
-        # --- DEBUG LOGGING: Display Trello IDs ---
-        logger.info(f"Attempting to use Trello Board ID (from {config.TRELLO_BOARD_ID_ENV}): '{board_id}'")
-        logger.info(f"Attempting to use Trello Invoice List ID (from {config.TRELLO_INVOICE_LIST_ID_ENV}): '{invoice_list_id}'")
-        # --- END DEBUG LOGGING ---
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Using Trello Board ID (from %s): '%s'", config.TRELLO_BOARD_ID_ENV, board_id)
+            logger.debug("Using Trello Invoice List ID (from %s): '%s'", config.TRELLO_INVOICE_LIST_ID_ENV, invoice_list_id)
 
         if not all([board_id, invoice_list_id]):
             logger.error(f"Trello Board ID (env var: {config.TRELLO_BOARD_ID_ENV}) or Invoice List ID (env var: {config.TRELLO_INVOICE_LIST_ID_ENV}) not found in environment variables.")
             raise ValueError(f"Missing Trello Board ID or Invoice List ID in .env file. Ensure {config.TRELLO_BOARD_ID_ENV} and {config.TRELLO_INVOICE_LIST_ID_ENV} are set.")
 
-        # Get the board
-        board = client.get_board(board_id)
-        if not board:
-            logger.error(f"Trello board with ID '{board_id}' (from env var {config.TRELLO_BOARD_ID_ENV}) not found.")
-            return None
-
-        # Get the list
-        invoice_list = board.get_list(invoice_list_id)
+        invoice_list = _get_invoice_list(client, invoice_list_id)
         if not invoice_list:
-            logger.error(f"Trello list with ID '{invoice_list_id}' (from env var {config.TRELLO_INVOICE_LIST_ID_ENV}) not found on board '{board_id}'.")
+            logger.error(f"Trello list with ID '{invoice_list_id}' (from env var {config.TRELLO_INVOICE_LIST_ID_ENV}) not found.")
             return None
 
         # Prepare card details
         due_date_str = invoice_data.get("due_date", "N/A")
         card_name = f"Оплатити до: {due_date_str}"
         
-        is_fuel_related_str = "Так" if invoice_data.get("is_fuel_related") else "Ні"
-
-        # Align description with Google Sheets columns (config.SHEET_HEADERS)
-        # SHEET_HEADERS = ["Номер фактури", "Дата виставлення", "Виставив", "Дата оплати", "Платник", 
-        # "Сума (брутто)", "VAT", "Пов'язано з авто/паливом", "Посилання на Google Drive"]
-        description_parts = [
-            f"{config.SHEET_HEADERS[0]}: {invoice_data.get('invoice_number', 'N/A')}", # Номер фактури
-            f"{config.SHEET_HEADERS[1]}: {invoice_data.get('invoice_date', 'N/A')}",   # Дата виставлення
-            f"{config.SHEET_HEADERS[2]}: {invoice_data.get('issuer', 'N/A')}",         # Виставив
-            f"{config.SHEET_HEADERS[3]}: {invoice_data.get('due_date', 'N/A')}",           # Дата оплати
-            f"{config.SHEET_HEADERS[4]}: {invoice_data.get('payer', 'N/A')}",          # Платник
-            f"{config.SHEET_HEADERS[5]}: {invoice_data.get('payer_nip', 'N/A')}",      # NIP Платника
-            f"{config.SHEET_HEADERS[6]}: {invoice_data.get('gross_amount', 'N/A')}",   # Сума (брутто)
-            f"{config.SHEET_HEADERS[7]}: {invoice_data.get('vat_amount', 'N/A')}",          # VAT
-            f"{config.SHEET_HEADERS[8]}: {is_fuel_related_str}",                         # Пов'язано з авто/паливом
-            f"{config.SHEET_HEADERS[9]}: {drive_file_link if drive_file_link else 'N/A'}" # Посилання на Google Drive
-        ]
-        description = "\n".join(description_parts)
+        # Same fields and headers as the Google Sheets columns (config.INVOICE_COLUMNS)
+        values = {**invoice_data, 'drive_file_link': drive_file_link if drive_file_link else 'N/A'}
+        description = "\n".join(f"{header}: {format_value(values.get(key, default))}"
+                                for key, header, format_value, default in _DESCRIPTION_FIELDS)
 
         # Create the card
-        new_card = invoice_list.add_card(name=card_name, desc=description)
+        try:
+            new_card = _with_backoff(lambda: invoice_list.add_card(name=card_name, desc=description))
+        except ResourceUnavailable:
+            # The cached list may be stale (e.g., archived and re-created); look it up again once.
+            logger.warning(f"Trello list '{invoice_list_id}' unavailable, refreshing cached handle and retrying.")
+            _LIST_CACHE.pop(invoice_list_id, None)
+            invoice_list = _get_invoice_list(client, invoice_list_id)
+            if not invoice_list:
+                logger.error(f"Trello list with ID '{invoice_list_id}' not found after refreshing its cached handle.")
+                return None
+            new_card = _with_backoff(lambda: invoice_list.add_card(name=card_name, desc=description))
         logger.info(f"Trello card '{new_card.name}' created successfully. ID: {new_card.id}, URL: {new_card.url}")
 
         # Attach the invoice file
-        if os.path.exists(invoice_file_path):
+        if file_bytes is not None:
+            _with_backoff(lambda: new_card.attach(name=os.path.basename(invoice_file_path), file=io.BytesIO(file_bytes)))
+            logger.info(f"Attached file '{os.path.basename(invoice_file_path)}' to card '{new_card.name}'.")
+        elif os.path.exists(invoice_file_path):
             with open(invoice_file_path, 'rb') as f:
-                new_card.attach(name=os.path.basename(invoice_file_path), file=f)
+                def attach_file():
+                    f.seek(0) # Rewind in case a rate-limited attempt already consumed it
+                    return new_card.attach(name=os.path.basename(invoice_file_path), file=f)
+                _with_backoff(attach_file)
             logger.info(f"Attached file '{os.path.basename(invoice_file_path)}' to card '{new_card.name}'.")
         else:
             logger.warning(f"Invoice file not found at path: {invoice_file_path}. Cannot attach to Trello card.")
@@ -119,9 +174,9 @@ def delete_trello_card(card_id: str) -> bool:
     """
     try:
         client = get_trello_client()
-        card = client.get_card(card_id)
+        card = _with_backoff(lambda: client.get_card(card_id))
         if card:
-            card.delete()
+            _with_backoff(card.delete)
             logger.info(f"Trello card with ID '{card_id}' deleted successfully.")
             return True
         else:
@@ -1,8 +1,10 @@
 import logging
 import os
+import sys
 from datetime import datetime, timedelta
 from decimal import Decimal, InvalidOperation
-from collections import defaultdict # Added for grouping
+from itertools import islice
+from googleapiclient.errors import HttpError
 
 import config
 import sheets_service
@@ -21,6 +23,8 @@ COL_IDX_PAYER_NIP = config.SHEET_HEADERS.index("NIP Платника")
 COL_IDX_GROSS_AMOUNT = config.SHEET_HEADERS.index("Сума (брутто)")
 COL_IDX_VAT = config.SHEET_HEADERS.index("VAT")
 COL_IDX_IS_FUEL_RELATED = config.SHEET_HEADERS.index("Пов'язано з авто/паливом")
+# A row must reach the last of the columns above to be usable
+MIN_INVOICE_ROW_LEN = max(COL_IDX_INVOICE_NUMBER, COL_IDX_INVOICE_DATE, COL_IDX_GROSS_AMOUNT, COL_IDX_PAYER, COL_IDX_PAYER_NIP, COL_IDX_VAT, COL_IDX_IS_FUEL_RELATED) + 1
 
 def get_previous_month_sheet_title():
     """Determines the sheet title for the previous month (e.g., '04.2024')."""
@@ -29,12 +33,24 @@ def get_previous_month_sheet_title():
     last_day_of_previous_month = first_day_of_current_month - timedelta(days=1)
     return last_day_of_previous_month.strftime(config.MONTH_YEAR_FORMAT)
 
+_DECIMAL_TRANS = str.maketrans(',', '.')
+# Spellings of "yes" in the fuel/auto column that need no case folding; "Так" is what sheets_service writes
+_FUEL_YES = frozenset({"Так", "так", "ТАК"})
+
+def _is_fuel_flag(value) -> bool:
+    """True if a "Пов'язано з авто/паливом" cell says yes ("так", in any case)."""
+    text = str(value).strip()
+    if text in _FUEL_YES:
+        return True
+    return len(text) == 3 and text.lower() == 'так' # "Ні" and other answers are rejected without lower()
+
 def parse_decimal(value_str: str) -> Decimal | None:
     """Safely parses a string to a Decimal, handling potential errors."""
     if isinstance(value_str, (int, float, Decimal)):
         return Decimal(value_str)
     try:
-        return Decimal(str(value_str).replace(',', '.').strip())
+        text = value_str if isinstance(value_str, str) else str(value_str)
+        return Decimal(text.translate(_DECIMAL_TRANS).strip())
     except (InvalidOperation, ValueError, TypeError):
         logger.warning(f"Could not parse '{value_str}' as Decimal.")
         return None
@@ -50,7 +66,16 @@ def calculate_and_record_vat_summary():
     prev_month_sheet_title = get_previous_month_sheet_title()
     logger.info(f"Reading data from sheet: '{prev_month_sheet_title}' for VAT calculation.")
 
-    data = sheets_service.read_sheet_data(spreadsheet_id, prev_month_sheet_title)
+    summary_sheet_title = config.VAT_SUMMARY_SHEET_NAME
+    # The month's invoices and the existing summary rows in one batchGet
+    all_values = sheets_service.read_sheet_data_many(spreadsheet_id, [f"'{prev_month_sheet_title}'", f"'{summary_sheet_title}'"])
+    if all_values is not None:
+        data, summary_data = all_values
+    else:
+        # batchGet fails as a whole if either tab is missing (e.g., no summary sheet yet): read the month alone,
+        # and leave the summary sheet to be created and read below.
+        data = sheets_service.read_sheet_data(spreadsheet_id, prev_month_sheet_title)
+        summary_data = None
 
     if data is None:
         logger.error(f"Failed to read data from sheet '{prev_month_sheet_title}'. Aborting VAT calculation.")
@@ -62,7 +87,7 @@ def calculate_and_record_vat_summary():
         return
 
     header_row_from_sheet = data[0]
-    invoice_rows = data[1:]
+    invoice_rows = islice(data, 1, None) # Single forward pass below; no copy of the rows list
 
     if header_row_from_sheet != config.SHEET_HEADERS:
         logger.warning(
@@ -71,20 +96,22 @@ def calculate_and_record_vat_summary():
             f"Proceeding based on column indices derived from config.SHEET_HEADERS."
         )
 
-    # --- Deduplication and Grouping by Payer (using NIP as the primary key for payer) ---
-    # Dictionary to hold unique invoices grouped by (payer_nip, payer_name)
-    # Key: (payer_nip, payer_name), Value: set of (invoice_number, invoice_date, gross_amount_str)
-    grouped_unique_invoices_keys = defaultdict(set)
-    # Dictionary to hold the actual row data for unique invoices, keyed by (payer_nip, payer_name)
-    # Key: (payer_nip, payer_name), Value: list of [row_data]
-    payer_invoices_data = defaultdict(list)
+    # --- Deduplication, Grouping by Payer (using NIP as the primary key for payer) and VAT totals, in one pass ---
+    # Invoices seen so far, as (payer_nip, payer_name, invoice_number, invoice_date, gross_amount_str)
+    seen_invoice_keys = set()
+    # Running totals over the unique invoices, keyed by (payer_nip, payer_name)
+    # Key: (payer_nip, payer_name), Value: [unique invoice count, total VAT, total fuel/auto VAT (100%)]
+    payer_vat_totals = {}
 
     for row in invoice_rows:
         try:
             # Ensure row has enough columns before accessing by index
-            if len(row) > max(COL_IDX_INVOICE_NUMBER, COL_IDX_INVOICE_DATE, COL_IDX_GROSS_AMOUNT, COL_IDX_PAYER, COL_IDX_PAYER_NIP, COL_IDX_VAT, COL_IDX_IS_FUEL_RELATED):
-                payer_name = str(row[COL_IDX_PAYER]).strip()
-                payer_nip = str(row[COL_IDX_PAYER_NIP]).strip()
+            if len(row) >= MIN_INVOICE_ROW_LEN:
+                # Every cell the calculation reads, as stripped strings, in one pass
+                norm = [str(cell).strip() for cell in row[:MIN_INVOICE_ROW_LEN]]
+                # Interned: a payer repeats on many rows, and every seen_invoice_keys entry holds these two strings
+                payer_name = sys.intern(norm[COL_IDX_PAYER])
+                payer_nip = sys.intern(norm[COL_IDX_PAYER_NIP])
                 
                 if not payer_nip and not payer_name: # Skip if no payer identifier
                     logger.warning(f"Skipping row due to missing Payer Name and Payer NIP: {row}")
@@ -98,56 +125,56 @@ def calculate_and_record_vat_summary():
                 payer_group_key = (payer_nip if payer_nip else "NIP_UNKNOWN", payer_name)
 
 
-                invoice_number = str(row[COL_IDX_INVOICE_NUMBER]).strip()
-                invoice_date = str(row[COL_IDX_INVOICE_DATE]).strip()
-                gross_amount_str = str(row[COL_IDX_GROSS_AMOUNT]).strip()
-                
-                invoice_dedup_key = (invoice_number, invoice_date, gross_amount_str)
+                invoice_dedup_key = (norm[COL_IDX_INVOICE_NUMBER], norm[COL_IDX_INVOICE_DATE], norm[COL_IDX_GROSS_AMOUNT])
 
-                if invoice_dedup_key not in grouped_unique_invoices_keys[payer_group_key]:
-                    payer_invoices_data[payer_group_key].append(row)
-                    grouped_unique_invoices_keys[payer_group_key].add(invoice_dedup_key)
-                else:
+                invoice_key = payer_group_key + invoice_dedup_key
+                if invoice_key in seen_invoice_keys:
                     logger.info(f"Duplicate invoice found for payer '{payer_name}' (NIP: {payer_nip}) and skipped: {invoice_dedup_key}")
+                    continue
+                seen_invoice_keys.add(invoice_key)
+
+                vat_totals = payer_vat_totals.setdefault(payer_group_key, [0, Decimal(0), Decimal(0)])
+                vat_totals[0] += 1
+                vat_amount = parse_decimal(norm[COL_IDX_VAT])
+                if vat_amount is None:
+                    logger.warning(f"Could not parse VAT amount for row: {row} (Payer: {payer_name}). Skipping VAT for this row.")
+                    continue
+                vat_totals[1] += vat_amount
+                if _is_fuel_flag(norm[COL_IDX_IS_FUEL_RELATED]):
+                    vat_totals[2] += vat_amount
             else:
                 logger.warning(f"Skipping row due to insufficient columns: {row}")
         except Exception as e:
-            logger.error(f"Error during deduplication/grouping for row {row}: {e}", exc_info=True)
+            logger.error(f"Error during deduplication/grouping/VAT calculation for row {row}: {e}", exc_info=True)
             continue
     
-    if not payer_invoices_data:
+    if not payer_vat_totals:
         logger.info(f"No unique invoices found after deduplication and grouping for sheet '{prev_month_sheet_title}'.")
         return
 
-    logger.info(f"Processing VAT for {len(payer_invoices_data)} unique payers/groups.")
+    logger.info(f"Processing VAT for {len(payer_vat_totals)} unique payers/groups.")
 
-    for (payer_nip_key, payer_name_key), unique_rows_for_payer in payer_invoices_data.items():
-        logger.info(f"--- Calculating VAT for Payer: {payer_name_key} (NIP: {payer_nip_key if payer_nip_key != 'NIP_UNKNOWN' else 'N/A'}) ---")
-        logger.info(f"Found {len(unique_rows_for_payer)} unique invoices for this payer.")
+    service = sheets_service.get_sheets_service()
+    if not service:
+        logger.error("Sheets service not available for writing VAT summary.")
+        return
 
-        total_vat_before_deduction = Decimal(0)
-        total_fuel_auto_vat = Decimal(0)
+    if summary_data is None:
+        if not sheets_service._ensure_sheet_tab_with_headers(service, spreadsheet_id, summary_sheet_title, config.VAT_SUMMARY_HEADERS):
+            logger.error(f"Failed to ensure VAT summary sheet '{summary_sheet_title}' with headers. Cannot write summary.")
+            return
+        summary_data = sheets_service.read_sheet_data(spreadsheet_id, summary_sheet_title)
+        if summary_data is None:
+            logger.error(f"Failed to read VAT summary sheet '{summary_sheet_title}'. Cannot write summary.")
+            return
 
-        for row_data in unique_rows_for_payer:
-            try:
-                # Already checked length during grouping, but good practice
-                vat_amount_str = row_data[COL_IDX_VAT]
-                is_fuel_str = str(row_data[COL_IDX_IS_FUEL_RELATED]).strip().lower()
-                
-                vat_amount = parse_decimal(vat_amount_str)
-                if vat_amount is None:
-                    logger.warning(f"Could not parse VAT amount for row: {row_data} (Payer: {payer_name_key}). Skipping VAT for this row.")
-                    continue
+    summary_index = _build_summary_index(summary_data)
+
+    summary_rows = []
+    for (payer_nip_key, payer_name_key), (invoice_count, total_vat_before_deduction, total_fuel_auto_vat) in payer_vat_totals.items():
+        logger.info(f"--- Calculating VAT for Payer: {payer_name_key} (NIP: {payer_nip_key if payer_nip_key != 'NIP_UNKNOWN' else 'N/A'}) ---")
+        logger.info(f"Found {invoice_count} unique invoices for this payer.")
 
-                total_vat_before_deduction += vat_amount
-                if is_fuel_str == 'так':
-                    total_fuel_auto_vat += vat_amount
-            except IndexError:
-                 logger.warning(f"Skipping row in VAT calculation for payer {payer_name_key} due to insufficient columns: {row_data}")
-            except Exception as e_calc:
-                logger.error(f"Unexpected error processing row {row_data} for VAT calculation (Payer: {payer_name_key}): {e_calc}", exc_info=True)
-                continue
-        
         logger.info(f"Payer: {payer_name_key} (NIP: {payer_nip_key}) - Total VAT (before deductions): {total_vat_before_deduction}")
         logger.info(f"Payer: {payer_name_key} (NIP: {payer_nip_key}) - Total Fuel/Auto VAT (100%): {total_fuel_auto_vat}")
 
@@ -157,35 +184,39 @@ def calculate_and_record_vat_summary():
         logger.info(f"Payer: {payer_name_key} (NIP: {payer_nip_key}) - 50% Fuel/Auto VAT (for deduction): {vat_fuel_auto_50_percent_to_deduct}")
         logger.info(f"Payer: {payer_name_key} (NIP: {payer_nip_key}) - Final VAT Payable (after deductions): {final_vat_payable}")
 
-        _write_vat_summary_row(
-            spreadsheet_id, 
+        summary_rows.append(_vat_summary_row(
             prev_month_sheet_title, # This is the "Звітний Місяць.Рік"
             payer_name_key,
             payer_nip_key if payer_nip_key != 'NIP_UNKNOWN' else "", # Pass empty string if NIP was unknown
             total_vat_before_deduction, 
             total_fuel_auto_vat, 
             final_vat_payable
-        )
+        ))
 
-def _write_vat_summary_row(spreadsheet_id, report_month_year, payer_name, payer_nip, total_vat_before_deduction, total_fuel_auto_vat_100, final_vat_payable):
-    """Writes a single summary row to the VAT Summary sheet for a specific payer."""
-    summary_sheet_title = config.VAT_SUMMARY_SHEET_NAME
-    service = sheets_service.get_sheets_service()
+    _write_vat_summary_rows(service, spreadsheet_id, summary_data, summary_index, summary_rows)
 
-    if not service:
-        logger.error("Sheets service not available for writing VAT summary.")
-        return
+def _summary_key(report_month_year, payer_nip, payer_name):
+    """Key of a VAT summary row: month and NIP, or month and payer name when the NIP is empty."""
+    return (report_month_year, payer_nip, '' if payer_nip else payer_name)
 
-    if not sheets_service._ensure_sheet_tab_with_headers(service, spreadsheet_id, summary_sheet_title, config.VAT_SUMMARY_HEADERS):
-        logger.error(f"Failed to ensure VAT summary sheet '{summary_sheet_title}' with headers. Cannot write summary.")
-        return
-    
+def _build_summary_index(existing_data):
+    """Maps _summary_key(...) of each VAT Summary sheet row to its 1-based row number."""
+    summary_index = {}
+    for i, row in enumerate(islice(existing_data, 1, None), start=2): # Start from 2 for 1-based indexing in Sheets
+        if row and len(row) >= 3:
+            # Match on NIP if present, or on name if the NIP is empty (the first matching row wins)
+            key = _summary_key(row[0], str(row[2]).strip(), str(row[1]).strip())
+            summary_index.setdefault(key, i)
+    return summary_index
+
+def _vat_summary_row(report_month_year, payer_name, payer_nip, total_vat_before_deduction, total_fuel_auto_vat_100, final_vat_payable):
+    """Builds the VAT Summary sheet row for a specific payer."""
     # Data for the new multi-column structure:
     # config.VAT_SUMMARY_HEADERS = [
     #     "Звітний Місяць.Рік", "Платник", "NIP Платника", 
     #     "Загальна сума VAT (до вирахувань)", "VAT Авто (100%)", "VAT до сплати (після вирахувань)"
     # ]
-    summary_row_data = [
+    return [
         report_month_year,
         payer_name,
         payer_nip,
@@ -194,52 +225,64 @@ def _write_vat_summary_row(spreadsheet_id, report_month_year, payer_name, payer_
         f"{final_vat_payable:.2f}"
     ]
 
-    try:
-        existing_data = sheets_service.read_sheet_data(spreadsheet_id, summary_sheet_title)
-        row_index_to_update = -1
-        if existing_data and len(existing_data) > 1: # Headers + data
-            for i, row in enumerate(existing_data[1:], start=2): # Start from 2 for 1-based indexing in Sheets
-                # Check for matching report_month_year AND payer_nip (or payer_name if NIP is empty)
-                if row and len(row) >=3 and row[0] == report_month_year:
-                    sheet_payer_nip = str(row[2]).strip()
-                    sheet_payer_name = str(row[1]).strip()
-                    
-                    # Match primarily on NIP if available, otherwise on name.
-                    # This handles cases where NIP might have been missing for the payer_group_key
-                    match_found = False
-                    if payer_nip and sheet_payer_nip == payer_nip:
-                        match_found = True
-                    elif not payer_nip and not sheet_payer_nip and sheet_payer_name == payer_name: # Both NIPs are empty, match by name
-                        match_found = True
-                    # Add a fallback if one NIP is present and the other is not, but names match?
-                    # For now, strict NIP match if present, or name match if both NIPs are absent.
-                    
-                    if match_found:
-                        row_index_to_update = i
-                        break
-        
+def _summary_row_unchanged(existing_row, summary_row_data):
+    """True if a VAT Summary sheet row already holds summary_row_data (amounts compared as numbers)."""
+    if len(existing_row) < len(summary_row_data):
+        return False
+    if [str(value).strip() for value in existing_row[:3]] != summary_row_data[:3]:
+        return False
+    return all(parse_decimal(existing_value) == Decimal(new_value)
+               for existing_value, new_value in zip(existing_row[3:], summary_row_data[3:]))
+
+def _write_vat_summary_rows(service, spreadsheet_id, summary_data, summary_index, summary_rows):
+    """Writes payer summary rows to the VAT Summary sheet: one values().batchUpdate for rows that already
+    exist there (summary_data as read, summary_index from _build_summary_index) and one append for the rest.
+    Rows that already hold the same values are not rewritten."""
+    summary_sheet_title = config.VAT_SUMMARY_SHEET_NAME
+
+    # Later rows with the same key replace earlier ones, as if each had been written in turn
+    rows_to_update = {}  # 1-based row number -> row data
+    rows_to_append = {}  # _summary_key -> row data
+    for summary_row_data in summary_rows:
+        report_month_year, payer_name, payer_nip = summary_row_data[:3]
+        summary_key = _summary_key(report_month_year, payer_nip, payer_name)
+        row_index_to_update = summary_index.get(summary_key, -1)
         if row_index_to_update != -1:
-            logger.info(f"Updating existing VAT summary row for '{report_month_year}', Payer: '{payer_name}' (NIP: {payer_nip}) at row {row_index_to_update}.")
-            # Update the entire row for the specific payer and month
-            range_to_update = f"'{summary_sheet_title}'!A{row_index_to_update}" 
-            body = {'values': [summary_row_data]}
-            service.spreadsheets().values().update(
-                spreadsheetId=spreadsheet_id, range=range_to_update,
-                valueInputOption='USER_ENTERED', body=body
-            ).execute()
+            rows_to_update[row_index_to_update] = summary_row_data
         else:
             logger.info(f"Appending new VAT summary row for '{report_month_year}', Payer: '{payer_name}' (NIP: {payer_nip}).")
-            body = {'values': [summary_row_data]}
-            service.spreadsheets().values().append(
+            rows_to_append[summary_key] = summary_row_data
+
+    for row_index, summary_row_data in list(rows_to_update.items()):
+        report_month_year, payer_name, payer_nip = summary_row_data[:3]
+        if _summary_row_unchanged(summary_data[row_index - 1], summary_row_data):
+            logger.info(f"VAT summary row for '{report_month_year}', Payer: '{payer_name}' (NIP: {payer_nip}) at row {row_index} is unchanged. Skipping.")
+            del rows_to_update[row_index]
+        else:
+            logger.info(f"Updating existing VAT summary row for '{report_month_year}', Payer: '{payer_name}' (NIP: {payer_nip}) at row {row_index}.")
+
+    try:
+        if rows_to_update:
+            body = {
+                'valueInputOption': 'USER_ENTERED',
+                'data': [{'range': f"'{summary_sheet_title}'!A{row_index}", 'values': [summary_row_data]}
+                         for row_index, summary_row_data in rows_to_update.items()]
+            }
+            sheets_service._execute_with_backoff(service.spreadsheets().values().batchUpdate(
+                spreadsheetId=spreadsheet_id, body=body
+            ))
+        if rows_to_append:
+            body = {'values': list(rows_to_append.values())}
+            sheets_service._execute_with_backoff(service.spreadsheets().values().append(
                 spreadsheetId=spreadsheet_id, range=f"'{summary_sheet_title}'!A1",
                 valueInputOption='USER_ENTERED', insertDataOption='INSERT_ROWS', body=body
-            ).execute()
-        logger.info(f"Successfully wrote VAT summary for '{report_month_year}', Payer: '{payer_name}' to '{summary_sheet_title}'.")
+            ), retry_statuses=sheets_service._REJECTED_STATUSES)
+        logger.info(f"Successfully wrote {len(rows_to_update)} updated and {len(rows_to_append)} new VAT summary row(s) to '{summary_sheet_title}'.")
 
-    except HttpError as e: # Make sure HttpError is imported or handle googleapiclient.errors.HttpError
-        logger.error(f"Google API HttpError writing VAT summary to sheet '{summary_sheet_title}' for Payer '{payer_name}': {e}", exc_info=True)
+    except HttpError as e:
+        logger.error(f"Google API HttpError writing VAT summary to sheet '{summary_sheet_title}': {e}", exc_info=True)
     except Exception as e_gen:
-        logger.error(f"Generic error writing VAT summary for '{report_month_year}', Payer '{payer_name}': {e_gen}", exc_info=True)
+        logger.error(f"Generic error writing VAT summary to sheet '{summary_sheet_title}': {e_gen}", exc_info=True)
 
 if __name__ == '__main__':
     from dotenv import load_dotenv